@@ -21,8 +21,10 @@ def main(global_config, **settings):
                                          callback=add_role_principals)
 
     config.add_route('swagger_ui', '/api/swagger.html')
+    config.add_database_free_route('swagger_ui')
     config.scan("caleido.views")
     config.add_static_view('api', path='caleido:static/dist/swagger')
+    config.add_database_free_route('__api/')
 
     return config.make_wsgi_app()
 
@@ -0,0 +1,122 @@
+"""
+Closure table of the group hierarchy.
+
+The group_closure table holds a row for every ancestor and descendant pair
+of groups, so the descendants or ancestors of a group are found with an
+indexed lookup instead of a recursive query. The table is updated by
+`refresh_group_closure` whenever a flush adds groups or changes their
+parent. Rows of deleted groups are removed by the foreign key cascades.
+The table of an existing repository is filled by `rebuild_group_closure`.
+"""
+import sqlalchemy as sql
+
+from caleido.models import Group, GroupClosure
+
+def descendants_query(group_ids, include_self=False):
+    """
+    Return a select of the ids of the descendants of the groups with
+    `group_ids`, which is a list of ids or a select of ids.
+    """
+    query = sql.select([GroupClosure.descendant_id]).where(
+        GroupClosure.ancestor_id.in_(group_ids))
+    if not include_self:
+        query = query.where(GroupClosure.depth > 0)
+    return query
+
+def ancestors_query(group_ids, include_self=False):
+    """
+    Return a select of the ids of the ancestors of the groups with
+    `group_ids`, which is a list of ids or a select of ids.
+    """
+    query = sql.select([GroupClosure.ancestor_id]).where(
+        GroupClosure.descendant_id.in_(group_ids))
+    if not include_self:
+        query = query.where(GroupClosure.depth > 0)
+    return query
+
+def attach_group(session, group_id, parent_id):
+    """
+    Move the subtree of the group with `group_id` below the group with
+    `parent_id`, or make it a root group if `parent_id` is None.
+    """
+    closure = GroupClosure.__table__
+    members = closure.alias('members')
+    subtree = sql.select([members.c.descendant_id]).where(
+        members.c.ancestor_id == group_id)
+    # detach the subtree from the ancestors of its previous parent
+    session.execute(closure.delete().where(
+        sql.and_(closure.c.descendant_id.in_(subtree),
+                 closure.c.ancestor_id.notin_(subtree))))
+    if parent_id is None:
+        return
+    ancestors = closure.alias('ancestors')
+    descendants = closure.alias('descendants')
+    session.execute(closure.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        sql.select([ancestors.c.ancestor_id,
+                    descendants.c.descendant_id,
+                    ancestors.c.depth + descendants.c.depth + 1]).where(
+                        sql.and_(ancestors.c.descendant_id == parent_id,
+                                 descendants.c.ancestor_id == group_id))))
+
+def rebuild_group_closure(session):
+    "Replace the rows of the closure table with the rows of all groups"
+    closure = GroupClosure.__table__
+    groups = Group.__table__
+    session.execute(closure.delete())
+    paths = sql.select([groups.c.id.label('ancestor_id'),
+                        groups.c.id.label('descendant_id'),
+                        sql.literal(0).label('depth')]).cte(
+                            'paths', recursive=True)
+    children = groups.alias('children')
+    paths = paths.union_all(
+        sql.select([paths.c.ancestor_id,
+                    children.c.id,
+                    paths.c.depth + 1]).where(
+                        children.c.parent_id == paths.c.descendant_id))
+    session.execute(closure.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        sql.select([paths.c.ancestor_id,
+                    paths.c.descendant_id,
+                    paths.c.depth])))
+
+def parent_changed(instance):
+    state = sql.inspect(instance)
+    return (state.attrs.parent_id.history.has_changes() or
+            state.attrs.parent.history.has_changes())
+
+def refresh_group_closure(session, flush_context):
+    """
+    Update the closure table for the groups added or re-parented by a
+    flush, returns True if the table was changed.
+    """
+    new_groups = [instance for instance in session.new
+                  if isinstance(instance, Group)]
+    moved_groups = [instance for instance in session.dirty
+                    if isinstance(instance, Group) and
+                    parent_changed(instance)]
+    if not new_groups and not moved_groups:
+        return False
+    if new_groups:
+        session.execute(GroupClosure.__table__.insert(), [
+            {'ancestor_id': group.id,
+             'descendant_id': group.id,
+             'depth': 0} for group in new_groups])
+    # attaching moves the complete subtree of a group, so the result does
+    # not depend on the order in which the groups are attached
+    for group in new_groups + moved_groups:
+        if group in session.new and group.parent_id is None:
+            continue
+        attach_group(session, group.id, group.parent_id)
+    return True
+
+def would_create_cycle(session, group_id, parent_id):
+    "Return True if `parent_id` is the group itself or one of its descendants"
+    if group_id is None or parent_id is None:
+        return False
+    if group_id == parent_id:
+        return True
+    return session.execute(
+        sql.select([sql.exists().where(
+            sql.and_(GroupClosure.ancestor_id == group_id,
+                     GroupClosure.descendant_id == parent_id))])).scalar()
@@ -10,3 +10,15 @@ class StorageError(Exception):
         if isinstance(err, sqlalchemy.exc.IntegrityError):
             return StorageError(err.args[0], location=None)
 
+
+
+class InvalidCursor(ValueError):
+    "A pagination cursor does not match the sort order of a listing"
+
+
+class QueryBudgetExceeded(Exception):
+    "A request exceeded its budget of queries or database time"
+
+
+class StatementTimeout(Exception):
+    "A statement was cancelled by the database because it ran too long"
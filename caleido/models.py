@@ -14,7 +14,9 @@ from sqlalchemy import (
     ForeignKey,
     ForeignKeyConstraint,
     UniqueConstraint,
-    CheckConstraint
+    CheckConstraint,
+    collate,
+    func
     )
 from sqlalchemy.orm import relationship, configure_mappers
 from sqlalchemy.schema import Index
@@ -28,6 +30,39 @@ Base = declarative_base()
 
 from caleido.utils import parse_duration
 
+def prefix_key(column):
+    """
+    Normalized prefix of `column` used for typeahead matching. It uses the
+    "C" collation, so an index on the key serves both the LIKE prefix match
+    and the ordering of the matches.
+    """
+    return collate(func.lower(func.left(column, 128)), 'C')
+
+# notations of doi values that are stripped when normalizing
+DOI_PREFIXES = ('https://doi.org/',
+                'http://doi.org/',
+                'https://dx.doi.org/',
+                'http://dx.doi.org/',
+                'doi:')
+
+def normalize_identifier(type, value):
+    """
+    Return the normalized form of the identifier `value` of `type`, which is
+    stored with the identifier and used to match identifiers regardless of
+    their notation.
+    """
+    value = value.strip()
+    if type == 'doi':
+        # dois are case insensitive
+        value = value.lower()
+        for prefix in DOI_PREFIXES:
+            if value.startswith(prefix):
+                value = value[len(prefix):]
+                break
+    elif type in ('isbn', 'issn', 'essn'):
+        value = value.replace('-', '').replace(' ', '').upper()
+    return value
+
 class WorkType(Base):
     __tablename__ = 'work_type_schemes'
     key = Column(Unicode(32), primary_key=True)
@@ -67,16 +102,28 @@ class Relation(Base):
 
 
     __tablename__ = 'relations'
+    # the relations of a work are followed in both directions, these
+    # indexes also serve lookups on work_id and target_id alone
+    __table_args__ = (Index('ix_relations_during',
+                            'during',
+                            postgresql_using='gist'),
+                      Index('ix_relations_work_id_type',
+                            'work_id',
+                            'type',
+                            'target_id'),
+                      Index('ix_relations_target_id_type',
+                            'target_id',
+                            'type',
+                            'work_id'))
+
     id = Column(Integer, Sequence('relations_id_seq'), primary_key=True)
     work_id = Column(BigInteger,
-                     ForeignKey('works.id'),
-                     index=True)
+                     ForeignKey('works.id'))
     work = relationship('Work',
                         foreign_keys=[work_id],
                         back_populates='relations')
     target_id = Column(BigInteger,
                        ForeignKey('works.id'),
-                       index=True,
                        nullable=False)
     target = relationship('Work',
                           foreign_keys=[target_id])
@@ -208,7 +255,21 @@ class Work(Base):
     __tablename__ = 'works'
     __table_args__ = (Index('ix_works_search_terms',
                             'search_terms',
-                            postgresql_using='gin'),)
+                            postgresql_using='gin'),
+                      Index('ix_works_title_trgm',
+                            'title',
+                            postgresql_using='gin',
+                            postgresql_ops={'title': 'gin_trgm_ops'},
+                            info={'extension': 'pg_trgm'}),
+                      Index('ix_works_during',
+                            'during',
+                            postgresql_using='gist'),
+                      # equality on type in a gist index needs btree_gist
+                      Index('ix_works_type_during',
+                            'type',
+                            'during',
+                            postgresql_using='gist',
+                            info={'extension': 'btree_gist'}))
 
     id = Column(BigInteger, Sequence('works_id_seq'), primary_key=True)
     type = Column(Unicode(32),
@@ -349,9 +410,11 @@ class Work(Base):
                     self.identifiers.remove(value)
             for new_value in new_values:
                 type, value = new_value
-                self.identifiers.append(Identifier(type=type,
-                                                   value=value,
-                                                   work_id=data.get('id')))
+                self.identifiers.append(Identifier(
+                    type=type,
+                    value=value,
+                    normalized_value=normalize_identifier(type, value),
+                    work_id=data.get('id')))
         if 'measures' in data:
             new_values = set([(a['type'], a['value'])
                               for a in data.pop('measures', [])])
@@ -436,12 +499,33 @@ class Work(Base):
         work.update_dict(data)
         return work
 
+Index('ix_works_title_prefix', prefix_key(Work.title), Work.id)
+
+class WorkSnippet(Base):
+    "Listing snippet of a work, maintained by `caleido.snippets`"
+    __tablename__ = 'work_snippets'
+
+    work_id = Column(BigInteger,
+                     ForeignKey('works.id', ondelete='CASCADE'),
+                     primary_key=True)
+    snippet = Column(JSON, nullable=False)
+
 
 class Person(Base):
     __tablename__ = 'persons'
     __table_args__ = (Index('ix_persons_search_terms',
                             'search_terms',
-                            postgresql_using='gin'),)
+                            postgresql_using='gin'),
+                      Index('ix_persons_name_trgm',
+                            'name',
+                            postgresql_using='gin',
+                            postgresql_ops={'name': 'gin_trgm_ops'},
+                            info={'extension': 'pg_trgm'}),
+                      Index('ix_persons_family_name_trgm',
+                            'family_name',
+                            postgresql_using='gin',
+                            postgresql_ops={'family_name': 'gin_trgm_ops'},
+                            info={'extension': 'pg_trgm'}))
     id = Column(BigInteger, Sequence('person_id_seq'), primary_key=True)
     name = Column(Unicode(128), nullable=False)
     family_name = Column(Unicode(128))
@@ -568,6 +652,8 @@ class Person(Base):
         person.update_dict(data)
         return person
 
+Index('ix_persons_name_prefix', prefix_key(Person.name), Person.id)
+
 
 class IdentifierType(Base):
     __tablename__ = 'identifier_type_schemes'
@@ -576,8 +662,9 @@ class IdentifierType(Base):
 
 class Identifier(Base):
     __tablename__ = 'identifiers'
-    #__table_args__ = (
-    #    UniqueConstraint('type', 'value'),)
+    __table_args__ = (Index('ix_identifiers_type_normalized_value',
+                            'type',
+                            'normalized_value'),)
 
 
     id = Column(Integer, Sequence('identifiers_id_seq'), primary_key=True)
@@ -590,6 +677,9 @@ class Identifier(Base):
                   ForeignKey('identifier_type_schemes.key'),
                   nullable=False)
     value = Column(Unicode(1024), nullable=False)
+    # see `normalize_identifier`, identifiers stored before the value was
+    # maintained are filled by the normalize_identifiers script
+    normalized_value = Column(Unicode(1024), nullable=True)
 
 class ConceptType(Base):
     __tablename__ = 'concept_type_schemes'
@@ -779,7 +869,15 @@ class Group(Base):
     __tablename__ = 'groups'
     __table_args__ = (Index('ix_groups_search_terms',
                             'search_terms',
-                            postgresql_using='gin'),)
+                            postgresql_using='gin'),
+                      Index('ix_groups_name_trgm',
+                            'name',
+                            postgresql_using='gin',
+                            postgresql_ops={'name': 'gin_trgm_ops'},
+                            info={'extension': 'pg_trgm'}),
+                      Index('ix_groups_during',
+                            'during',
+                            postgresql_using='gist'))
 
 
     id = Column(BigInteger, Sequence('group_id_seq'), primary_key=True)
@@ -869,6 +967,27 @@ class Group(Base):
         group.update_dict(data)
         return group
 
+Index('ix_groups_name_prefix', prefix_key(Group.name), Group.id)
+
+class GroupClosure(Base):
+    """
+    Ancestor and descendant pairs of the group hierarchy, including the
+    pair of every group with itself at depth 0. Maintained by
+    `caleido.closure`.
+    """
+    __tablename__ = 'group_closure'
+    __table_args__ = (Index('ix_group_closure_descendant_id',
+                            'descendant_id',
+                            'depth'),)
+
+    ancestor_id = Column(BigInteger,
+                         ForeignKey('groups.id', ondelete='CASCADE'),
+                         primary_key=True)
+    descendant_id = Column(BigInteger,
+                           ForeignKey('groups.id', ondelete='CASCADE'),
+                           primary_key=True)
+    depth = Column(Integer, nullable=False)
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -974,6 +1093,15 @@ class Owner(Base):
 
 class Membership(Base):
     __tablename__ = 'memberships'
+    __table_args__ = (Index('ix_memberships_during',
+                            'during',
+                            postgresql_using='gist'),
+                      Index('ix_memberships_group_id_during',
+                            'group_id',
+                            'during',
+                            postgresql_using='gist',
+                            info={'extension': 'btree_gist'}))
+
     id = Column(Integer, Sequence('memberships_id_seq'), primary_key=True)
     person_id = Column(BigInteger,
                        ForeignKey('persons.id'),
@@ -1022,6 +1150,15 @@ class Membership(Base):
 
 class Position(Base):
     __tablename__ = 'positions'
+    __table_args__ = (Index('ix_positions_during',
+                            'during',
+                            postgresql_using='gist'),
+                      Index('ix_positions_group_id_during',
+                            'group_id',
+                            'during',
+                            postgresql_using='gist',
+                            info={'extension': 'btree_gist'}))
+
     id = Column(Integer, Sequence('positions_id_seq'), primary_key=True)
     type = Column(Unicode(32),
                   ForeignKey('position_type_schemes.key'),
@@ -1084,6 +1221,9 @@ class Contributor(Base):
     __tablename__ = 'contributors'
     __table_args__ = (
         CheckConstraint('NOT(person_id IS NULL AND group_id IS NULL)'),
+        Index('ix_contributors_during',
+              'during',
+              postgresql_using='gist'),
         )
     id = Column(Integer, Sequence('contributors_id_seq'), primary_key=True)
     role = Column(Unicode(32),
@@ -1207,10 +1347,15 @@ class Affiliation(Base):
 
 class Repository(Base):
     __tablename__ = 'repositories'
+    # the repositories catalog is shared by all namespaces
+    __table_args__ = {'schema': 'public'}
     namespace = Column(Unicode(32), primary_key=True)
     vhost_name = Column(Unicode(128), nullable=False, unique=True)
     config_revision = Column(Integer, nullable=False)
     schema_version = Column(Unicode(32), nullable=False)
+    # name of the database (sqlalchemy.shard.<placement>) storing the
+    # repository schema, NULL for the main database
+    placement = Column(Unicode(64), nullable=True)
     settings = Column(JSON)
 
     __mapper_args__ = {
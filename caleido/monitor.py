@@ -0,0 +1,215 @@
+import math
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+from caleido.exceptions import QueryBudgetExceeded, StatementTimeout
+
+# upper bounds of the checkout latency histogram buckets in milliseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class PoolMonitor(object):
+    """
+    Collects connection pool statistics of an engine.
+
+    The time spent waiting for a connection is recorded by the
+    MonitoredQueuePool, checkins and checkouts are tracked with pool events.
+    Connection usage per namespace is recorded by sessions created with
+    `caleido.storage.Storage.make_session` through `tenant_checkout`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pool = None
+        self.checkouts = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.namespaces = {}
+
+    def instrument(self, engine):
+        "Start monitoring the connection pool of `engine`"
+        self.pool = engine.pool
+        self.pool.monitor = self
+        event.listen(self.pool, 'checkin', self.on_checkin)
+
+    def record_checkout(self, duration):
+        milliseconds = duration * 1000.0
+        bucket = len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if milliseconds <= bound:
+                bucket = index
+                break
+        with self._lock:
+            self.checkouts += 1
+            self.latency_buckets[bucket] += 1
+            self.latency_total += milliseconds
+            self.latency_max = max(self.latency_max, milliseconds)
+
+    def tenant_checkout(self, namespace, connection_record_info):
+        "Mark a checked out connection as used by `namespace`"
+        if connection_record_info.get('caleido.namespace') == namespace:
+            return
+        connection_record_info['caleido.namespace'] = namespace
+        with self._lock:
+            usage = self.namespaces.setdefault(namespace,
+                                               {'in_use': 0, 'checkouts': 0})
+            usage['in_use'] += 1
+            usage['checkouts'] += 1
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        namespace = connection_record.info.pop('caleido.namespace', None)
+        if namespace is None:
+            return
+        with self._lock:
+            usage = self.namespaces.get(namespace)
+            if usage:
+                usage['in_use'] = max(usage['in_use'] - 1, 0)
+
+    def status(self, namespace=None):
+        """
+        Pool statistics, the usage per namespace is limited to `namespace`
+        when given, so tenants can not see each other's usage.
+        """
+        with self._lock:
+            histogram = []
+            for index, count in enumerate(self.latency_buckets):
+                if index < len(LATENCY_BUCKETS):
+                    bound = LATENCY_BUCKETS[index]
+                else:
+                    bound = None
+                histogram.append({'le': bound, 'count': count})
+            result = {'checkouts': self.checkouts,
+                      'checkout_ms': {
+                          'total': round(self.latency_total, 3),
+                          'max': round(self.latency_max, 3),
+                          'histogram': histogram},
+                      'namespaces': dict(
+                          (name, dict(usage))
+                          for name, usage in self.namespaces.items()
+                          if namespace is None or name == namespace)}
+        pool = self.pool
+        if pool is not None and isinstance(pool, QueuePool):
+            result.update({'size': pool.size(),
+                           'checked_in': pool.checkedin(),
+                           'checked_out': pool.checkedout(),
+                           'overflow': max(pool.overflow(), 0),
+                           'max_overflow': pool._max_overflow,
+                           'timeout': pool._timeout})
+        return result
+
+
+def pool_has_capacity(pool):
+    "Return True if `pool` can hand out a connection without waiting"
+    if not isinstance(pool, QueuePool):
+        return True
+    return (pool.checkedin() > 0 or
+            pool._max_overflow < 0 or
+            pool.overflow() < pool._max_overflow)
+
+
+class MonitoredQueuePool(QueuePool):
+    """
+    QueuePool that reports the time spent waiting for a connection to the
+    PoolMonitor set on the `monitor` attribute.
+    """
+    monitor = None
+
+    def _do_get(self):
+        if self.monitor is None:
+            return super(MonitoredQueuePool, self)._do_get()
+        start = time.monotonic()
+        try:
+            return super(MonitoredQueuePool, self)._do_get()
+        finally:
+            self.monitor.record_checkout(time.monotonic() - start)
+
+    def recreate(self):
+        pool = super(MonitoredQueuePool, self).recreate()
+        pool.monitor = self.monitor
+        if self.monitor is not None:
+            self.monitor.pool = pool
+        return pool
+
+
+class QueryBudget(object):
+    """
+    Limits the number of queries and the database time of a request.
+
+    The budget is attached to the connections used by the session of the
+    request, see `caleido.storage.Storage.make_session`, and is checked
+    before every statement by listeners installed with `instrument_queries`.
+    These also lower the statement_timeout of the transaction to the time
+    left in the budget when that drops below half of the timeout in effect,
+    so a single statement can not overrun the budget by much.
+    `max_time` is in milliseconds, a limit of 0 or None means unlimited.
+    """
+
+    def __init__(self, max_queries=None, max_time=None):
+        self.max_queries = max_queries or None
+        self.max_time = max_time or None
+        self.queries = 0
+        self.time = 0.0
+
+    def check(self):
+        if self.max_queries and self.queries >= self.max_queries:
+            raise QueryBudgetExceeded(
+                'Request exceeded the budget of %s queries' % (
+                    self.max_queries))
+        if self.max_time and self.time >= self.max_time:
+            raise QueryBudgetExceeded(
+                'Request exceeded the budget of %s ms database time' % (
+                    self.max_time))
+
+    def remaining_time(self):
+        "Return the database time left in milliseconds, or None if unlimited"
+        if not self.max_time:
+            return None
+        return max(int(math.ceil(self.max_time - self.time)), 1)
+
+    def record(self, duration):
+        self.queries += 1
+        self.time += duration * 1000.0
+
+
+def before_cursor_execute(connection, cursor, statement, parameters,
+                          context, executemany):
+    budget = connection.info.get('caleido.budget')
+    if budget is not None:
+        budget.check()
+        remaining = budget.remaining_time()
+        # the timeout set in the current transaction, 0 means none. It is
+        # only lowered once the budget left is well below it, so most
+        # statements cost no additional round trip
+        timeout = connection.info.get('caleido.statement_timeout')
+        if remaining is not None and (not timeout or
+                                      remaining < timeout / 2):
+            cursor.execute('SET LOCAL statement_timeout = %d' % remaining)
+            connection.info['caleido.statement_timeout'] = remaining
+        connection.info['caleido.query_start'] = time.monotonic()
+
+def after_cursor_execute(connection, cursor, statement, parameters,
+                         context, executemany):
+    start = connection.info.pop('caleido.query_start', None)
+    budget = connection.info.get('caleido.budget')
+    if budget is not None and start is not None:
+        budget.record(time.monotonic() - start)
+
+def handle_error(context):
+    if getattr(context.original_exception, 'pgcode', None) == '57014':
+        # query_canceled, raised when the statement_timeout expires
+        raise StatementTimeout(str(context.original_exception).strip())
+
+def clear_query_budget(dbapi_connection, connection_record):
+    connection_record.info.pop('caleido.budget', None)
+    connection_record.info.pop('caleido.query_start', None)
+    connection_record.info.pop('caleido.statement_timeout', None)
+
+def instrument_queries(engine):
+    "Enforce query budgets and report statement timeouts on `engine`"
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
+    event.listen(engine.pool, 'checkin', clear_query_budget)
@@ -3,12 +3,15 @@ from intervals import DateInterval
 from operator import itemgetter
 
 import sqlalchemy as sql
-from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPForbidden, HTTPBadRequest
 from pyramid.security import Allow, ALL_PERMISSIONS
 from pyramid.interfaces import IAuthorizationPolicy
 from sqlalchemy_utils.functions import get_primary_keys
-from sqlalchemy.orm import load_only, Load, aliased
+from sqlalchemy.orm import load_only, Load
 from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
 import sqlalchemy.exc
 import transaction
 
@@ -16,8 +19,13 @@ from caleido.models import (
     User, Person, Group, GroupType, GroupAccountType, PersonAccountType,
     Membership, Work, WorkType, Contributor, ContributorRole, Affiliation,
     IdentifierType, MeasureType, DescriptionType, DescriptionFormat, Blob,
-    RelationType, Relation, PositionType)
-from caleido.exceptions import StorageError
+    RelationType, Relation, PositionType, Identifier,
+    WorkSnippet, prefix_key, normalize_identifier)
+from caleido.exceptions import StorageError, InvalidCursor
+from caleido.closure import (
+    descendants_query, ancestors_query, would_create_cycle)
+from caleido.snippets import snippet_query
+from caleido.utils import encode_cursor, decode_cursor
 
 class ResourceFactory(object):
     def __init__(self, resource_class):
@@ -34,9 +42,123 @@ class ResourceFactory(object):
             raise HTTPForbidden()
         return resource
 
+def any_of(column, values):
+    """
+    Match `column` against a list of `values` with = ANY(:array). The
+    statement is the same for any number of values, and it can use an
+    index on the column.
+    """
+    return column == sql.any_(
+        sql.bindparam(None, list(values), type_=ARRAY(column.type)))
+
+def group_filter(column, group_ids, transitive=False, ancestors=False):
+    """
+    Match `column` against a list of `group_ids`. With `transitive`, the
+    subgroups of these groups are matched as well, with `ancestors` the
+    groups above them. Both are selected from the group closure table.
+    """
+    group_ids = list(group_ids)
+    if not transitive and not ancestors:
+        return any_of(column, group_ids)
+    filters = []
+    if transitive:
+        filters.append(
+            column.in_(descendants_query(group_ids, include_self=True)))
+    if ancestors:
+        filters.append(
+            column.in_(ancestors_query(group_ids, include_self=True)))
+    return sql.or_(*filters)
+
+def overlaps(column, start_date=None, end_date=None):
+    """
+    Match the date range `column` overlapping the period from `start_date`
+    to `end_date`, a missing date leaves that side of the period open. The
+    period is bound as a daterange, so the gist indexes on the during
+    columns can be used for the && operator.
+    """
+    duration = DateInterval([start_date, end_date])
+    return column.op('&&')(sql.cast(duration, column.type))
+
+def escape_like(text):
+    "Escape the LIKE wildcards in `text`, matched with a backslash escape"
+    return text.replace('\\', '\\\\').replace(
+        '%', '\\%').replace('_', '\\_')
+
+def contains_text(column, text):
+    """
+    Case insensitive substring match of `text` in `column`. The LIKE
+    wildcards in `text` are matched literally. Matches of 3 or more
+    characters can use the trigram indexes on the column.
+    """
+    return column.ilike('%' + escape_like(text) + '%', escape='\\')
+
+# facets available in the work listing, see `WorkResource.facets`
+WORK_FACETS = ('type', 'year', 'affiliation')
+
+class KeysetFilter(object):
+    """
+    Filters the rows following a cursor for keyset pagination.
+
+    All `order_by` clauses must sort in the same direction, the `tie_breaker`
+    column is sorted in that direction as well so the sort key is unique.
+    """
+
+    def __init__(self, order_by, tie_breaker):
+        self.expressions = []
+        directions = set()
+        for clause in order_by:
+            descending = False
+            if (isinstance(clause, UnaryExpression) and
+                clause.modifier in (operators.asc_op, operators.desc_op)):
+                descending = clause.modifier is operators.desc_op
+                clause = clause.element
+            directions.add(descending)
+            self.expressions.append(clause)
+        if len(directions) > 1:
+            raise ValueError(
+                'Keyset pagination requires a single sort direction')
+        self.descending = directions.pop() if directions else False
+        self.expressions.append(tie_breaker)
+        if self.descending:
+            self.order_by = tie_breaker.desc()
+        else:
+            self.order_by = tie_breaker.asc()
+
+    def convert(self, expression, value):
+        "Return the cursor `value` as the python type of `expression`"
+        try:
+            python_type = expression.type.python_type
+        except NotImplementedError:
+            return value
+        if python_type is datetime.date and isinstance(value, str):
+            try:
+                return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                raise InvalidCursor('Invalid cursor')
+        if isinstance(value, bool) or not isinstance(value, python_type):
+            raise InvalidCursor('Invalid cursor')
+        return value
+
+    def __call__(self, cursor):
+        try:
+            values = decode_cursor(cursor)
+        except (ValueError, TypeError):
+            raise InvalidCursor('Invalid cursor')
+        if len(values) != len(self.expressions):
+            raise InvalidCursor('Invalid cursor')
+        values = [self.convert(expression, value)
+                  for expression, value in zip(self.expressions, values)]
+        key = sql.tuple_(*self.expressions)
+        if self.descending:
+            return key < sql.tuple_(*values)
+        return key > sql.tuple_(*values)
+
+
 class BaseResource(object):
     orm_class = None
     key_col_name = None
+    # column matched by `typeahead`
+    label_col_name = None
 
 
     def __init__(self, registry, session, key=None, model=None):
@@ -100,7 +222,6 @@ class BaseResource(object):
     def pre_put_hook(self, model):
         return model
 
-
     def put(self, model=None, principals=None):
         if model is None:
             if self.model is None:
@@ -153,34 +274,45 @@ class BaseResource(object):
                from_query_joined_tables=None,
                post_query_callback=None,
                apply_limits_post_query=False,
-               keys_only=False):
+               keys_only=False,
+               cursor=None,
+               cursor_key=None,
+               total_mode='exact'):
+        """
+        Search the resources matching `filters` that are visible to
+        `principals`.
+
+        For keyset pagination, `cursor_key` is a function returning the
+        values of the `order_by` expressions for a hit. The primary key is
+        then added to the sort order, and the result contains a `cursor`
+        token for the next page, which is passed as `cursor` to continue
+        after the last hit instead of using an offset.
+
+        The `total_mode` selects how the total is computed, see
+        `caleido.storage.Storage.count`.
+        """
         query = from_query or self.session.query(self.orm_class)
 
         order_by = order_by or []
         if not isinstance(order_by, list):
             order_by = [order_by]
+        keyset_filter = None
+        if cursor_key is not None or cursor:
+            keyset_filter = self.keyset(order_by)
+            order_by = order_by + [keyset_filter.order_by]
 
         if filters:
             query = query.filter(sql.and_(*filters))
-        acl_filters = []
-        acl_joined_tables = [t.__table__.name for t in (from_query_joined_tables or []) ]
-        for filter in self.acl_filters(principals):
-            first_clause = filter
-            if not hasattr(first_clause, 'left'):
-                first_clause = filter.clauses[0]
-            if (first_clause.left.table.name != self.orm_class.__table__.name and
-                first_clause.left.table.name not in acl_joined_tables):
-                # acl requires filter on other table
-                query = query.join(first_clause.left.table)
-                acl_joined_tables.append(first_clause.left.table.name)
-            acl_filters.append(filter)
-
-        if acl_filters:
-            query = query.filter(sql.or_(*acl_filters))
-
+        query = self.apply_acl_filters(
+            query,
+            principals,
+            [t.__table__.name for t in (from_query_joined_tables or [])])
 
         if not apply_limits_post_query:
-            total = query.count()
+            total = self.count(query, total_mode)
+            if cursor:
+                query = query.filter(keyset_filter(cursor))
+                offset = 0
             query = query.order_by(*order_by)
             query = query.offset(offset)
             query = query.limit(limit)
@@ -188,15 +320,87 @@ class BaseResource(object):
             # useful for cte aggregations, etc
             query = post_query_callback(query)
             if apply_limits_post_query:
-                total = query.count()
+                total = self.count(query, total_mode)
+                if cursor:
+                    query = query.filter(keyset_filter(cursor))
+                    offset = 0
                 query = query.order_by(*order_by)
                 query = query.offset(offset)
                 query = query.limit(limit)
 
         if keys_only:
             query = query.options(load_only(self.key_col_name))
-        return {'total': total,
-                'hits': [h for h in query.all()]}
+        hits = [h for h in query.all()]
+        result = {'total': total(),
+                  'hits': hits}
+        if cursor_key is not None:
+            result['cursor'] = None
+            if hits and len(hits) == limit:
+                last_hit = hits[-1]
+                result['cursor'] = encode_cursor(
+                    list(cursor_key(last_hit)) +
+                    [getattr(last_hit, self.key_col_name)])
+        return result
+
+    def typeahead(self, text, principals, limit=10):
+        """
+        Return the (id, label) rows of at most `limit` resources visible to
+        `principals` whose label starts with `text`, ignoring case. The
+        prefix index on the label and the key serves the match and the
+        ordering, no total is counted.
+        """
+        label_col = getattr(self.orm_class, self.label_col_name)
+        key_col = getattr(self.orm_class, self.key_col_name)
+        key = prefix_key(label_col)
+        query = self.session.query(key_col, label_col).filter(
+            key.like(escape_like(text.lower()) + '%', escape='\\'))
+        if self.acl_filters(principals):
+            # filter on a subquery, so joined tables do not duplicate rows
+            visible = self.apply_acl_filters(self.session.query(key_col),
+                                             principals)
+            query = query.filter(key_col.in_(visible.subquery()))
+        return query.order_by(key, key_col).limit(limit).all()
+
+    def apply_acl_filters(self, query, principals, joined_tables=None):
+        """
+        Filter `query` on the resources visible to `principals`, joining
+        the tables the ACL filters are on unless they are listed in
+        `joined_tables`.
+        """
+        acl_filters = []
+        joined_tables = list(joined_tables or [])
+        for filter in self.acl_filters(principals):
+            first_clause = filter
+            if not hasattr(first_clause, 'left'):
+                first_clause = filter.clauses[0]
+            if (first_clause.left.table.name != self.orm_class.__table__.name and
+                first_clause.left.table.name not in joined_tables):
+                # acl requires filter on other table
+                query = query.join(first_clause.left.table)
+                joined_tables.append(first_clause.left.table.name)
+            acl_filters.append(filter)
+
+        if acl_filters:
+            query = query.filter(sql.or_(*acl_filters))
+        return query
+
+    def keyset(self, order_by):
+        """
+        Return a KeysetFilter for paginating over `order_by` with the
+        primary key as tie breaker.
+        """
+        return KeysetFilter(order_by,
+                            getattr(self.orm_class, self.key_col_name))
+
+    def count(self, query, mode='exact'):
+        """
+        Start counting the rows of `query`, returns a function returning
+        the total. See `caleido.storage.Storage.count`.
+        """
+        return self.registry['storage'].count(self.session,
+                                              query,
+                                              mapper=self.orm_class,
+                                              mode=mode)
 
     def is_permitted(self, model, principals, permission):
         policy = self.registry.queryUtility(IAuthorizationPolicy)
@@ -243,6 +447,7 @@ class UserResource(BaseResource):
 class PersonResource(BaseResource):
     orm_class = Person
     key_col_name = 'id'
+    label_col_name = 'name'
 
 
     def __acl__(self):
@@ -292,8 +497,7 @@ class PersonResource(BaseResource):
                 owner_group_ids.append(int(principal.split(':')[-1]))
 
         if owner_group_ids:
-            filters.append(sql.or_(*[Membership.group_id == i
-                                     for i in set(owner_group_ids)]))
+            filters.append(any_of(Membership.group_id, set(owner_group_ids)))
         if not filters:
             # match nothing
             filters.append(Person.id == -1)
@@ -302,6 +506,7 @@ class PersonResource(BaseResource):
 class GroupResource(BaseResource):
     orm_class = Group
     key_col_name = 'id'
+    label_col_name = 'name'
 
 
     def __acl__(self):
@@ -318,6 +523,11 @@ class GroupResource(BaseResource):
 
 
     def pre_put_hook(self, model):
+        if would_create_cycle(self.session, model.id, model.parent_id):
+            # discard the changes, they would be flushed on commit
+            self.session.expire(model)
+            raise StorageError(
+                'Group can not be a subgroup of itself', location='parent_id')
         model.name = model.international_name
         search_terms = [model.international_name]
 
@@ -340,8 +550,7 @@ class GroupResource(BaseResource):
                 owner_group_ids.append(int(principal.split(':')[-1]))
 
         if owner_group_ids:
-            filters.append(sql.or_(*[Group.id == i
-                                     for i in set(owner_group_ids)]))
+            filters.append(any_of(Group.id, set(owner_group_ids)))
 
         if not filters:
             # match nothing
@@ -349,33 +558,15 @@ class GroupResource(BaseResource):
         return filters
 
     def child_groups(self):
-        query = sql.text('''
-        WITH RECURSIVE rel_tree AS (
-          SELECT id,
-                 parent_id,
-                 1 AS level,
-                 ARRAY[id] AS path_info,
-                 false AS cyclic
-          FROM groups
-          WHERE parent_id = :group_id
-          UNION ALL
-          SELECT c.id,
-                 c.parent_id,
-                 p.level + 1,
-                 p.path_info||c.id,
-                 c.id = ANY(p.path_info) as cyclic
-          FROM groups c
-          JOIN rel_tree p ON c.parent_id = p.id AND NOT cyclic)
-        SELECT DISTINCT UNNEST(path_info) FROM rel_tree
-        ''')
-        return [row[0] for row in
-                self.session.execute(query,
-                                     dict(group_id=self.model.id)).fetchall()]
+        "Return the ids of all subgroups of the group"
+        query = descendants_query([self.model.id])
+        return [row[0] for row in self.session.execute(query).fetchall()]
 
 
 class WorkResource(BaseResource):
     orm_class = Work
     key_col_name = 'id'
+    label_col_name = 'title'
 
 
     def __acl__(self):
@@ -415,10 +606,163 @@ class WorkResource(BaseResource):
             filters.append(Contributor.id == -1)
         return filters
 
-    def pre_put_hook(self, model):
-        search_terms = [model.title]
-        model.search_terms = sql.func.to_tsvector(' '.join(search_terms))
-        return model
+    def allowed_work_ids(self, principals):
+        """
+        Return a cte of the ids of the works visible to `principals`, or
+        None if all works are visible.
+        """
+        acl_filters = self.acl_filters(principals)
+        if not acl_filters:
+            return None
+        group_filters = [f for f in acl_filters if f.left.table.name == 'affiliations']
+        person_filters = [f for f in acl_filters if f.left.table.name == 'contributors']
+        if group_filters:
+            query = self.session.query(Affiliation.work_id.label('id'))
+            query = query.filter(sql.or_(*group_filters))
+            query = query.group_by(Affiliation.work_id)
+            allowed_work_ids = query.cte('allowed_work_ids')
+            allowed_group_query = query
+        if person_filters:
+            query = self.session.query(Contributor.work_id.label('id'))
+            query = query.filter(sql.or_(*person_filters))
+            query = query.group_by(Contributor.work_id)
+            allowed_work_ids = query.cte('allowed_work_ids')
+            allowed_person_query = query
+        if group_filters and person_filters:
+            query = allowed_group_query.union(
+                allowed_person_query).group_by('id')
+            allowed_work_ids = query.cte('allowed_work_ids')
+        return allowed_work_ids
+
+    def resolve_identifiers(self, identifiers):
+        """
+        Return the ids of the works having the identifiers, a list of
+        (type, value) pairs. The result holds a sorted list of work ids for
+        every pair, in the order of `identifiers`.
+
+        The values are normalized and matched in a single query against
+        the index on the normalized identifiers, no ACL filters are applied.
+        """
+        keys = [(type, normalize_identifier(type, value))
+                for type, value in identifiers]
+        unique_keys = sorted(set(keys))
+        if not unique_keys:
+            return []
+        pairs = sql.select(
+            [func.unnest(sql.bindparam(
+                'types', [k[0] for k in unique_keys],
+                type_=ARRAY(Identifier.type.type))).label('type'),
+             func.unnest(sql.bindparam(
+                 'values', [k[1] for k in unique_keys],
+                 type_=ARRAY(Identifier.normalized_value.type))).label(
+                     'value')]).alias('pairs')
+        query = sql.select(
+            [Identifier.type,
+             Identifier.normalized_value,
+             Identifier.work_id]).select_from(
+                 Identifier.__table__.join(
+                     pairs,
+                     sql.and_(Identifier.type == pairs.c.type,
+                              Identifier.normalized_value == pairs.c.value))
+             ).distinct()
+        work_ids = {}
+        for type, value, work_id in self.session.execute(query):
+            work_ids.setdefault((type, value), []).append(work_id)
+        return [sorted(work_ids.get(key, [])) for key in keys]
+
+    def normalize_identifiers(self):
+        """
+        Fill the normalized values of the identifiers stored without one,
+        returns the number of updated identifiers.
+        """
+        identifiers = Identifier.__table__
+        rows = self.session.execute(sql.select(
+            [identifiers.c.id, identifiers.c.type, identifiers.c.value]).where(
+                identifiers.c.normalized_value.is_(None))).fetchall()
+        if rows:
+            self.session.execute(
+                identifiers.update().where(
+                    identifiers.c.id == sql.bindparam('_id')).values(
+                        normalized_value=sql.bindparam('_value')),
+                [{'_id': id, '_value': normalize_identifier(type, value)}
+                 for id, type, value in rows])
+        return len(rows)
+
+    def graph(self,
+              depth=1,
+              relation_types=None,
+              direction='both',
+              limit=100,
+              principals=None):
+        """
+        Return the works within `depth` relation hops of the work, as dicts
+        with the id, title and type of the work, the minimal number of hops
+        and the relations to the other returned works. Relations are
+        followed from work to target, from target to work, or both
+        depending on `direction`, and can be restricted to
+        `relation_types`. At most `limit` works are returned, nearest
+        first, starting with the work itself.
+
+        Relations are only followed to works visible to `principals`, so
+        the graph does not reveal works, or paths through works, that the
+        listing would not show.
+        """
+        relations = Relation.__table__
+        type_filters = []
+        if relation_types:
+            type_filters.append(any_of(relations.c.type, relation_types))
+        steps = []
+        if direction in ('both', 'outgoing'):
+            steps.append(sql.select(
+                [relations.c.work_id.label('source'),
+                 relations.c.target_id.label('target')]).where(
+                     sql.and_(*type_filters)))
+        if direction in ('both', 'incoming'):
+            steps.append(sql.select(
+                [relations.c.target_id.label('source'),
+                 relations.c.work_id.label('target')]).where(
+                     sql.and_(*type_filters)))
+        # the union all is planned as an append of index scans on the
+        # (work_id, type) and (target_id, type) indexes
+        steps = sql.union_all(*steps).alias('steps')
+        reached = sql.select(
+            [sql.cast(sql.bindparam('work_id', self.model.id),
+                      sql.BigInteger).label('id'),
+             sql.literal(0).label('depth')]).cte('reached', recursive=True)
+        step_filters = [steps.c.source == reached.c.id,
+                        reached.c.depth < depth]
+        allowed_work_ids = self.allowed_work_ids(principals)
+        if allowed_work_ids is not None:
+            step_filters.append(steps.c.target.in_(
+                sql.select([allowed_work_ids.c.id])))
+        reached = reached.union(sql.select(
+            [steps.c.target, reached.c.depth + 1]).where(
+                sql.and_(*step_filters)))
+        nodes = sql.select(
+            [reached.c.id, func.min(reached.c.depth).label('depth')]
+            ).group_by(reached.c.id).order_by(
+                func.min(reached.c.depth), reached.c.id).limit(
+                    limit).cte('nodes')
+        targets = nodes.alias('targets')
+        edges = sql.select([func.json_agg(aggregate_order_by(
+            func.json_build_object('type', relations.c.type,
+                                   'target_id', relations.c.target_id),
+            relations.c.position))]).where(
+                sql.and_(relations.c.work_id == nodes.c.id,
+                         relations.c.target_id.in_(
+                             sql.select([targets.c.id])),
+                         *type_filters))
+        query = sql.select(
+            [nodes.c.id,
+             nodes.c.depth,
+             Work.title,
+             Work.type,
+             func.coalesce(edges.as_scalar(),
+                           sql.literal_column("'[]'::json")).label(
+                               'relations')]).select_from(
+                nodes.join(Work.__table__, Work.id == nodes.c.id)
+            ).order_by(nodes.c.depth, nodes.c.id)
+        return [dict(row) for row in self.session.execute(query)]
 
     def listing(self,
                 text_query=None,
@@ -428,160 +772,212 @@ class WorkResource(BaseResource):
                 contributor_person_ids=None,
                 contributor_group_ids=None,
                 affiliation_group_ids=None,
+                affiliation_ancestors=False,
                 related_work_ids=None,
                 offset=0,
                 limit=100,
                 order_by=None,
-                principals=None):
+                principals=None,
+                cursor=None,
+                total_mode='exact',
+                facets=None,
+                facet_size=10):
+        """
+        List the works matching the filters that are visible to
+        `principals`. If `facets` are given, the result contains the
+        buckets of these WORK_FACETS for all matching works.
 
-        selected_work_ids = None
-        if contributor_person_ids:
-            query = self.session.query(Contributor.work_id.label('id'))
-            query = query.filter(sql.or_(*[Contributor.person_id == pid
-                                           for pid in contributor_person_ids]))
-            query = query.group_by(Contributor.work_id)
-            selected_work_ids = query.cte('selected_work_ids')
-        elif contributor_group_ids:
-            query = self.session.query(Contributor.work_id.label('id'))
-            query = query.filter(sql.or_(*[Contributor.group_id == gid
-                                           for gid in contributor_group_ids]))
-            query = query.group_by(Contributor.work_id)
-            selected_work_ids = query.cte('selected_work_ids')
-        elif affiliation_group_ids:
-            query = self.session.query(Affiliation.work_id.label('id'))
-            query = query.filter(sql.or_(*[Affiliation.group_id == gid
-                                           for gid in affiliation_group_ids]))
-            query = query.group_by(Affiliation.work_id)
-            selected_work_ids = query.cte('selected_work_ids')
-        elif related_work_ids:
-            query = self.session.query(Relation.work_id.label('id'))
-            query = query.filter(sql.or_(*[Relation.target_id == wid
-                                           for wid in related_work_ids]))
-            query = query.group_by(Relation.work_id)
-            selected_work_ids = query.cte('selected_work_ids')
+        Works affiliated with subgroups of `affiliation_group_ids` match
+        as well, and with `affiliation_ancestors` also works affiliated
+        with the groups above them.
+        """
+
+        # keyset pagination is supported for the default sort order
+        keyset_filter = None
+        if order_by is None:
+            keyset_filter = self.keyset([Work.issued.desc()])
+        elif cursor:
+            raise HTTPBadRequest('A cursor requires the default sort order')
 
         work_query = self.session.query(Work.id)
-        if selected_work_ids is not None:
+        # all selectors are combined, a work matches a selector if it
+        # matches any of its ids
+        selectors = [
+            ('contributor_person', Contributor.work_id,
+             any_of, Contributor.person_id, contributor_person_ids),
+            ('contributor_group', Contributor.work_id,
+             any_of, Contributor.group_id, contributor_group_ids),
+            ('affiliation_group', Affiliation.work_id,
+             lambda col, ids: group_filter(
+                 col, ids, transitive=True, ancestors=affiliation_ancestors),
+             Affiliation.group_id, affiliation_group_ids),
+            ('related_work', Relation.work_id,
+             any_of, Relation.target_id, related_work_ids)]
+        for name, work_id_col, match, id_col, ids in selectors:
+            if not ids:
+                continue
+            query = self.session.query(work_id_col.label('id'))
+            query = query.filter(match(id_col, ids))
+            query = query.group_by(work_id_col)
+            selected_work_ids = query.cte('%s_work_ids' % name)
             work_query = work_query.join(
                 selected_work_ids, selected_work_ids.c.id == Work.id)
 
-        acl_filters = self.acl_filters(principals)
-        if acl_filters:
-            group_filters = [f for f in acl_filters if f.left.table.name == 'affiliations']
-            person_filters = [f for f in acl_filters if f.left.table.name == 'contributors']
-            if group_filters:
-                query = self.session.query(Affiliation.work_id.label('id'))
-                query = query.filter(sql.or_(*group_filters))
-                query = query.group_by(Affiliation.work_id)
-                allowed_work_ids = query.cte('allowed_work_ids')
-                allowed_group_query = query
-            if person_filters:
-                query = self.session.query(Contributor.work_id.label('id'))
-                query = query.filter(sql.or_(*person_filters))
-                query = query.group_by(Contributor.work_id)
-                allowed_work_ids = query.cte('allowed_work_ids')
-                allowed_person_query = query
-            if group_filters and person_filters:
-                query = allowed_group_query.union(
-                    allowed_person_query).group_by('id')
-                allowed_work_ids = query.cte('allowed_work_ids')
-
+        allowed_work_ids = self.allowed_work_ids(principals)
+        if allowed_work_ids is not None:
             work_query = work_query.join(
                 allowed_work_ids, allowed_work_ids.c.id == Work.id)
 
         if start_date or end_date:
-            duration = DateInterval([start_date, end_date])
-            work_query = work_query.filter(Work.during.op('&&')(duration))
+            work_query = work_query.filter(
+                overlaps(Work.during, start_date, end_date))
         if text_query:
             work_query = work_query.filter(
-                Work.title.ilike('%%%s%%' % text_query))
+                contains_text(Work.title, text_query))
         if type:
             work_query = work_query.filter(Work.type == type)
 
-        total = work_query.count()
-
-        work_query = work_query.order_by(order_by or Work.issued.desc())
+        total = self.count(work_query, total_mode)
+        facet_statements = []
+        if facets:
+            # the page and the facets are selected from the matching works
+            # in a single statement
+            matched_works = work_query.cte('matched_works')
+            facet_statements = self.facet_statements(
+                matched_works, facets, facet_size)
+            work_query = self.session.query(Work.id).join(
+                matched_works, matched_works.c.id == Work.id)
+
+        if keyset_filter is None:
+            work_query = work_query.order_by(order_by)
+        else:
+            if cursor:
+                work_query = work_query.filter(keyset_filter(cursor))
+                offset = 0
+            work_query = work_query.order_by(Work.issued.desc(),
+                                             keyset_filter.order_by)
         work_query = work_query.limit(limit).offset(offset)
 
         filtered_work_ids = work_query.cte('filtered_work_ids')
-
-        listed_works = self.session.query(
-            Work.id.label('id'),
-            Work.type.label('type'),
-            Work.issued.label('issued'),
-            Work.title).join(filtered_work_ids,
-                             filtered_work_ids.c.id == Work.id).cte('listed_works')
-        Target = aliased(Work)
-
-        full_listing = self.session.query(
-            listed_works,
-            func.json_agg(func.json_build_object('id', Contributor.id,
-                                                 'position', Contributor.position,
-                                                 'name', Person.name,
-                                                 'person_id', Person.id,
-                                                 'initials', Person.initials,
-                                                 'prefix', Person.family_name_prefix,
-                                                 'given_name', Person.given_name,
-                                                 'family_name', Person.family_name,
-                                                 'role', Contributor.role)
-                          ).label('contributors'),
-            func.json_agg(func.json_build_object('id', Relation.id,
-                                                 'relation_type', Relation.type,
-                                                 'type', Target.type,
-                                                 'location', Relation.location,
-                                                 'starting', Relation.starting,
-                                                 'ending', Relation.ending,
-                                                 'volume', Relation.volume,
-                                                 'issue', Relation.issue,
-                                                 'number', Relation.number,
-                                                 'title', Target.title,
-                                                 )
-                          ).label('relations'),
-            func.array_agg(
-              sql.distinct(func.concat(Group.id, ':', Group.name))).label('affiliations')
-            )
-
-        full_listing = full_listing.outerjoin(
-            Contributor, listed_works.c.id == Contributor.work_id).outerjoin(
-              Person, Person.id == Contributor.person_id)
-        full_listing = full_listing.outerjoin(
-            Affiliation, Contributor.id == Affiliation.contributor_id).outerjoin(
-              Group, Group.id == Affiliation.group_id)
-        full_listing = full_listing.outerjoin(
-            Relation, listed_works.c.id == Relation.work_id).outerjoin(
-              Target, Target.id == Relation.target_id)
-
-        full_listing = full_listing.group_by(listed_works).order_by(
-            listed_works.c.issued.desc())
+        columns = [filtered_work_ids.c.id, WorkSnippet.snippet]
+        if facet_statements:
+            columns.extend(
+                sql.cast(sql.null(), type).label(label) for label, type in [
+                    ('facet', sql.UnicodeText),
+                    ('value', sql.UnicodeText),
+                    ('name', sql.UnicodeText),
+                    ('count', sql.BigInteger),
+                    ('position', sql.BigInteger)])
+        page = sql.select(columns).select_from(
+            filtered_work_ids.outerjoin(
+                WorkSnippet,
+                WorkSnippet.work_id == filtered_work_ids.c.id))
+        facet_buckets = None
+        if facet_statements:
+            rows = self.session.execute(
+                sql.union_all(page, *facet_statements)).fetchall()
+            facet_buckets = self.facet_buckets(
+                facets, [row for row in rows if row.facet is not None])
+            rows = [(row.id, row.snippet) for row in rows
+                    if row.facet is None]
+        else:
+            rows = self.session.execute(page).fetchall()
+        snippets = dict(rows)
+        missing = [id for id, snippet in rows if snippet is None]
+        if missing:
+            # works stored before snippets were maintained
+            snippets.update(
+                self.session.execute(snippet_query(missing)).fetchall())
 
         hits = []
+        next_cursor = None
         contributor_role_ids = set(contributor_person_ids or [])
-        for hit in full_listing.all():
-            contributors = []
-            roles = set()
-            hit.contributors.sort(key=itemgetter('position'))
-            for contributor in hit.contributors:
-                if contributor['person_id'] in contributor_role_ids:
-                    roles.add(contributor['role'])
-                contributors.append(contributor)
-            affiliations = []
-            for affiliation in hit.affiliations:
-                id, name = affiliation.split(':', 1)
-                affiliations.append(dict(id=id, name=name))
-
-            hits.append({'id': hit.id,
-                         'title': hit.title,
-                         'type': hit.type,
-                         'roles': list(roles),
-                         'issued': hit.issued.strftime('%Y-%m-%d'),
-                         'relations': hit.relations,
-                         'affiliations': affiliations,
-                         'contributors': contributors})
-
-        return {'total': total,
-                'hits': hits,
-                'limit': limit,
-                'offset': offset}
+        for snippet in sorted(snippets.values(),
+                              key=itemgetter('issued', 'id'),
+                              reverse=True):
+            if keyset_filter is not None:
+                next_cursor = [snippet['issued'], snippet['id']]
+            hit = dict(snippet)
+            hit['roles'] = list(set(
+                contributor['role'] for contributor in hit['contributors']
+                if contributor['person_id'] in contributor_role_ids))
+            hits.append(hit)
+
+        if next_cursor is not None and len(hits) == limit:
+            next_cursor = encode_cursor(next_cursor)
+        else:
+            next_cursor = None
+        result = {'total': total(),
+                  'hits': hits,
+                  'limit': limit,
+                  'offset': offset,
+                  'cursor': next_cursor}
+        if facet_buckets is not None:
+            result['facets'] = facet_buckets
+        return result
+
+    def facet_statements(self, matched_works, facets, size=10):
+        """
+        Return the selects of the buckets of `facets` for the works in the
+        CTE `matched_works`, to be combined with the page of works in a
+        single statement. Buckets are sorted by count, year buckets by
+        year, at most `size` buckets are selected per facet.
+
+        The rows of all selects have the columns of a page of snippets,
+        which are null, followed by the facet, value, name, count and
+        position of the bucket.
+        """
+        works = Work.__table__.join(matched_works,
+                                    matched_works.c.id == Work.id)
+        count = func.count(sql.distinct(Work.id))
+        statements = []
+        for facet in facets:
+            if facet not in WORK_FACETS:
+                raise ValueError('Unknown facet "%s"' % facet)
+            name = sql.null()
+            source = works
+            if facet == 'type':
+                value = Work.type
+                order_by = [count.desc(), value]
+            elif facet == 'year':
+                value = sql.cast(func.date_part('year', Work.issued),
+                                 sql.Integer)
+                order_by = [value.desc()]
+            elif facet == 'affiliation':
+                value = Group.id
+                name = Group.name
+                order_by = [count.desc(), name]
+                source = works.join(
+                    Affiliation, Affiliation.work_id == Work.id).join(
+                        Group, Group.id == Affiliation.group_id)
+            buckets = sql.select([
+                sql.cast(sql.null(), sql.BigInteger).label('id'),
+                sql.cast(sql.null(), WorkSnippet.snippet.type).label(
+                    'snippet'),
+                sql.cast(sql.literal(facet), sql.UnicodeText).label('facet'),
+                sql.cast(value, sql.UnicodeText).label('value'),
+                sql.cast(name, sql.UnicodeText).label('name'),
+                count.label('count'),
+                func.row_number().over(order_by=order_by).label('position')
+                ]).select_from(source)
+            if facet == 'affiliation':
+                buckets = buckets.group_by(value, name)
+            else:
+                buckets = buckets.group_by(value)
+            statements.append(buckets.order_by(*order_by).limit(size))
+        return statements
+
+    def facet_buckets(self, facets, rows):
+        "Return the buckets of `facets` from the rows of `facet_statements`"
+        result = dict((facet, []) for facet in facets)
+        for row in sorted(rows, key=lambda row: row.position):
+            bucket = {'value': row.value, 'count': row.count}
+            if row.facet in ('year', 'affiliation'):
+                bucket['value'] = int(row.value)
+            if row.name is not None:
+                bucket['name'] = row.name
+            result[row.facet].append(bucket)
+        return result
 
 class MembershipResource(BaseResource):
     orm_class = Membership
@@ -621,10 +1017,12 @@ class MembershipResource(BaseResource):
                 end_date=None,
                 person_ids=None,
                 group_ids=None,
+                ancestors=False,
                 offset=0,
                 limit=100,
                 order_by=None,
-                principals=None):
+                principals=None,
+                total_mode='exact'):
 
         query = self.session.query(
             Membership.person_id.label('person_id'),
@@ -642,19 +1040,21 @@ class MembershipResource(BaseResource):
                                                 Person.family_name)
 
         if person_ids:
-            query = query.filter(sql.or_(*[Membership.person_id == pid
-                                           for pid in person_ids]))
+            query = query.filter(any_of(Membership.person_id, person_ids))
         if group_ids:
-            query = query.filter(sql.or_(*[Membership.group_id == pid
-                                           for pid in group_ids]))
+            # memberships of subgroups count as memberships of the group
+            query = query.filter(group_filter(Membership.group_id,
+                                              group_ids,
+                                              transitive=True,
+                                              ancestors=ancestors))
         if start_date or end_date:
-            duration = DateInterval([start_date, end_date])
-            query = query.filter(Membership.during.op('&&')(duration))
+            query = query.filter(
+                overlaps(Membership.during, start_date, end_date))
         if text_query:
             query = query.filter(
-                Person.name.ilike('%%%s%%' % text_query))
+                contains_text(Person.name, text_query))
 
-        total = query.count()
+        total = self.count(query, total_mode)
 
         query = query.order_by(order_by or Person.family_name)
         query = query.limit(limit).offset(offset)
@@ -699,7 +1099,7 @@ class MembershipResource(BaseResource):
                          'works': hit.works,
                          'memberships': hit.memberships})
 
-        return {'total': total,
+        return {'total': total(),
                 'hits': hits,
                 'limit': limit,
                 'offset': offset}
@@ -827,6 +1227,16 @@ class TypeResource(object):
             listing.append(res.to_dict())
         return {'types': listing}
 
+class SystemResource(object):
+    "Context for system information that is not part of a repository"
+
+    def __acl__(self):
+        yield (Allow, 'group:admin', ALL_PERMISSIONS)
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.model = None
+
 class BlobResource(BaseResource):
     orm_class = Blob
     key_col_name = 'id'
@@ -0,0 +1,110 @@
+"""
+Search vectors of works.
+
+The search vector of a work is built from the work, its descriptions,
+the names of its contributors and its identifiers. It is stored in the
+search_terms column of the works table, and rebuilt by
+`refresh_search_terms` whenever a flush changes any of the data it is
+built from.
+"""
+import sqlalchemy as sql
+from sqlalchemy import func
+
+from caleido.models import (
+    Work, Description, Contributor, Identifier, Person, Group)
+
+# description types included with weight B in the work search vector
+WORK_SEARCH_DESCRIPTION_TYPES = ('abstract', 'keywords')
+
+def work_search_terms():
+    """
+    Return the weighted search vector of a work, correlated to the works
+    table: the title is weighted A, abstracts and keywords B, contributor
+    names C and identifiers D.
+    """
+    def weighted(text, weight, config=None):
+        text = func.coalesce(text, '')
+        if config is None:
+            vector = func.to_tsvector(text)
+        else:
+            vector = func.to_tsvector(config, text)
+        return func.setweight(vector, weight)
+
+    descriptions = sql.select(
+        [func.string_agg(Description.value, ' ')]).where(
+            sql.and_(Description.work_id == Work.id,
+                     Description.type.in_(WORK_SEARCH_DESCRIPTION_TYPES)))
+    contributors = sql.select(
+        [func.string_agg(func.coalesce(Person.name, Group.name), ' ')]
+        ).select_from(
+            Contributor.__table__.outerjoin(
+                Person.__table__, Person.id == Contributor.person_id
+            ).outerjoin(
+                Group.__table__, Group.id == Contributor.group_id)
+        ).where(Contributor.work_id == Work.id)
+    identifiers = sql.select(
+        [func.string_agg(Identifier.value, ' ')]).where(
+            Identifier.work_id == Work.id)
+    # identifiers are not stemmed
+    return (weighted(Work.title, 'A').op('||')(
+        weighted(descriptions.as_scalar(), 'B')).op('||')(
+        weighted(contributors.as_scalar(), 'C')).op('||')(
+        weighted(identifiers.as_scalar(), 'D', config='simple')))
+
+def update_work_search_terms(session, work_ids=None):
+    """
+    Rebuild the search vectors of the works with `work_ids`, which is a
+    list of ids or a select of ids. All works are updated if `work_ids`
+    is None, which is used to fill the vectors of existing works.
+    """
+    statement = Work.__table__.update().values(
+        search_terms=work_search_terms())
+    if work_ids is not None:
+        statement = statement.where(Work.id.in_(work_ids))
+    session.execute(statement)
+
+def changed_work_ids(session):
+    """
+    Return a select of the ids of the works whose search vector is changed
+    by the flush of `session`, or None if no vectors are changed. This uses
+    the pre flush state of the session, see `refresh_search_terms`.
+    """
+    work_ids = set()
+    queries = []
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, Work):
+            work_ids.add(instance.id)
+        elif instance in session.new:
+            continue
+        elif isinstance(instance, Person):
+            if sql.inspect(instance).attrs.name.history.has_changes():
+                queries.append(sql.select([Contributor.work_id]).where(
+                    Contributor.person_id == instance.id))
+        elif isinstance(instance, Group):
+            if sql.inspect(instance).attrs.name.history.has_changes():
+                queries.append(sql.select([Contributor.work_id]).where(
+                    Contributor.group_id == instance.id))
+    for instance in (list(session.new) + list(session.dirty) +
+                     list(session.deleted)):
+        if isinstance(instance, (Contributor, Description, Identifier)):
+            history = sql.inspect(instance).attrs.work_id.history
+            work_ids.update(history.sum())
+    work_ids.discard(None)
+    if work_ids:
+        queries.append(sql.select([Work.id]).where(Work.id.in_(work_ids)))
+    if not queries:
+        return None
+    if len(queries) == 1:
+        return queries[0]
+    return sql.union(*queries)
+
+def refresh_search_terms(session, flush_context):
+    """
+    Rebuild the search vectors changed by a flush, returns True if any
+    vectors were rebuilt.
+    """
+    work_ids = changed_work_ids(session)
+    if work_ids is None:
+        return False
+    update_work_search_terms(session, work_ids)
+    return True
@@ -1,5 +1,5 @@
 from caleido.models import User
-from caleido.resources import GroupResource
+from caleido.closure import descendants_query
 
 def add_role_principals(userid, request):
     return request.jwt_claims.get('principals') or []
@@ -38,10 +38,12 @@ class BasicAuthenticator(object):
                 principals.append('owner:person:%s' % owner.person_id)
             elif owner.group_id:
                 owner_group_ids.append(owner.group_id)
-                owner_group_ids.extend(
-                    GroupResource(self.registry,
-                                  self.session,
-                                  key=owner.group_id).child_groups())
-        for group_id in set(owner_group_ids):
+        owner_group_ids = set(owner_group_ids)
+        if owner_group_ids:
+            # owners of a group own all its subgroups
+            owner_group_ids.update(
+                row[0] for row in self.session.execute(descendants_query(
+                    owner_group_ids)).fetchall())
+        for group_id in sorted(owner_group_ids):
             principals.append('owner:group:%s' % group_id)
         return principals
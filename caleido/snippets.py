@@ -0,0 +1,150 @@
+"""
+Listing snippets of works.
+
+The snippet of a work holds the listing payload built from the work, its
+contributors, affiliations and relations. Snippets are stored in the
+work_snippets table of a repository, and rebuilt by `refresh_snippets`
+whenever a flush changes any of the data they are built from.
+"""
+import sqlalchemy as sql
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert
+
+from caleido.models import (
+    Work, WorkSnippet, Contributor, Person, Group, Affiliation, Relation)
+
+# attributes of referenced records that are part of the snippets
+SNIPPET_ATTRIBUTES = {Work: ('title', 'type', 'issued'),
+                      Person: ('name', 'initials', 'family_name_prefix',
+                               'given_name', 'family_name'),
+                      Group: ('name',)}
+
+def snippet_query(work_ids):
+    """
+    Return a select of the id and the snippet of the works with
+    `work_ids`, which is a list of ids or a select of ids.
+
+    Each child collection is aggregated in its own subquery, so the cost
+    grows with the number of children instead of their product.
+    """
+    Target = aliased(Work)
+    contributors = sql.select([func.json_agg(aggregate_order_by(
+        func.json_build_object('id', Contributor.id,
+                               'position', Contributor.position,
+                               'name', Person.name,
+                               'person_id', Person.id,
+                               'initials', Person.initials,
+                               'prefix', Person.family_name_prefix,
+                               'given_name', Person.given_name,
+                               'family_name', Person.family_name,
+                               'role', Contributor.role),
+        Contributor.position))]).select_from(
+            Contributor.__table__.outerjoin(
+                Person.__table__, Person.id == Contributor.person_id)
+        ).where(Contributor.work_id == Work.id)
+    relations = sql.select([func.json_agg(aggregate_order_by(
+        func.json_build_object('id', Relation.id,
+                               'relation_type', Relation.type,
+                               'type', Target.type,
+                               'location', Relation.location,
+                               'starting', Relation.starting,
+                               'ending', Relation.ending,
+                               'volume', Relation.volume,
+                               'issue', Relation.issue,
+                               'number', Relation.number,
+                               'title', Target.title),
+        Relation.position))]).select_from(
+            Relation.__table__.outerjoin(
+                Target, Target.id == Relation.target_id)
+        ).where(Relation.work_id == Work.id)
+    # jsonb has an equality operator, which distinct requires
+    affiliations = sql.select([func.jsonb_agg(sql.distinct(
+        func.jsonb_build_object('id', sql.cast(Group.id, sql.UnicodeText),
+                                'name', Group.name)))]).select_from(
+            Affiliation.__table__.join(
+                Contributor.__table__,
+                Contributor.id == Affiliation.contributor_id).join(
+                    Group.__table__, Group.id == Affiliation.group_id)
+        ).where(Contributor.work_id == Work.id)
+
+    snippet = func.json_build_object(
+        'id', Work.id,
+        'title', Work.title,
+        'type', Work.type,
+        'issued', Work.issued,
+        'contributors', func.coalesce(contributors.as_scalar(),
+                                      sql.literal_column("'[]'::json")),
+        'relations', func.coalesce(relations.as_scalar(),
+                                   sql.literal_column("'[]'::json")),
+        'affiliations', func.coalesce(affiliations.as_scalar(),
+                                      sql.literal_column("'[]'::jsonb")))
+    return sql.select([Work.id.label('work_id'),
+                       snippet.label('snippet')]).where(Work.id.in_(work_ids))
+
+def store_snippets(session, work_ids):
+    "Rebuild the stored snippets of the works with `work_ids`"
+    statement = insert(WorkSnippet.__table__).from_select(
+        ['work_id', 'snippet'], snippet_query(work_ids))
+    statement = statement.on_conflict_do_update(
+        index_elements=['work_id'],
+        set_={'snippet': statement.excluded.snippet})
+    session.execute(statement)
+
+def attributes_changed(instance, attributes):
+    state = sql.inspect(instance)
+    return any(state.attrs[name].history.has_changes()
+               for name in attributes)
+
+def changed_work_ids(session):
+    """
+    Return a select of the ids of the works whose snippet is changed by
+    the flush of `session`, or None if no snippets are changed. This uses
+    the pre flush state of the session, see `refresh_snippets`.
+    """
+    work_ids = set()
+    queries = []
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, Work):
+            work_ids.add(instance.id)
+            if (instance in session.dirty and
+                attributes_changed(instance, SNIPPET_ATTRIBUTES[Work])):
+                # the title and type of related works are part of snippets
+                queries.append(sql.select([Relation.work_id]).where(
+                    Relation.target_id == instance.id))
+        elif instance in session.new:
+            continue
+        elif isinstance(instance, Person):
+            if attributes_changed(instance, SNIPPET_ATTRIBUTES[Person]):
+                queries.append(sql.select([Contributor.work_id]).where(
+                    Contributor.person_id == instance.id))
+        elif isinstance(instance, Group):
+            if attributes_changed(instance, SNIPPET_ATTRIBUTES[Group]):
+                queries.append(sql.select([Contributor.work_id]).where(
+                    Contributor.group_id == instance.id))
+                queries.append(sql.select([Affiliation.work_id]).where(
+                    Affiliation.group_id == instance.id))
+    for instance in (list(session.new) + list(session.dirty) +
+                     list(session.deleted)):
+        if isinstance(instance, (Contributor, Affiliation, Relation)):
+            history = sql.inspect(instance).attrs.work_id.history
+            work_ids.update(history.sum())
+    work_ids.discard(None)
+    if work_ids:
+        queries.append(sql.select([Work.id]).where(Work.id.in_(work_ids)))
+    if not queries:
+        return None
+    if len(queries) == 1:
+        return queries[0]
+    return sql.union(*queries)
+
+def refresh_snippets(session, flush_context):
+    """
+    Rebuild the stored snippets changed by a flush, returns True if any
+    snippets were rebuilt.
+    """
+    work_ids = changed_work_ids(session)
+    if work_ids is None:
+        return False
+    store_snippets(session, work_ids)
+    return True
@@ -1,12 +1,32 @@
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+
 from pyramid.decorator import reify
-from sqlalchemy import engine_from_config
+from pyramid.interfaces import IRoutesMapper
+import sqlalchemy as sql
+from sqlalchemy import engine_from_config, event
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.schema import CreateSchema, DropSchema
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.schema import (CreateSchema,
+                               DropSchema,
+                               CreateSequence,
+                               CreateTable,
+                               CreateIndex)
 import zope.sqlalchemy
 import transaction
 
 from caleido.interfaces import IBlobStoreBackend
 from caleido.blob import BlobStore
+from caleido.monitor import (PoolMonitor,
+                             MonitoredQueuePool,
+                             pool_has_capacity,
+                             QueryBudget,
+                             instrument_queries)
 from caleido.models import (Base,
                             Repository,
                             User, UserGroup,
@@ -20,7 +40,13 @@ from caleido.models import (Base,
                             DescriptionType,
                             PositionType,
                             DescriptionFormat,
-                            GroupAccountType)
+                            GroupAccountType,
+                            WorkSnippet,
+                            GroupClosure,
+                            Work)
+from caleido.snippets import refresh_snippets
+from caleido.closure import refresh_group_closure
+from caleido.search import refresh_search_terms
 
 DEFAULTS = {
     'user_groups': {100: 'Admin',
@@ -66,10 +92,261 @@ DEFAULTS = {
                             'wikipedia': 'Wikipedia'},
     'repository_settings': {'title': 'Caleido'}}
 
+# scheme tables that are filled with DEFAULTS when a repository is created
+DEFAULT_SCHEMES = [('group_types', GroupType),
+                   ('person_account_types', PersonAccountType),
+                   ('group_account_types', GroupAccountType),
+                   ('work_types', WorkType),
+                   ('contributor_roles', ContributorRole),
+                   ('identifier_types', IdentifierType),
+                   ('relation_types', RelationType),
+                   ('description_types', DescriptionType),
+                   ('description_formats', DescriptionFormat),
+                   ('measure_types', MeasureType),
+                   ('position_types', PositionType)]
+
+# postgresql extensions used by tenant indexes, they are created when the
+# database offers them. Indexes marked with info={'extension': name} are
+# only created when the extension is installed, see `tenant_ddl`.
+EXTENSIONS = ('pg_trgm', 'btree_gist')
+
+# ways of computing the total of a listing, see Storage.count
+TOTAL_MODES = ('exact', 'estimated', 'none')
+
+# requests with these methods get a session on the replica engine, if any
+READONLY_METHODS = ('GET', 'HEAD')
+
+class Explain(Executable, ClauseElement):
+    "EXPLAIN statement returning the query plan of `statement` as JSON"
+
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) %s' % compiler.process(element.statement,
+                                                         **kw)
+
+
+class RepositoryCache(object):
+    """
+    Process local cache mapping vhost names to repository info.
+
+    Every request needs the namespace, config revision and settings of the
+    repository matching the Host header. Looking these up in the
+    repositories table costs a round trip per request, so the info is cached
+    here. Entries are invalidated when a repository is created, dropped or
+    updated in this process, and expire after `ttl` seconds so changes made
+    by other processes are picked up as well.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, vhost_name):
+        with self._lock:
+            entry = self._entries.get(vhost_name)
+            if entry is None:
+                return None
+            expires, info = entry
+            if expires < time.monotonic():
+                del self._entries[vhost_name]
+                return None
+            return dict(info)
+
+    def set(self, vhost_name, info):
+        with self._lock:
+            self._entries[vhost_name] = (time.monotonic() + self.ttl,
+                                         dict(info))
+
+    def invalidate(self, namespace=None):
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                return
+            for vhost_name, (expires, info) in list(self._entries.items()):
+                if info['namespace'] == namespace:
+                    del self._entries[vhost_name]
+
+
+class SchemeCache(object):
+    """
+    Process local LRU cache of the type scheme values of repositories.
+
+    Entries are keyed by namespace and config revision, and hold the values
+    of all scheme tables of a repository. The cache is shared by all worker
+    threads and holds at most `max_entries` repositories, evicting the least
+    recently used one when it is full.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, namespace, config_revision):
+        key = (namespace, config_revision)
+        with self._lock:
+            schemes = self._entries.get(key)
+            if schemes is not None:
+                self._entries.move_to_end(key)
+            return schemes
+
+    def set(self, namespace, config_revision, schemes):
+        key = (namespace, config_revision)
+        with self._lock:
+            self._entries[key] = schemes
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, namespace=None):
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                if key[0] == namespace:
+                    del self._entries[key]
+
+
+class CountCache(object):
+    """
+    Process local LRU cache of listing totals.
+
+    Entries are keyed by namespace and the compiled count statement, which
+    contains the listing filters and the ACL filters derived from the
+    principals of the user. Each entry records the tables the count was
+    computed from, and is invalidated when one of these tables is written
+    in the namespace. Entries expire after `ttl` seconds to pick up changes
+    made by other processes.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._generations = {}
+
+    def generation(self, namespace):
+        "Counter increased on every invalidation of `namespace`"
+        with self._lock:
+            return self._generations.get(namespace, 0)
+
+    def get(self, namespace, key):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            expires, total, tables = entry
+            if expires < time.monotonic():
+                del self._entries[(namespace, key)]
+                return None
+            self._entries.move_to_end((namespace, key))
+            return total
+
+    def set(self, namespace, key, total, tables, generation):
+        """
+        Store a `total`, unless `namespace` was invalidated after
+        `generation` was retrieved, while the count was running.
+        """
+        with self._lock:
+            if self._generations.get(namespace, 0) != generation:
+                return
+            self._entries[(namespace, key)] = (time.monotonic() + self.ttl,
+                                               total,
+                                               frozenset(tables))
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, namespace, tables=None):
+        "Remove the totals of `namespace` computed from any of `tables`"
+        with self._lock:
+            self._generations[namespace] = self._generations.get(
+                namespace, 0) + 1
+            for key, (expires, total, entry_tables) in list(
+                    self._entries.items()):
+                if key[0] != namespace:
+                    continue
+                if tables is None or entry_tables & tables:
+                    del self._entries[key]
+
+
 class Storage(object):
     schema_version = '0.1'
+    tenant_selection_modes = ('search_path', 'transaction', 'schema_translate')
+
     def __init__(self, registry):
         self.registry = registry
+        self.tenant_selection = (registry.settings or {}).get(
+            'caleido.tenant_selection', 'search_path')
+        if self.tenant_selection not in self.tenant_selection_modes:
+            raise ValueError(
+                'Unknown caleido.tenant_selection "%s", use one of: %s' % (
+                    self.tenant_selection,
+                    ', '.join(self.tenant_selection_modes)))
+        self._tenant_engines = {}
+        settings = registry.settings or {}
+        self.concurrent_count = settings.get(
+            'caleido.concurrent_count', 'false').lower() in ('true', '1', 'on')
+        # statement timeouts in milliseconds, per service (route name) with
+        # caleido.statement_timeout.<service> settings
+        self.statement_timeouts = {}
+        for key, value in settings.items():
+            if key.startswith('caleido.statement_timeout.'):
+                service = key[len('caleido.statement_timeout.'):]
+                self.statement_timeouts[service] = int(value)
+        self.default_statement_timeout = int(
+            settings.get('caleido.statement_timeout', 0))
+        self.max_queries = int(settings.get('caleido.query_budget.queries', 0))
+        self.max_query_time = int(settings.get('caleido.query_budget.time', 0))
+
+    @property
+    def repository_cache(self):
+        return self.registry['repository_cache']
+
+    def lookup_repository(self, vhost_name):
+        """
+        Return a dict with the namespace, config_revision and settings of
+        the repository served on `vhost_name`, or None if there is none.
+
+        The lookup runs outside of the request transaction, so the session
+        for the repository can be created once the namespace is known.
+        """
+        info = self.repository_cache.get(vhost_name)
+        if info is not None:
+            return info
+        table = Repository.__table__
+        with self.registry['engine'].connect() as connection:
+            repository = connection.execute(
+                sql.select([table.c.namespace,
+                            table.c.config_revision,
+                            table.c.settings,
+                            table.c.placement]).where(
+                                table.c.vhost_name == vhost_name)).first()
+        if repository is None:
+            return None
+        info = {'namespace': repository.namespace,
+                'config_revision': repository.config_revision,
+                'settings': repository.settings,
+                'placement': repository.placement}
+        self.repository_cache.set(vhost_name, info)
+        return info
+
+    def invalidate_repository(self, session, namespace):
+        """
+        Remove cached info of a repository, both now and after the
+        session commits, so concurrent requests can not cache stale values.
+        """
+        self.repository_cache.invalidate(namespace)
+        event.listen(session,
+                     'after_commit',
+                     lambda session: self.repository_cache.invalidate(namespace),
+                     once=True)
 
     def repository_info(self, session):
         revisions = {}
@@ -77,27 +354,57 @@ class Storage(object):
             revisions[repository.namespace] = repository.to_dict()
         return revisions
 
-    def create_repository(self, session, namespace, vhost_name, settings=None):
-        self.registry['engine'].execute(CreateSchema(namespace))
+    def repository_placement(self, session, namespace):
+        return session.query(Repository.placement).filter(
+            Repository.namespace == namespace).scalar()
+
+    def tenant_tables(self):
+        "All tables that are created in the schema of a repository"
+        return [table for table in Base.metadata.sorted_tables
+                if table is not Repository.__table__]
+
+    def create_repository(self,
+                          session,
+                          namespace,
+                          vhost_name,
+                          settings=None,
+                          placement=None):
+        """
+        Create a repository in `namespace`. The schema is created in the
+        database of `placement`, which is one of the names configured with
+        `sqlalchemy.shard.<placement>.*` settings, or the main database if
+        no placement is given.
+        """
+        engine = self.engine(placement)
         session.add(Repository(namespace=namespace,
                                schema_version=self.schema_version,
                                vhost_name=vhost_name,
+                               placement=placement,
                                settings=settings or DEFAULTS['repository_settings']))
         session.flush()
-        session.execute('SET search_path TO %s, public' % namespace);
-        Base.metadata.create_all(bind=session.connection())
+        connection = session.connection(bind=engine)
+        extensions = self.ensure_extensions(connection)
+        # the DDL is sent as a single batch instead of one round trip per
+        # statement, it has no parameters
+        connection.execute(';\n'.join(
+            self.tenant_ddl(namespace, engine.dialect, extensions)))
+        self.select_tenant(session, namespace, placement=placement)
         session.flush()
+        self.invalidate_repository(session, namespace)
 
     def drop_repository(self, session, namespace):
-        self.registry['engine'].execute(DropSchema(namespace, cascade=True))
         repo = session.query(Repository).filter(
             Repository.namespace == namespace).first()
+        placement = repo.placement if repo else None
+        self.engine(placement).execute(DropSchema(namespace, cascade=True))
         if repo:
             session.delete(repo)
         session.flush()
+        self.invalidate_repository(session, namespace)
 
     def create_all(self, session):
-        session.execute('SET search_path TO public');
+        self.select_tenant(session)
+        self.ensure_extensions(session.connection())
         Repository.__table__.create(bind=session.connection())
         session.flush()
 
@@ -106,64 +413,384 @@ class Storage(object):
             self.drop_repository(session, repository.namespace)
         Repository.__table__.drop(bind=session.connection())
 
-    def make_session(self, namespace=None, transaction_manager=None):
+    def engine(self, placement=None, replica=False):
+        """
+        Return the engine of the database for `placement`, or the main
+        engine if placement is None. Replicas are only available for
+        the main database.
+        """
+        if placement is not None:
+            engines = self.registry.get('shard_engines', {})
+            if placement not in engines:
+                raise ValueError('Unknown repository placement "%s"' % (
+                    placement))
+            return engines[placement]
+        if replica and self.registry.get('replica_engine') is not None:
+            return self.registry['replica_engine']
+        return self.registry['engine']
+
+    def tenant_engine(self, namespace, placement=None, replica=False,
+                      isolation_level=None):
+        """
+        Return the engine with the schema of `namespace` compiled into all
+        statements, and transactions started with `isolation_level` if
+        given. No schema is compiled in if `namespace` is None. The engine
+        shares the connection pool of the engine returned by `engine`.
+        """
+        key = (namespace, placement, replica, isolation_level)
+        engine = self._tenant_engines.get(key)
+        if engine is None:
+            options = {}
+            if namespace is not None:
+                options['schema_translate_map'] = {None: namespace}
+            if isolation_level is not None:
+                options['isolation_level'] = isolation_level
+            engine = self.engine(placement, replica=replica).execution_options(
+                **options)
+            self._tenant_engines[key] = engine
+        return engine
+
+    def select_tenant(self, session, namespace=None, placement=None):
+        """
+        Point the current transaction of the session to the tables of
+        `namespace`, or to the public schema if no namespace is given.
+
+        If the repository is placed in another database, the repository
+        tables of the session are bound to the engine of that database.
+
+        With the (default) `search_path` tenant selection mode, the
+        search_path is set on the connection and outlives the transaction.
+        In the other modes it is scoped to the current transaction, which
+        is safe to use behind a transaction pooling pgbouncer.
+        """
+        engine = self.engine(placement)
+        if placement is not None:
+            for table in self.tenant_tables():
+                session.bind_table(table, engine)
+        session.execute(self.search_path_statement(namespace), bind=engine)
+
+    def search_path(self, namespace=None):
+        if namespace:
+            return '%s, public' % namespace
+        return 'public'
+
+    def search_path_statement(self, namespace=None):
+        search_path = self.search_path(namespace)
+        if self.tenant_selection == 'search_path':
+            return 'SET search_path TO %s' % search_path
+        return self.local_settings_statement({'search_path': search_path})
+
+    def local_settings_statement(self, settings):
+        "Statement changing `settings` for the current transaction only"
+        return sql.select([sql.func.set_config(name, value, True)
+                           for name, value in sorted(settings.items())])
+
+    def statement_timeout(self, service=None):
+        """
+        Return the statement timeout in milliseconds for transactions of
+        `service`, or 0 if there is none. The timeout never exceeds the
+        database time budget of a request.
+        """
+        timeout = self.statement_timeouts.get(service,
+                                              self.default_statement_timeout)
+        if self.max_query_time:
+            timeout = min(timeout or self.max_query_time, self.max_query_time)
+        return timeout
+
+    def query_budget(self):
+        "Return a new QueryBudget for a request, or None if not configured"
+        if not (self.max_queries or self.max_query_time):
+            return None
+        return QueryBudget(max_queries=self.max_queries,
+                           max_time=self.max_query_time)
+
+    def concurrent_execute(self, session, statement, mapper=None):
+        """
+        Execute the core `statement` on a second pooled connection, in a
+        worker thread. The worker transaction imports the snapshot of the
+        current transaction of `session`. Readonly sessions with concurrent
+        counts run their transactions with repeatable read, so the worker
+        and all queries of the session see the same data.
+
+        The connection is checked out before the worker is started. If the
+        pool has no connection to spare, the statement is executed on the
+        connection of `session` instead, so requests do not wait on each
+        other for a second connection.
+
+        Returns a future of the fetched rows.
+        """
+        bind = session.get_bind(mapper=mapper)
+        if not pool_has_capacity(bind.pool):
+            future = Future()
+            future.set_result(
+                session.execute(statement, mapper=mapper).fetchall())
+            return future
+        snapshot = session.execute(
+            sql.select([sql.func.pg_export_snapshot()]),
+            mapper=mapper).scalar()
+        local_settings = {
+            'search_path': self.search_path(session.info.get('namespace'))}
+        if session.info.get('statement_timeout'):
+            local_settings['statement_timeout'] = str(
+                session.info['statement_timeout'])
+        local_settings = self.local_settings_statement(local_settings)
+
+        connection = bind.connect()
+
+        def execute():
+            with connection:
+                with connection.begin():
+                    connection.execute(
+                        'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                    connection.execute(
+                        sql.text('SET TRANSACTION SNAPSHOT :snapshot'),
+                        snapshot=snapshot)
+                    connection.execute(local_settings)
+                    return connection.execute(statement).fetchall()
+
+        return self.registry['query_executor'].submit(execute)
+
+    def count(self, session, query, mapper=None, mode='exact'):
+        """
+        Count the rows of the ORM `query` and return a function returning
+        the total.
+
+        The `mode` is one of `TOTAL_MODES`: `exact` counts the rows,
+        `estimated` returns the row estimate of the query planner, and
+        `none` does not count at all, the total is None.
+
+        With the `caleido.concurrent_count` setting, sessions of readonly
+        requests run the exact count concurrently with the queries that
+        follow, and the returned function waits for the result.
+
+        Exact totals are cached in the `count_cache` until the counted
+        tables are written in the namespace of the session. Totals counted
+        on a replica are not cached, the replica may not have caught up
+        with the writes that invalidated the cache.
+        """
+        if mode not in TOTAL_MODES:
+            raise ValueError('Unknown total mode "%s"' % mode)
+        if mode == 'none':
+            return lambda: None
+        if mode == 'estimated':
+            plan = session.execute(Explain(query.order_by(None).statement),
+                                   mapper=mapper).scalar()
+            total = int(plan[0]['Plan']['Plan Rows'])
+            return lambda: total
+        cache = session.info.get('count_cache')
+        namespace = session.info.get('namespace')
+        if cache is None or session.info.get('written_tables'):
+            # sessions with uncommitted writes can not use cached totals
+            return self.exact_count(session, query, mapper=mapper)
+        statement = query.order_by(None).statement
+        compiled = statement.compile(
+            dialect=session.get_bind(mapper=mapper).dialect)
+        key = (str(compiled), tuple(sorted(
+            (name, repr(value)) for name, value in compiled.params.items())))
+        total = cache.get(namespace, key)
+        if total is not None:
+            return lambda: total
+        count = self.exact_count(session, query, mapper=mapper)
+        # the generation at the start of the transaction, totals are only
+        # cached if nothing was invalidated since the count's snapshot
+        generation = session.info.get('count_generation')
+        if generation is None or session.info.get('replica'):
+            return count
+        tables = set(table.name for table in find_tables(statement))
+        def cached_count():
+            total = count()
+            cache.set(namespace, key, total, tables, generation)
+            return total
+        return cached_count
+
+    def exact_count(self, session, query, mapper=None):
+        if not (self.concurrent_count and session.info.get('readonly')):
+            total = query.count()
+            return lambda: total
+        statement = sql.select([sql.func.count()]).select_from(
+            query.order_by(None).subquery())
+        future = self.concurrent_execute(session, statement, mapper=mapper)
+        return lambda: future.result()[0][0]
+
+    def make_session(self,
+                     namespace=None,
+                     transaction_manager=None,
+                     readonly=False,
+                     placement=None,
+                     statement_timeout=None,
+                     budget=None):
+        """
+        Create a session for the repository in `namespace`, stored in the
+        database of `placement`. The repositories catalog is always
+        accessed through the main engine.
+
+        The `statement_timeout` in milliseconds is applied to every
+        transaction of the session, and the queries of the session are
+        counted against the QueryBudget `budget`.
+
+        If `readonly` is set and a replica engine is configured with the
+        `sqlalchemy.replica.` settings, the session is bound to the replica.
+
+        Depending on the tenant selection mode, the search_path is set once
+        on the first connection (`search_path`), at the start of each
+        transaction (`transaction`), or the session is bound to an engine that prefixes
+        all tables with the namespace (`schema_translate`), which costs no
+        additional round trips at all.
+        """
+        kwargs = {}
+        isolation_level = None
+        if readonly and self.concurrent_count:
+            # the snapshot exported for concurrent counts is the snapshot of
+            # the whole transaction, see `concurrent_execute`
+            isolation_level = 'REPEATABLE READ'
+        if namespace and self.tenant_selection == 'schema_translate':
+            kwargs['bind'] = self.tenant_engine(namespace,
+                                                placement=placement,
+                                                replica=readonly,
+                                                isolation_level=isolation_level)
+        elif isolation_level is not None:
+            kwargs['bind'] = self.tenant_engine(None,
+                                                placement=placement,
+                                                replica=readonly,
+                                                isolation_level=isolation_level)
+        else:
+            kwargs['bind'] = self.engine(placement, replica=readonly)
+        if placement is not None:
+            kwargs['binds'] = {Repository: self.registry['engine']}
         session = get_tm_session(
             self.registry['dbsession_factory'],
-            transaction_manager or transaction.manager)
+            transaction_manager or transaction.manager,
+            **kwargs)
+        session.info['namespace'] = namespace
+        session.info['readonly'] = readonly
+        session.info['replica'] = bool(
+            readonly and placement is None and
+            self.registry.get('replica_engine') is not None)
+        session.info['statement_timeout'] = statement_timeout
         if namespace:
-            session.execute('SET search_path TO %s, public' % namespace);
+            # see `count` and `invalidate_counts`
+            session.info['count_cache'] = self.registry.get('count_cache')
+        # the search_path and timeout are set when the session checks out a
+        # connection, sessions that are never used cost no round trip
+        if namespace and self.tenant_selection == 'search_path':
+            statement = self.search_path_statement(namespace)
+            def set_search_path(session, transaction, connection):
+                connection.execute(statement)
+            event.listen(session, 'after_begin', set_search_path, once=True)
+        local_settings = {}
+        if namespace and self.tenant_selection == 'transaction':
+            local_settings['search_path'] = self.search_path(namespace)
+        if statement_timeout:
+            local_settings['statement_timeout'] = str(statement_timeout)
+        if local_settings or budget is not None:
+            local_statement = self.local_settings_statement(local_settings)
+            def begin_transaction(session, transaction, connection):
+                if budget is not None:
+                    connection.info['caleido.budget'] = budget
+                    connection.info['caleido.statement_timeout'] = (
+                        statement_timeout or 0)
+                if local_settings:
+                    connection.execute(local_statement)
+            event.listen(session, 'after_begin', begin_transaction)
         return session
 
+    def default_rows(self):
+        "Yield the tables and DEFAULTS rows every repository starts with"
+        yield UserGroup.__table__, [
+            {'id': id, 'label': label}
+            for id, label in DEFAULTS['user_groups'].items()]
+        for key, model in DEFAULT_SCHEMES:
+            yield model.__table__, [
+                {'key': value, 'label': label}
+                for value, label in DEFAULTS[key].items()]
+
     def initialize_repository(self, session, namespace, admin_userid, admin_credentials):
-        session.execute('SET search_path TO %s, public' % namespace);
-        user_groups = DEFAULTS['user_groups']
-        for id, label in user_groups.items():
-            session.add(UserGroup(id=id, label=label))
-        session.flush()
+        placement = self.repository_placement(session, namespace)
+        self.select_tenant(session, namespace, placement=placement)
+        for table, rows in self.default_rows():
+            session.execute(table.insert(), rows)
         session.add(User(userid=admin_userid,
                          credentials=admin_credentials,
                          user_group=100))
         session.flush()
-        group_types = DEFAULTS['group_types']
-        for key, label in group_types.items():
-            session.add(GroupType(key=key, label=label))
-        person_account_types = DEFAULTS['person_account_types']
-        for key, label in person_account_types.items():
-            session.add(PersonAccountType(key=key, label=label))
-        group_account_types = DEFAULTS['group_account_types']
-        for key, label in group_account_types.items():
-            session.add(GroupAccountType(key=key, label=label))
-        work_types = DEFAULTS['work_types']
-        for key, label in work_types.items():
-            session.add(WorkType(key=key, label=label))
-        contributor_roles = DEFAULTS['contributor_roles']
-        for key, label in contributor_roles.items():
-            session.add(ContributorRole(key=key, label=label))
-        identifier_types = DEFAULTS['identifier_types']
-        for key, label in identifier_types.items():
-            session.add(IdentifierType(key=key, label=label))
-        relation_types = DEFAULTS['relation_types']
-        for key, label in relation_types.items():
-            session.add(RelationType(key=key, label=label))
-        description_types = DEFAULTS['description_types']
-        for key, label in description_types.items():
-            session.add(DescriptionType(key=key, label=label))
-        description_formats = DEFAULTS['description_formats']
-        for key, label in description_formats.items():
-            session.add(DescriptionFormat(key=key, label=label))
-        measure_types = DEFAULTS['measure_types']
-        for key, label in measure_types.items():
-            session.add(MeasureType(key=key, label=label))
-        position_types = DEFAULTS['position_types']
-        for key, label in position_types.items():
-            session.add(PositionType(key=key, label=label))
-
-        session.flush()
-        session.execute('SET search_path TO public');
+        self.select_tenant(session, placement=placement)
         session.flush()
 
+    def installed_extensions(self, connection):
+        return set(row[0] for row in connection.execute(
+            sql.text('SELECT extname FROM pg_extension')))
 
-def get_tm_session(session_factory, transaction_manager):
+    def ensure_extensions(self, connection):
+        """
+        Create the EXTENSIONS offered by the database of `connection`, and
+        return the names of all installed extensions. Extensions the role
+        of the connection may not create are skipped, the indexes using
+        them are left out, see `tenant_ddl`.
+        """
+        installed = self.installed_extensions(connection)
+        missing = tuple(name for name in EXTENSIONS if name not in installed)
+        if missing:
+            available = connection.execute(
+                sql.text('SELECT name FROM pg_available_extensions '
+                         'WHERE name IN :names'), names=missing).fetchall()
+            for row in available:
+                savepoint = connection.begin_nested()
+                try:
+                    connection.execute('CREATE EXTENSION IF NOT EXISTS %s' % (
+                        connection.dialect.identifier_preparer.quote(row[0])))
+                except sql.exc.DBAPIError:
+                    savepoint.rollback()
+                    continue
+                savepoint.commit()
+                installed.add(row[0])
+        return installed
+
+    def tenant_ddl(self, namespace, dialect, extensions=()):
+        """
+        Return the statements creating the schema `namespace` with all
+        tenant sequences, tables and indexes, compiled for `dialect`.
+        Indexes requiring an extension that is not in `extensions` are
+        left out.
+        """
+        statements = [CreateSchema(namespace)]
+        for table in self.tenant_tables():
+            for column in table.columns:
+                if isinstance(column.default, sql.Sequence):
+                    statements.append(CreateSequence(column.default))
+            statements.append(CreateTable(table))
+            for index in table.indexes:
+                extension = index.info.get('extension')
+                if extension is not None and extension not in extensions:
+                    continue
+                statements.append(CreateIndex(index))
+        return [str(statement.compile(
+            dialect=dialect,
+            schema_translate_map={None: namespace}))
+                for statement in statements]
+
+    def provision_repository(self,
+                             session,
+                             namespace,
+                             vhost_name,
+                             admin_userid,
+                             admin_credentials,
+                             settings=None,
+                             placement=None):
+        """
+        Create and initialize a repository in `namespace`, see
+        `create_repository` and `initialize_repository`.
+        """
+        self.create_repository(session,
+                               namespace,
+                               vhost_name,
+                               settings=settings,
+                               placement=placement)
+        self.initialize_repository(session,
+                                   namespace,
+                                   admin_userid,
+                                   admin_credentials)
+
+def get_tm_session(session_factory, transaction_manager, **kwargs):
     """
     Get a ``sqlalchemy.orm.Session`` instance backed by a transaction.
 
@@ -184,14 +811,12 @@ def get_tm_session(session_factory, transaction_manager):
               dbsession = get_tm_session(session_factory, transaction.manager)
 
     """
-    dbsession = session_factory()
+    dbsession = session_factory(**kwargs)
 
     zope.sqlalchemy.register(
         dbsession, transaction_manager=transaction_manager)
     return dbsession
 
-REPOSITORY_CONFIG = {}
-
 class RepositoryConfig(object):
     orm_table = {'group_type': GroupType,
                  'work_type': WorkType,
@@ -213,13 +838,6 @@ class RepositoryConfig(object):
         self._blob_store = None
         self.config_revision = config_revision
         self.settings = settings or {}
-        if self.config_revision in REPOSITORY_CONFIG.get(self.namespace, {}):
-            self.cached_config = REPOSITORY_CONFIG[
-                self.namespace][self.config_revision]
-        else:
-            self.cached_config = {}
-            REPOSITORY_CONFIG[self.namespace] = {
-                self.config_revision: self.cached_config}
 
     @reify
     def blob(self):
@@ -228,6 +846,34 @@ class RepositoryConfig(object):
             self.registry.settings['caleido.blob_storage'])
         return BlobStore(backend(self))
 
+    @property
+    def scheme_cache(self):
+        return self.registry['scheme_cache']
+
+    @reify
+    def schemes(self):
+        """
+        The values of all type schemes, loaded from the scheme cache or
+        with a single query over all scheme tables. Values loaded from a
+        replica are not cached, the replica may not have caught up with the
+        config revision yet.
+        """
+        schemes = self.scheme_cache.get(self.namespace, self.config_revision)
+        if schemes is not None:
+            return schemes
+        schemes = dict((type, []) for type in self.orm_table)
+        query = sql.union_all(*[
+            sql.select([sql.literal(type).label('type'),
+                        orm_table.key,
+                        orm_table.label])
+            for type, orm_table in self.orm_table.items()])
+        for row in self.session.execute(query):
+            schemes[row.type].append({'key': row.key, 'label': row.label})
+        if not self.session.info.get('replica'):
+            self.scheme_cache.set(self.namespace, self.config_revision,
+                                  schemes)
+        return schemes
+
     def update_settings(self, settings):
         self.settings = settings
         repo = self.session.query(Repository).filter(
@@ -235,17 +881,11 @@ class RepositoryConfig(object):
         repo.settings = self.settings
         self.session.add(repo)
         self.session.flush()
+        self.registry['storage'].invalidate_repository(self.session,
+                                                       self.namespace)
 
     def type_config(self, type):
-        if type in self.cached_config:
-            values = self.cached_config[type]
-        else:
-            orm_table = self.orm_table[type]
-            values = []
-            for setting in self.session.query(orm_table).all():
-                values.append({'key': setting.key, 'label': setting.label})
-            self.cached_config[type] = values
-        return values
+        return self.schemes[type]
 
     def put_type_config(self, type, values):
         orm_table = self.orm_table[type]
@@ -259,13 +899,119 @@ class RepositoryConfig(object):
                     self.session.add(item)
                 del values[item.key]
         for key, label in values.items():
-            self.session.add(self.orm(key=key, label=label))
-        # update the repository config revision to force cache invalidation
-        repo = self.session(Repository).query(
-            Repository.namespace==self.namespace).first()
-        repo.config_revision = Repository.config_revision + 1
+            self.session.add(orm_table(key=key, label=label))
+        self.session.flush()
+        self.schemes_changed()
+
+    def schemes_changed(self):
+        """
+        Update the repository config revision after the type schemes have
+        been changed, so all processes stop using their cached values.
+        """
+        repo = self.session.query(Repository).filter(
+            Repository.namespace == self.namespace).first()
+        # the config revision is the version counter of the repository,
+        # and is increased on every update
+        flag_modified(repo, 'settings')
         self.session.add(repo)
         self.session.flush()
+        self.config_revision = repo.config_revision
+        self.scheme_cache.invalidate(self.namespace)
+        self.registry['storage'].invalidate_repository(self.session,
+                                                       self.namespace)
+        self.__dict__.pop('schemes', None)
+
+
+def dependent_tables(tables):
+    """
+    Return the names of `tables` and of all tables referencing them by
+    foreign key, whose rows can be deleted or updated by cascades.
+    """
+    tables = set(tables)
+    changed = True
+    while changed:
+        changed = False
+        for table in Base.metadata.sorted_tables:
+            if table.name in tables:
+                continue
+            if any(fk.column.table.name in tables
+                   for fk in table.foreign_keys):
+                tables.add(table.name)
+                changed = True
+    return tables
+
+def record_written_tables(session, flush_context):
+    tables_written(session, [
+        sql.inspect(instance).mapper.local_table.name
+        for instance in list(session.new) + list(session.dirty) + list(
+            session.deleted)])
+
+def store_group_closure(session, flush_context):
+    if refresh_group_closure(session, flush_context):
+        tables_written(session, [GroupClosure.__tablename__])
+
+def store_changed_search_terms(session, flush_context):
+    if refresh_search_terms(session, flush_context):
+        tables_written(session, [Work.__tablename__])
+
+def store_changed_snippets(session, flush_context):
+    if refresh_snippets(session, flush_context):
+        tables_written(session, [WorkSnippet.__tablename__])
+
+def tables_written(session, tables):
+    """
+    Record writes to `tables` in the transaction of `session`. Flushes are
+    recorded automatically, this is needed for core insert, update and
+    delete statements executed with the session.
+    """
+    if session.info.get('count_cache') is None:
+        return
+    session.info.setdefault('written_tables', set()).update(tables)
+
+def record_count_generation(session, transaction, connection):
+    "Record the generation of the count cache when a transaction starts"
+    cache = session.info.get('count_cache')
+    if cache is not None and 'count_generation' not in session.info:
+        session.info['count_generation'] = cache.generation(
+            session.info['namespace'])
+
+def invalidate_counts(session):
+    "Invalidate the cached totals of the tables written by the session"
+    session.info.pop('count_generation', None)
+    tables = session.info.pop('written_tables', None)
+    if tables:
+        session.info['count_cache'].invalidate(session.info['namespace'],
+                                               dependent_tables(tables))
+
+def discard_written_tables(session):
+    session.info.pop('count_generation', None)
+    session.info.pop('written_tables', None)
+
+def monitored_engine(settings, prefix):
+    """
+    Create an engine from the `prefix` settings, using a MonitoredQueuePool
+    unless another poolclass is configured.
+    """
+    options = {}
+    if not settings.get('%spoolclass' % prefix):
+        options['poolclass'] = MonitoredQueuePool
+    return engine_from_config(settings, prefix=prefix, **options)
+
+def add_database_free_route(config, route_name):
+    """
+    Config directive marking the route `route_name` as not using the
+    database, requests for it skip the transaction and session setup.
+    """
+    config.registry['database_free_routes'].add(route_name)
+
+def needs_transaction(request):
+    "pyramid_tm activation hook, see `add_database_free_route`"
+    mapper = request.registry.queryUtility(IRoutesMapper)
+    if mapper is None:
+        return True
+    route = mapper(request)['route']
+    return (route is None or
+            route.name not in request.registry['database_free_routes'])
 
 
 def includeme(config):
@@ -278,43 +1024,124 @@ def includeme(config):
     settings = config.get_settings()
 
     settings['tm.manager_hook'] = 'pyramid_tm.explicit_manager'
+    # requests for routes added with `add_database_free_route` are handled
+    # without a transaction
+    settings['tm.activate_hook'] = needs_transaction
+    config.registry['database_free_routes'] = set()
+    config.add_directive('add_database_free_route', add_database_free_route)
     # use pyramid_tm to hook the transaction lifecycle to the request
     config.include('pyramid_tm')
 
     # use pyramid_retry to retry a request when transient exceptions occur
     config.include('pyramid_retry')
 
-    engine = engine_from_config(settings, prefix='sqlalchemy.')#, echo=True)
+    primary_settings = dict((key, value) for key, value in settings.items()
+                            if not key.startswith(('sqlalchemy.replica.',
+                                                   'sqlalchemy.shard.')))
+    engine = monitored_engine(primary_settings, 'sqlalchemy.')#, echo=True)
+    pool_monitors = {'primary': PoolMonitor()}
+    pool_monitors['primary'].instrument(engine)
 
     session_factory = sessionmaker()
     session_factory.configure(bind=engine, autoflush=False)
 
+    def record_tenant_connection(session, transaction, connection):
+        namespace = session.info.get('namespace')
+        monitor = getattr(connection.engine.pool, 'monitor', None)
+        if namespace and monitor is not None:
+            monitor.tenant_checkout(namespace, connection.info)
+
+    event.listen(session_factory, 'after_begin', record_tenant_connection)
+    event.listen(session_factory, 'after_begin', record_count_generation)
+
+    # the pre flush state of the session is still available after a flush
+    event.listen(session_factory, 'after_flush', record_written_tables)
+    event.listen(session_factory, 'after_flush', store_group_closure)
+    event.listen(session_factory, 'after_flush', store_changed_search_terms)
+    event.listen(session_factory, 'after_flush', store_changed_snippets)
+    event.listen(session_factory, 'after_commit', invalidate_counts)
+    event.listen(session_factory, 'after_rollback', discard_written_tables)
+
     config.registry['engine'] = engine
     config.registry['dbsession_factory'] = session_factory
+    if settings.get('sqlalchemy.replica.url'):
+        # optional read replica for requests that do not write
+        config.registry['replica_engine'] = monitored_engine(
+            settings, 'sqlalchemy.replica.')
+        pool_monitors['replica'] = PoolMonitor()
+        pool_monitors['replica'].instrument(config.registry['replica_engine'])
+
+    # additional databases repositories can be placed in, configured with
+    # sqlalchemy.shard.<placement>.url settings
+    shard_engines = {}
+    for key in settings:
+        if not key.startswith('sqlalchemy.shard.'):
+            continue
+        placement = key.split('.')[2]
+        if placement in shard_engines:
+            continue
+        shard_engines[placement] = monitored_engine(
+            settings, 'sqlalchemy.shard.%s.' % placement)
+        pool_monitors['shard:%s' % placement] = PoolMonitor()
+        pool_monitors['shard:%s' % placement].instrument(
+            shard_engines[placement])
+    config.registry['shard_engines'] = shard_engines
+    instrument_queries(engine)
+    if config.registry.get('replica_engine') is not None:
+        instrument_queries(config.registry['replica_engine'])
+    for shard_engine in shard_engines.values():
+        instrument_queries(shard_engine)
+    config.registry['pool_monitors'] = pool_monitors
+    config.registry['repository_cache'] = RepositoryCache(
+        ttl=int(settings.get('caleido.repository_cache_ttl', 60)))
+    config.registry['scheme_cache'] = SchemeCache(
+        max_entries=int(settings.get('caleido.scheme_cache_size', 256)))
+    count_cache_size = int(settings.get('caleido.count_cache_size', 1024))
+    if count_cache_size:
+        config.registry['count_cache'] = CountCache(
+            max_entries=count_cache_size,
+            ttl=int(settings.get('caleido.count_cache_ttl', 60)))
+
+    # worker threads running count queries, see Storage.count
+    config.registry['query_executor'] = ThreadPoolExecutor(
+        max_workers=int(settings.get('caleido.concurrent_count_workers', 4)))
 
     config.registry['storage'] = Storage(config.registry)
 
-    def new_dbsession(request):
-        session = get_tm_session(session_factory, request.tm)
+    def repository_info(request):
         host = request.headers['Host'].split(':')[0]
-        repository = session.query(Repository).filter(Repository.vhost_name == host).first()
+        repository = request.registry['storage'].lookup_repository(host)
         if repository:
             request.environ[
-                'caleido.repository.namespace'] = repository.namespace
+                'caleido.repository.namespace'] = repository['namespace']
             request.environ[
-                'caleido.repository.config_revision'] = repository.config_revision
+                'caleido.repository.config_revision'] = repository['config_revision']
             request.environ[
-                'caleido.repository.settings'] = repository.settings
-            session.execute(
-                'SET search_path TO %s, public' % repository.namespace);
-        return session
+                'caleido.repository.settings'] = repository['settings']
+        return repository
+
+    def new_dbsession(request):
+        storage = request.registry['storage']
+        repository = request.repository_info
+        service = None
+        if request.matched_route is not None:
+            # cornice routes are named after their service
+            service = request.matched_route.name
+        return storage.make_session(
+            namespace=repository and repository['namespace'],
+            transaction_manager=request.tm,
+            readonly=request.method in READONLY_METHODS,
+            placement=repository and repository['placement'],
+            statement_timeout=storage.statement_timeout(service),
+            budget=storage.query_budget())
 
     def new_repository(request):
         session = request.dbsession
-        namespace = request.environ['caleido.repository.namespace']
-        rev = request.environ['caleido.repository.config_revision']
+        repository_info = request.repository_info
+        namespace = repository_info['namespace']
+        rev = repository_info['config_revision']
 
-        repo_settings = request.environ['caleido.repository.settings']
+        repo_settings = repository_info['settings']
 
         api_host_url = '%s://%s' % (request.scheme, request.host)
         if request.server_port != 80:
@@ -328,6 +1155,7 @@ def includeme(config):
                                       settings=repo_settings)
         return repository
 
+    config.add_request_method(repository_info, 'repository_info', reify=True)
     config.add_request_method(new_dbsession, 'new_dbsession')
     # make request.dbsession available for use in Pyramid
     config.add_request_method(
@@ -5,7 +5,11 @@ import json
 from pyramid.paster import get_appsettings
 from caleido import main
 from caleido.models import Person, Group, Work
+from caleido.search import update_work_search_terms
+from caleido.closure import rebuild_group_closure as rebuild_closure
+from caleido.resources import WorkResource
 import transaction
+from zope.sqlalchemy import mark_changed
 import sqlalchemy as sql
 import sqlalchemy.dialects.postgresql  as postgresql
 from sqlalchemy.inspection import inspect
@@ -13,18 +17,28 @@ from sqlalchemy.inspection import inspect
 def initialize_db():
     if len(sys.argv) == 1:
         cmd = os.path.basename(sys.argv[0])
-        print('usage: %s <config_uri> [schema]\n'
+        print('usage: %s <config_uri> [schema] [placement]\n'
               'example: "%s development.ini test"' % (cmd, cmd))
         sys.exit(1)
     settings = get_appsettings(sys.argv[1])
     app = main({}, **settings)
     storage = app.registry['storage']
     session = storage.make_session()
-    if len(sys.argv) == 3:
+    if len(sys.argv) >= 3:
         repo = sys.argv[2]
-        print('Creating "%s" repository on "%s.localhost"' % (repo, repo))
-        storage.create_repository(session, repo, '%s.localhost' % repo)
-        storage.initialize_repository(session, repo, 'admin', 'admin')
+        placement = None
+        if len(sys.argv) == 4:
+            placement = sys.argv[3]
+            print('Creating "%s" repository on "%s.localhost" in "%s"' % (
+                repo, repo, placement))
+        else:
+            print('Creating "%s" repository on "%s.localhost"' % (repo, repo))
+        storage.provision_repository(session,
+                                     repo,
+                                     '%s.localhost' % repo,
+                                     'admin',
+                                     'admin',
+                                     placement=placement)
     else:
         storage.create_all(session)
         print('Creating "unittest" repository on "unittest.localhost"')
@@ -47,13 +61,72 @@ def drop_db():
     session = storage.make_session()
     if len(sys.argv) == 3:
         repo = sys.argv[2]
-        print('Dropping "%s" repository on "%s.localhost"' % (repo, repo))
+        placement = storage.repository_placement(session, repo)
+        if placement:
+            print('Dropping "%s" repository on "%s.localhost" in "%s"' % (
+                repo, repo, placement))
+        else:
+            print('Dropping "%s" repository on "%s.localhost"' % (repo, repo))
         storage.drop_repository(session, repo)
     else:
         print('Dropping all repositories"')
         storage.drop_all(session)
     transaction.commit()
 
+def rebuild_search_terms():
+    if len(sys.argv) != 3:
+        cmd = os.path.basename(sys.argv[0])
+        print('usage: %s <config_uri> <schema>\n'
+              'example: "%s development.ini test"' % (cmd, cmd))
+        sys.exit(1)
+    settings = get_appsettings(sys.argv[1])
+    app = main({}, **settings)
+    storage = app.registry['storage']
+    repo = sys.argv[2]
+    placement = storage.repository_placement(storage.make_session(), repo)
+    session = storage.make_session(repo, placement=placement)
+    print('Rebuilding the work search vectors of "%s"' % repo)
+    update_work_search_terms(session)
+    # the vectors are written without the ORM
+    mark_changed(session)
+    transaction.commit()
+
+def rebuild_group_closure():
+    if len(sys.argv) != 3:
+        cmd = os.path.basename(sys.argv[0])
+        print('usage: %s <config_uri> <schema>\n'
+              'example: "%s development.ini test"' % (cmd, cmd))
+        sys.exit(1)
+    settings = get_appsettings(sys.argv[1])
+    app = main({}, **settings)
+    storage = app.registry['storage']
+    repo = sys.argv[2]
+    placement = storage.repository_placement(storage.make_session(), repo)
+    session = storage.make_session(repo, placement=placement)
+    print('Rebuilding the group closure table of "%s"' % repo)
+    rebuild_closure(session)
+    # the rows are written without the ORM
+    mark_changed(session)
+    transaction.commit()
+
+def normalize_identifiers():
+    if len(sys.argv) != 3:
+        cmd = os.path.basename(sys.argv[0])
+        print('usage: %s <config_uri> <schema>\n'
+              'example: "%s development.ini test"' % (cmd, cmd))
+        sys.exit(1)
+    settings = get_appsettings(sys.argv[1])
+    app = main({}, **settings)
+    storage = app.registry['storage']
+    repo = sys.argv[2]
+    placement = storage.repository_placement(storage.make_session(), repo)
+    session = storage.make_session(repo, placement=placement)
+    count = WorkResource(app.registry, session).normalize_identifiers()
+    print('Normalized %s identifiers of "%s"' % (count, repo))
+    # the values are written without the ORM
+    mark_changed(session)
+    transaction.commit()
+
 def bigquery_schema():
     if len(sys.argv) == 1:
         cmd = os.path.basename(sys.argv[0])
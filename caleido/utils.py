@@ -1,3 +1,7 @@
+import base64
+import datetime
+import json
+
 from infinity import is_infinite
 
 import colander
@@ -17,10 +21,64 @@ def parse_duration(duration, format=None):
         end_date = end_date.strftime(format)
     return start_date, end_date
 
+def encode_cursor(values):
+    """
+    Encode the sort key values of the last hit of a page into an opaque
+    cursor token, used for keyset pagination.
+    """
+    values = [v.isoformat() if isinstance(v, datetime.date) else v
+              for v in values]
+    token = base64.urlsafe_b64encode(
+        json.dumps(values, separators=(',', ':')).encode('utf8'))
+    return token.decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    "Decode a cursor token, raises ValueError if it is invalid"
+    token = token + '=' * (-len(token) % 4)
+    values = json.loads(
+        base64.urlsafe_b64decode(token.encode('ascii')).decode('utf8'))
+    if not isinstance(values, list) or not values:
+        raise ValueError('Invalid cursor')
+    return values
+
+def cursor_validator(node, value):
+    try:
+        decode_cursor(value)
+    except (ValueError, TypeError):
+        raise colander.Invalid(node, 'Invalid cursor')
+
+class IdList(colander.String):
+    """
+    List of integer ids in a querystring, given as a repeated parameter
+    and/or as comma separated values: `id=1&id=2` or `id=1,2`
+    """
+    def serialize(self, node, appstruct):
+        if appstruct is colander.null:
+            return colander.null
+        return ','.join(str(value) for value in appstruct)
+
+    def deserialize(self, node, cstruct):
+        if cstruct is colander.null:
+            return colander.null
+        if not isinstance(cstruct, list):
+            cstruct = [cstruct]
+        try:
+            return [int(value)
+                    for values in cstruct
+                    for value in str(values).split(',') if value.strip()]
+        except ValueError:
+            raise colander.Invalid(
+                node, '"%s" is not a list of ids' % ','.join(cstruct))
+
 OKStatus = colander.SchemaNode(colander.String(),
                                validator=colander.OneOf(['ok']))
 ErrorStatus = colander.SchemaNode(colander.String(),
                                   validator=colander.OneOf(['error']))
+# querystring parameter selecting how the total of a listing is computed
+TotalMode = colander.SchemaNode(
+    colander.String(),
+    validator=colander.OneOf(['exact', 'estimated', 'none']),
+    missing='exact')
 
 class JsonMappingSchemaSerializerMixin(object):
     def to_json(self, appstruct):
@@ -91,6 +149,28 @@ class StatusResponseSchema(colander.MappingSchema):
     class body(colander.MappingSchema):
         status = ErrorStatus
 
+class TypeaheadRequestSchema(colander.MappingSchema):
+    @colander.instantiate()
+    class querystring(colander.MappingSchema):
+        query = colander.SchemaNode(colander.String(),
+                                    validator=colander.Length(1, 128))
+        limit = colander.SchemaNode(colander.Int(),
+                                    default=10,
+                                    validator=colander.Range(1, 50),
+                                    missing=10)
+
+class TypeaheadResponseSchema(colander.MappingSchema):
+    @colander.instantiate()
+    class body(colander.MappingSchema):
+        status = OKStatus
+
+        @colander.instantiate()
+        class snippets(colander.SequenceSchema):
+            @colander.instantiate()
+            class snippet(colander.MappingSchema):
+                id = colander.SchemaNode(colander.Int())
+                name = colander.SchemaNode(colander.String())
+
 def colander_bound_repository_validator(
     request, schema=None, deserializer=None, **kwargs):
     return colander_bound_repository_body_validator(request,
@@ -2,14 +2,14 @@ import datetime
 
 from intervals import DateInterval
 import colander
-import sqlalchemy as sql
 from sqlalchemy import func
 from cornice.resource import resource, view
 from cornice.validators import colander_validator
 from cornice import Service
 
 from caleido.models import Affiliation, Contributor, Group
-from caleido.resources import ResourceFactory, AffiliationResource, GroupResource
+from caleido.resources import (
+    ResourceFactory, AffiliationResource, group_filter)
 
 from caleido.exceptions import StorageError
 from caleido.utils import (ErrorResponseSchema,
@@ -18,7 +18,7 @@ from caleido.utils import (ErrorResponseSchema,
                            OKStatus,
                            JsonMappingSchemaSerializerMixin,
                            colander_bound_repository_body_validator,
-                           )
+                           TotalMode)
 
 
 class AffiliationSchema(colander.MappingSchema,
@@ -47,7 +47,7 @@ class AffiliationListingResponseSchema(colander.MappingSchema):
     @colander.instantiate()
     class body(colander.MappingSchema):
         status = OKStatus
-        total = colander.SchemaNode(colander.Int())
+        total = colander.SchemaNode(colander.Int(), missing=None)
         offset = colander.SchemaNode(colander.Int())
         limit = colander.SchemaNode(colander.Int())
 
@@ -76,12 +76,17 @@ class AffiliationListingRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
         query = colander.SchemaNode(colander.String(),
                                     missing=colander.drop)
         contributor_id = colander.SchemaNode(colander.Int(),
                                              missing=colander.drop)
         group_id = colander.SchemaNode(colander.Int(),
                                        missing=colander.drop)
+        transitive = colander.SchemaNode(colander.Boolean(),
+                                         missing=False)
+        ancestors = colander.SchemaNode(colander.Boolean(),
+                                        missing=False)
         work_id = colander.SchemaNode(colander.Int(),
                                       missing=colander.drop)
         format = colander.SchemaNode(
@@ -193,15 +198,10 @@ class AffiliationRecordAPI(object):
         if work_id:
             filters.append(Affiliation.work_id == work_id)
         if group_id:
-            if qs['transitive']:
-                # find
-                group_ids = [group_id]
-                group_ids.extend(ResourceFactory(GroupResource)(
-                    self.request, group_id).child_groups())
-                filters.append(
-                    sql.or_(*[Affiliation.group_id == g for g in group_ids]))
-            else:
-                filters.append(Affiliation.group_id == group_id)
+            filters.append(group_filter(Affiliation.group_id,
+                                        [group_id],
+                                        transitive=qs['transitive'],
+                                        ancestors=qs['ancestors']))
 
 
         cte_total = None
@@ -220,7 +220,8 @@ class AffiliationRecordAPI(object):
             order_by=order_by,
             post_query_callback=query_callback,
             apply_limits_post_query={'snippet': True}.get(format, False),
-            principals=self.request.effective_principals)
+            principals=self.request.effective_principals,
+            total_mode=self.request.validated['querystring']['total'])
         schema = AffiliationSchema()
         result = {'total': listing['total'] or cte_total,
                   'records': [],
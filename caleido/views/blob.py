@@ -16,7 +16,8 @@ from caleido.utils import (ErrorResponseSchema,
                            StatusResponseSchema,
                            OKStatus,
                            JsonMappingSchemaSerializerMixin,
-                           colander_bound_repository_body_validator)
+                           colander_bound_repository_body_validator,
+                           TotalMode)
 
 
 class BlobSchema(colander.MappingSchema, JsonMappingSchemaSerializerMixin):
@@ -42,7 +43,7 @@ class BlobListingResponseSchema(colander.MappingSchema):
     @colander.instantiate()
     class body(colander.MappingSchema):
         status = OKStatus
-        total = colander.SchemaNode(colander.Int())
+        total = colander.SchemaNode(colander.Int(), missing=None)
         offset = colander.SchemaNode(colander.Int())
         limit = colander.SchemaNode(colander.Int())
 
@@ -61,6 +62,7 @@ class BlobListingRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
 
 
 @resource(name='Blob',
@@ -145,7 +147,8 @@ class BlobRecordAPI(object):
             limit=limit,
             order_by=order_by,
             format=format,
-            principals=self.request.effective_principals)
+            principals=self.request.effective_principals,
+            total_mode=self.request.validated['querystring']['total'])
         schema = BlobSchema()
         result = {'total': listing['total'],
                   'records': [],
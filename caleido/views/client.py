@@ -4,8 +4,8 @@ import colander
 from cornice import Service
 
 from caleido.security import authenticator_factory
-from caleido.utils import OKStatus
-from caleido.resources import TypeResource
+from caleido.utils import OKStatus, ErrorResponseSchema
+from caleido.resources import SystemResource
 
 class ClientSchema(colander.MappingSchema):
     status = OKStatus
@@ -50,6 +50,13 @@ class ClientSchema(colander.MappingSchema):
 class ClientResponseSchema(colander.MappingSchema):
     body = ClientSchema()
 
+class PoolStatusSchema(colander.MappingSchema):
+    status = OKStatus
+    pools = colander.SchemaNode(colander.Mapping(unknown='preserve'))
+
+class PoolStatusResponseSchema(colander.MappingSchema):
+    body = PoolStatusSchema()
+
 
 
 client = Service(name='Client',
@@ -59,39 +66,24 @@ client = Service(name='Client',
                  response_schemas={
     '200': ClientResponseSchema(description='Ok')})
 
+def scheme_values(request, type):
+    "Values of a type scheme, served from the scheme cache when possible"
+    return [{'id': v['key'], 'label': v['label']}
+            for v in request.repository.type_config(type)]
+
 @client.get()
 def client_config(request):
-    group_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'group').to_dict()['values']]
-    work_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'work').to_dict()['values']]
+    group_types = scheme_values(request, 'group_type')
+    work_types = scheme_values(request, 'work_type')
     work_types.sort(key=itemgetter('label'))
-    group_account_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'groupAccount').to_dict()['values']]
-    person_account_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'personAccount').to_dict()['values']]
-    identifier_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'identifier').to_dict()['values']]
-    description_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'description').to_dict()['values']]
-    description_formats = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'descriptionFormat').to_dict()['values']]
-    relation_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'relation').to_dict()['values']]
-    measure_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'measure').to_dict()['values']]
-    position_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'position').to_dict()['values']]
+    group_account_types = scheme_values(request, 'group_account_type')
+    person_account_types = scheme_values(request, 'person_account_type')
+    identifier_types = scheme_values(request, 'identifier_type')
+    description_types = scheme_values(request, 'description_type')
+    description_formats = scheme_values(request, 'description_format')
+    relation_types = scheme_values(request, 'relation_type')
+    measure_types = scheme_values(request, 'measure_type')
+    position_types = scheme_values(request, 'position_type')
     user_group_types = [
         {'id': 100, 'label': 'Admin'},
         {'id': 80, 'label': 'Manager'},
@@ -99,9 +91,7 @@ def client_config(request):
         {'id': 40, 'label': 'Owner'},
         {'id': 10, 'label': 'Viewer'}]
 
-    contributor_role_types = [
-        {'id': v['key'], 'label': v['label']}
-        for v in TypeResource(request.dbsession, 'contributorRole').to_dict()['values']]
+    contributor_role_types = scheme_values(request, 'contributor_role')
 
 
     # palette generated by http://mcg.mbitson.com
@@ -138,3 +128,25 @@ def client_config(request):
         token = request.create_jwt_token(dev_user_id, principals=principals)
         result['dev_user'] = {'user': dev_user_id, 'token': token}
     return result
+
+def system_factory(request):
+    return SystemResource(request.registry)
+
+pool_status = Service(name='PoolStatus',
+                      path='/api/v1/client/pool',
+                      factory=system_factory,
+                      api_security=[{'jwt':[]}],
+                      tags=['config'],
+                      response_schemas={
+    '200': PoolStatusResponseSchema(description='Ok'),
+    '401': ErrorResponseSchema(description='Unauthorized'),
+    '403': ErrorResponseSchema(description='Forbidden')})
+
+@pool_status.get(permission='view')
+def pool_status_view(request):
+    "Connection pool statistics per engine, including usage of this namespace"
+    namespace = request.repository.namespace
+    pools = {}
+    for name, monitor in request.registry['pool_monitors'].items():
+        pools[name] = monitor.status(namespace=namespace)
+    return {'status': 'ok', 'pools': pools}
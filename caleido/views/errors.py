@@ -0,0 +1,25 @@
+from pyramid.view import view_config
+
+from caleido.exceptions import (InvalidCursor,
+                                QueryBudgetExceeded,
+                                StatementTimeout)
+
+def error_response(request, status, name, description, location='request'):
+    request.response.status = status
+    return {'status': 'error',
+            'errors': [{'location': location,
+                        'name': name,
+                        'description': description}]}
+
+@view_config(context=InvalidCursor, renderer='json')
+def invalid_cursor_view(exc, request):
+    return error_response(request, 400, 'cursor', str(exc),
+                          location='querystring')
+
+@view_config(context=QueryBudgetExceeded, renderer='json')
+def query_budget_exceeded_view(exc, request):
+    return error_response(request, 503, 'query_budget', str(exc))
+
+@view_config(context=StatementTimeout, renderer='json')
+def statement_timeout_view(exc, request):
+    return error_response(request, 504, 'statement_timeout', str(exc))
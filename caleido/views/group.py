@@ -8,7 +8,8 @@ from cornice.validators import colander_validator
 from cornice import Service
 
 from caleido.models import Group, Membership, Affiliation
-from caleido.resources import ResourceFactory, GroupResource
+from caleido.resources import (
+    ResourceFactory, GroupResource, contains_text, group_filter)
 
 from caleido.exceptions import StorageError
 from caleido.utils import (ErrorResponseSchema,
@@ -16,7 +17,11 @@ from caleido.utils import (ErrorResponseSchema,
                            OKStatusResponseSchema,
                            OKStatus,
                            JsonMappingSchemaSerializerMixin,
-                           colander_bound_repository_body_validator)
+                           colander_bound_repository_body_validator,
+                           cursor_validator,
+                           TotalMode,
+                           TypeaheadRequestSchema,
+                           TypeaheadResponseSchema)
 
 @colander.deferred
 def deferred_group_type_validator(node, kw):
@@ -68,9 +73,11 @@ class GroupListingResponseSchema(colander.MappingSchema):
     @colander.instantiate()
     class body(colander.MappingSchema):
         status = OKStatus
-        total = colander.SchemaNode(colander.Int())
+        total = colander.SchemaNode(colander.Int(), missing=None)
         offset = colander.SchemaNode(colander.Int())
         limit = colander.SchemaNode(colander.Int())
+        cursor = colander.SchemaNode(colander.String(),
+                                     missing=colander.drop)
 
         @colander.instantiate()
         class records(colander.SequenceSchema):
@@ -95,6 +102,10 @@ class GroupListingRequestSchema(colander.MappingSchema):
                                           missing=colander.drop)
         filter_parent = colander.SchemaNode(colander.Int(),
                                             missing=colander.drop)
+        filter_subtree = colander.SchemaNode(colander.Int(),
+                                             missing=colander.drop)
+        filter_ancestors = colander.SchemaNode(colander.Int(),
+                                               missing=colander.drop)
         offset = colander.SchemaNode(colander.Int(),
                                    default=0,
                                    validator=colander.Range(min=0),
@@ -103,6 +114,10 @@ class GroupListingRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
+        cursor = colander.SchemaNode(colander.String(),
+                                     validator=cursor_validator,
+                                     missing=colander.drop)
         format = colander.SchemaNode(
             colander.String(),
             validator=colander.OneOf(['record', 'snippet']),
@@ -121,6 +136,7 @@ class GroupSearchRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
 
 class GroupBulkRequestSchema(colander.MappingSchema):
     @colander.instantiate()
@@ -225,7 +241,7 @@ class GroupRecordAPI(object):
         query = self.request.validated['querystring'].get('query')
         filters = []
         if query:
-            filters.append(Group.name.ilike('%%%s%%' % query))
+            filters.append(contains_text(Group.name, query))
         filter_type = self.request.validated['querystring'].get('filter_type')
         if filter_type:
             filter_types = filter_type.split(',')
@@ -233,6 +249,20 @@ class GroupRecordAPI(object):
         filter_parent = self.request.validated['querystring'].get('filter_parent')
         if filter_parent:
             filters.append(Group.parent_id == filter_parent)
+        # the group and all groups below it
+        filter_subtree = self.request.validated['querystring'].get(
+            'filter_subtree')
+        if filter_subtree:
+            filters.append(group_filter(Group.id,
+                                        [filter_subtree],
+                                        transitive=True))
+        # the group and all groups above it
+        filter_ancestors = self.request.validated['querystring'].get(
+            'filter_ancestors')
+        if filter_ancestors:
+            filters.append(group_filter(Group.id,
+                                        [filter_ancestors],
+                                        ancestors=True))
 
         from_query=None
         query_callback = None
@@ -261,7 +291,8 @@ class GroupRecordAPI(object):
                     filtered_memberships,
                     func.count(Affiliation.work_id.distinct()).label('work_count'),
                     ).outerjoin(Affiliation).group_by(filtered_memberships)
-                return with_work_counts
+                return with_work_counts.order_by(filtered_memberships.c.name,
+                                                 filtered_memberships.c.id)
 
 
 
@@ -273,7 +304,10 @@ class GroupRecordAPI(object):
             format=format,
             from_query=from_query,
             post_query_callback=query_callback,
-            principals=self.request.effective_principals)
+            principals=self.request.effective_principals,
+            cursor=self.request.validated['querystring'].get('cursor'),
+            cursor_key=lambda group: [group.name],
+            total_mode=self.request.validated['querystring']['total'])
         schema = GroupSchema()
         result = {'total': listing['total'],
                   'records': [],
@@ -281,6 +315,8 @@ class GroupRecordAPI(object):
                   'limit': limit,
                   'offset': offset,
                   'status': 'ok'}
+        if listing['cursor']:
+            result['cursor'] = listing['cursor']
 
         if format == 'snippet':
             snippets = []
@@ -348,7 +384,7 @@ def group_search_view(request):
     query = request.validated['querystring'].get('query')
     filters = []
     if query:
-        filters.append(Group.name.ilike('%%%s%%' % query))
+        filters.append(contains_text(Group.name, query))
     from_query = request.context.session.query(Group)
     from_query = from_query.options(
         Load(Group).load_only('id', 'name'))
@@ -371,7 +407,8 @@ def group_search_view(request):
         format=format,
         from_query=from_query,
         post_query_callback=query_callback,
-        principals=['group:editor'])
+        principals=['group:editor'],
+        total_mode=request.validated['querystring']['total'])
     snippets = []
     for hit in listing['hits']:
         snippets.append({'id': hit.id,
@@ -383,3 +420,25 @@ def group_search_view(request):
             'offset': offset,
             'status': 'ok'}
 
+
+group_typeahead = Service(name='GroupTypeahead',
+                     path='/api/v1/group/typeahead',
+                     factory=ResourceFactory(GroupResource),
+                     api_security=[{'jwt':[]}],
+                     tags=['group'],
+                     cors_origins=('*', ),
+                     schema=TypeaheadRequestSchema(),
+                     validators=(colander_validator,),
+                     response_schemas={
+    '200': TypeaheadResponseSchema(description='Ok'),
+    '400': ErrorResponseSchema(description='Bad Request'),
+    '401': ErrorResponseSchema(description='Unauthorized')})
+
+@group_typeahead.get(permission='search')
+def group_typeahead_view(request):
+    query = request.validated['querystring']['query']
+    limit = request.validated['querystring']['limit']
+    # like the search listing, typeahead lists with editor principals
+    hits = request.context.typeahead(query, ['group:editor'], limit=limit)
+    return {'snippets': [{'id': id, 'name': name} for id, name in hits],
+            'status': 'ok'}
@@ -1,15 +1,15 @@
 import datetime
 
-from intervals import DateInterval
 import colander
-import sqlalchemy as sql
 from sqlalchemy import func
 from cornice.resource import resource, view
 from cornice.validators import colander_validator
 from cornice import Service
 
 from caleido.models import Membership, Person, Group, Contributor
-from caleido.resources import ResourceFactory, MembershipResource, GroupResource
+from caleido.resources import (
+    ResourceFactory, MembershipResource, contains_text, any_of, group_filter,
+    overlaps)
 
 from caleido.exceptions import StorageError
 from caleido.utils import (ErrorResponseSchema,
@@ -18,7 +18,8 @@ from caleido.utils import (ErrorResponseSchema,
                            OKStatus,
                            JsonMappingSchemaSerializerMixin,
                            colander_bound_repository_body_validator,
-                           )
+                           TotalMode,
+                           IdList)
 
 class MembershipSchema(colander.MappingSchema, JsonMappingSchemaSerializerMixin):
     id = colander.SchemaNode(colander.Int())
@@ -44,7 +45,7 @@ class MembershipListingResponseSchema(colander.MappingSchema):
     @colander.instantiate()
     class body(colander.MappingSchema):
         status = OKStatus
-        total = colander.SchemaNode(colander.Int())
+        total = colander.SchemaNode(colander.Int(), missing=None)
         offset = colander.SchemaNode(colander.Int())
         limit = colander.SchemaNode(colander.Int())
 
@@ -83,14 +84,17 @@ class MembershipListingRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
         query = colander.SchemaNode(colander.String(),
                                     missing=colander.drop)
-        person_id = colander.SchemaNode(colander.Int(),
+        person_id = colander.SchemaNode(IdList(),
                                         missing=colander.drop)
-        group_id = colander.SchemaNode(colander.Int(),
+        group_id = colander.SchemaNode(IdList(),
                                        missing=colander.drop)
         transitive = colander.SchemaNode(colander.Boolean(),
                                        missing=False)
+        ancestors = colander.SchemaNode(colander.Boolean(),
+                                        missing=False)
         start_date = colander.SchemaNode(colander.Date(),
                                          missing=colander.drop)
         end_date = colander.SchemaNode(colander.Date(),
@@ -198,29 +202,24 @@ class MembershipRecordAPI(object):
         qs = self.request.validated['querystring']
         offset = qs['offset']
         limit = qs['limit']
-        person_id = qs.get('person_id')
-        group_id = qs.get('group_id')
+        person_ids = qs.get('person_id')
+        group_ids = qs.get('group_id')
         format = qs.get('format')
         order_by = []
         query = qs.get('query')
         filters = []
-        if person_id:
-            filters.append(Membership.person_id == person_id)
+        if person_ids:
+            filters.append(any_of(Membership.person_id, person_ids))
         if qs.get('start_date') or qs.get('end_date'):
-            duration = DateInterval([qs.get('start_date'),
-                                     qs.get('end_date')])
-            filters.append(Membership.during.op('&&')(duration))
-
-        if group_id:
-            if qs['transitive']:
-                # find
-                group_ids = [group_id]
-                group_ids.extend(ResourceFactory(GroupResource)(
-                    self.request, group_id).child_groups())
-                filters.append(
-                    sql.or_(*[Membership.group_id == g for g in group_ids]))
-            else:
-                filters.append(Membership.group_id == group_id)
+            filters.append(overlaps(Membership.during,
+                                    qs.get('start_date'),
+                                    qs.get('end_date')))
+
+        if group_ids:
+            filters.append(group_filter(Membership.group_id,
+                                        group_ids,
+                                        transitive=qs['transitive'],
+                                        ancestors=qs['ancestors']))
 
 
         cte_total = None
@@ -245,9 +244,9 @@ class MembershipRecordAPI(object):
                     Person.id.label('person_id'),
                     Person.name.label('person_name')).join(
                     Person).join(Group).outerjoin(Person.contributors)
-                if query and group_id:
+                if query and group_ids:
                     with_members = with_members.filter(
-                        Person.family_name.ilike('%%%s%%' % query))
+                        contains_text(Person.family_name, query))
                 with_members = with_members.group_by(Person.id,
                                                      Person.name)
                 return with_members.order_by(Person.name)
@@ -260,7 +259,8 @@ class MembershipRecordAPI(object):
             order_by=order_by,
             post_query_callback=query_callback,
             apply_limits_post_query={'snippet': True}.get(format, False),
-            principals=self.request.effective_principals)
+            principals=self.request.effective_principals,
+            total_mode=self.request.validated['querystring']['total'])
         schema = MembershipSchema()
         result = {'total': listing['total'] or cte_total,
                   'records': [],
@@ -328,14 +328,14 @@ def membership_listing_view(request):
                   order_by = qs.get('order_by'),
                   start_date = qs.get('start_date'),
                   end_date = qs.get('end_date'),
+                  total_mode = qs['total'],
                   principals=request.effective_principals)
 
     if qs.get('person_id'):
-        params['person_ids'] = [qs['person_id']]
+        params['person_ids'] = qs['person_id']
     if qs.get('group_id'):
-        params['group_ids'] = [qs['group_id']]
-        params['group_ids'].extend(ResourceFactory(GroupResource)(
-            request, qs['group_id']).child_groups())
+        params['group_ids'] = qs['group_id']
+        params['ancestors'] = qs['ancestors']
 
     result = request.context.listing(**params)
     result['snippets'] = result.pop('hits')
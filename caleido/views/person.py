@@ -16,7 +16,10 @@ from caleido.utils import (ErrorResponseSchema,
                            OKStatusResponseSchema,
                            OKStatus,
                            JsonMappingSchemaSerializerMixin,
-                           colander_bound_repository_body_validator)
+                           colander_bound_repository_body_validator,
+                           TotalMode,
+                           TypeaheadRequestSchema,
+                           TypeaheadResponseSchema)
 
 @colander.deferred
 def deferred_account_type_validator(node, kw):
@@ -101,7 +104,7 @@ class PersonListingResponseSchema(colander.MappingSchema):
     @colander.instantiate()
     class body(colander.MappingSchema):
         status = OKStatus
-        total = colander.SchemaNode(colander.Int())
+        total = colander.SchemaNode(colander.Int(), missing=None)
         offset = colander.SchemaNode(colander.Int())
         limit = colander.SchemaNode(colander.Int())
 
@@ -139,6 +142,7 @@ class PersonListingRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
         format = colander.SchemaNode(
             colander.String(),
             validator=colander.OneOf(['record', 'snippet']),
@@ -157,6 +161,7 @@ class PersonSearchRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
 
 class PersonBulkRequestSchema(colander.MappingSchema):
     @colander.instantiate()
@@ -294,7 +299,8 @@ class PersonRecordAPI(object):
             format=format,
             from_query=from_query,
             post_query_callback=query_callback,
-            principals=self.request.effective_principals)
+            principals=self.request.effective_principals,
+            total_mode=self.request.validated['querystring']['total'])
         schema = PersonSchema()
         result = {'total': listing['total'],
                   'records': [],
@@ -397,7 +403,8 @@ def person_search_view(request):
         format=format,
         from_query=from_query,
         post_query_callback=query_callback,
-        principals=['group:editor'])
+        principals=['group:editor'],
+        total_mode=request.validated['querystring']['total'])
     snippets = []
     for hit in listing['hits']:
         if hit.membership_count == 0:
@@ -417,3 +424,25 @@ def person_search_view(request):
             'offset': offset,
             'status': 'ok'}
 
+
+person_typeahead = Service(name='PersonTypeahead',
+                     path='/api/v1/person/typeahead',
+                     factory=ResourceFactory(PersonResource),
+                     api_security=[{'jwt':[]}],
+                     tags=['person'],
+                     cors_origins=('*', ),
+                     schema=TypeaheadRequestSchema(),
+                     validators=(colander_validator,),
+                     response_schemas={
+    '200': TypeaheadResponseSchema(description='Ok'),
+    '400': ErrorResponseSchema(description='Bad Request'),
+    '401': ErrorResponseSchema(description='Unauthorized')})
+
+@person_typeahead.get(permission='search')
+def person_typeahead_view(request):
+    query = request.validated['querystring']['query']
+    limit = request.validated['querystring']['limit']
+    # like the search listing, typeahead lists with editor principals
+    hits = request.context.typeahead(query, ['group:editor'], limit=limit)
+    return {'snippets': [{'id': id, 'name': name} for id, name in hits],
+            'status': 'ok'}
@@ -71,6 +71,7 @@ class TypeAPI(object):
     def put(self):
         "Update a Type Scheme"
         self.context.from_dict(self.request.validated)
+        self.request.repository.schemes_changed()
         return TypeSchema().serialize(self.context.to_dict())
 
 
@@ -9,7 +9,8 @@ from caleido.exceptions import StorageError
 from caleido.utils import (ErrorResponseSchema,
                            StatusResponseSchema,
                            OKStatus,
-                           JsonMappingSchemaSerializerMixin)
+                           JsonMappingSchemaSerializerMixin,
+                           TotalMode)
 
 
 def owner_validator(node, kw):
@@ -47,7 +48,7 @@ class UserListingResponseSchema(colander.MappingSchema):
         class records(colander.SequenceSchema):
             user = UserSchema()
         status = OKStatus
-        total = colander.SchemaNode(colander.Int())
+        total = colander.SchemaNode(colander.Int(), missing=None)
         offset = colander.SchemaNode(colander.Int())
         limit = colander.SchemaNode(colander.Int())
 
@@ -64,6 +65,7 @@ class UserListingRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
         format = colander.SchemaNode(
             colander.String(),
             validator=colander.OneOf(['record', 'snippet']),
@@ -181,7 +183,8 @@ class UserAPI(object):
             limit=limit,
             order_by=order_by,
             format=format,
-            principals=self.request.effective_principals)
+            principals=self.request.effective_principals,
+            total_mode=self.request.validated['querystring']['total'])
 
         schema = UserSchema()
         result = {'total': listing['total'],
@@ -1,4 +1,3 @@
-from intervals import DateInterval
 import datetime
 
 import colander
@@ -11,7 +10,8 @@ from cornice.validators import colander_validator
 from cornice import Service
 
 from caleido.models import Work, Contributor, Affiliation, Person, Group
-from caleido.resources import ResourceFactory, WorkResource, GroupResource
+from caleido.resources import (
+    ResourceFactory, WorkResource, WORK_FACETS, overlaps)
 
 from caleido.exceptions import StorageError
 from caleido.utils import (ErrorResponseSchema,
@@ -19,7 +19,12 @@ from caleido.utils import (ErrorResponseSchema,
                            OKStatusResponseSchema,
                            OKStatus,
                            JsonMappingSchemaSerializerMixin,
-                           colander_bound_repository_body_validator)
+                           colander_bound_repository_body_validator,
+                           cursor_validator,
+                           TotalMode,
+                           TypeaheadRequestSchema,
+                           TypeaheadResponseSchema,
+                           IdList)
 
 @colander.deferred
 def deferred_work_type_validator(node, kw):
@@ -170,13 +175,30 @@ class WorkPostSchema(WorkSchema):
 class WorkResponseSchema(colander.MappingSchema):
     body = WorkSchema()
 
+class FacetBucketsSchema(colander.SequenceSchema):
+    @colander.instantiate()
+    class bucket(colander.MappingSchema):
+        value = colander.SchemaNode(colander.String())
+        name = colander.SchemaNode(colander.String(), missing=colander.drop)
+        count = colander.SchemaNode(colander.Int())
+
+class IntFacetBucketsSchema(colander.SequenceSchema):
+    # buckets of years and group ids
+    @colander.instantiate()
+    class bucket(colander.MappingSchema):
+        value = colander.SchemaNode(colander.Int())
+        name = colander.SchemaNode(colander.String(), missing=colander.drop)
+        count = colander.SchemaNode(colander.Int())
+
 class WorkListingResponseSchema(colander.MappingSchema):
     @colander.instantiate()
     class body(colander.MappingSchema):
         status = OKStatus
-        total = colander.SchemaNode(colander.Int())
+        total = colander.SchemaNode(colander.Int(), missing=None)
         offset = colander.SchemaNode(colander.Int())
         limit = colander.SchemaNode(colander.Int())
+        cursor = colander.SchemaNode(colander.String(),
+                                     missing=colander.drop)
 
         @colander.instantiate()
         class records(colander.SequenceSchema):
@@ -205,6 +227,19 @@ class WorkListingResponseSchema(colander.MappingSchema):
                         id = colander.SchemaNode(colander.Int())
                         name = colander.SchemaNode(colander.String())
 
+        @colander.instantiate(missing=colander.drop)
+        class facets(colander.MappingSchema):
+            type = FacetBucketsSchema(missing=colander.drop)
+            year = IntFacetBucketsSchema(missing=colander.drop)
+            affiliation = IntFacetBucketsSchema(missing=colander.drop)
+
+def facets_validator(node, value):
+    for facet in value.split(','):
+        if facet not in WORK_FACETS:
+            raise colander.Invalid(
+                node, '"%s" is not one of %s' % (facet,
+                                                 ', '.join(WORK_FACETS)))
+
 class WorkListingRequestSchema(colander.MappingSchema):
     @colander.instantiate()
     class querystring(colander.MappingSchema):
@@ -214,13 +249,15 @@ class WorkListingRequestSchema(colander.MappingSchema):
                                           missing=colander.drop)
         start_date = colander.SchemaNode(colander.Date(), missing=None)
         end_date = colander.SchemaNode(colander.Date(), missing=None)
-        contributor_person_id = colander.SchemaNode(colander.Integer(),
+        contributor_person_id = colander.SchemaNode(IdList(),
                                                     missing=colander.drop)
-        contributor_group_id = colander.SchemaNode(colander.Integer(),
+        contributor_group_id = colander.SchemaNode(IdList(),
                                                    missing=colander.drop)
-        affiliation_group_id = colander.SchemaNode(colander.Integer(),
+        affiliation_group_id = colander.SchemaNode(IdList(),
                                                    missing=colander.drop)
-        related_work_id = colander.SchemaNode(colander.Integer(),
+        affiliation_ancestors = colander.SchemaNode(colander.Boolean(),
+                                                    missing=False)
+        related_work_id = colander.SchemaNode(IdList(),
                                               missing=colander.drop)
         offset = colander.SchemaNode(colander.Int(),
                                    default=0,
@@ -230,10 +267,21 @@ class WorkListingRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
+        cursor = colander.SchemaNode(colander.String(),
+                                     validator=cursor_validator,
+                                     missing=colander.drop)
         format = colander.SchemaNode(
             colander.String(),
             validator=colander.OneOf(['snippet', 'csl']),
             missing=colander.drop)
+        facets = colander.SchemaNode(colander.String(),
+                                     validator=facets_validator,
+                                     missing=colander.drop)
+        facet_size = colander.SchemaNode(colander.Int(),
+                                         default=10,
+                                         validator=colander.Range(1, 100),
+                                         missing=10)
 
 class WorkSearchRequestSchema(colander.MappingSchema):
     @colander.instantiate()
@@ -250,12 +298,76 @@ class WorkSearchRequestSchema(colander.MappingSchema):
                                     default=20,
                                     validator=colander.Range(0, 100),
                                     missing=20)
+        total = TotalMode
 
 class WorkBulkRequestSchema(colander.MappingSchema):
     @colander.instantiate()
     class records(colander.SequenceSchema):
         work = WorkSchema()
 
+class WorkGraphRequestSchema(colander.MappingSchema):
+    @colander.instantiate()
+    class querystring(colander.MappingSchema):
+        depth = colander.SchemaNode(colander.Int(),
+                                    default=1,
+                                    validator=colander.Range(1, 3),
+                                    missing=1)
+        relation_type = colander.SchemaNode(colander.String(),
+                                            missing=colander.drop)
+        direction = colander.SchemaNode(
+            colander.String(),
+            validator=colander.OneOf(['both', 'outgoing', 'incoming']),
+            missing='both')
+        limit = colander.SchemaNode(colander.Int(),
+                                    default=100,
+                                    validator=colander.Range(1, 1000),
+                                    missing=100)
+
+class WorkGraphResponseSchema(colander.MappingSchema):
+    @colander.instantiate()
+    class body(colander.MappingSchema):
+        status = OKStatus
+
+        @colander.instantiate()
+        class nodes(colander.SequenceSchema):
+            @colander.instantiate()
+            class node(colander.MappingSchema):
+                id = colander.SchemaNode(colander.Int())
+                depth = colander.SchemaNode(colander.Int())
+                title = colander.SchemaNode(colander.String())
+                type = colander.SchemaNode(colander.String())
+
+                @colander.instantiate()
+                class relations(colander.SequenceSchema):
+                    @colander.instantiate()
+                    class relation(colander.MappingSchema):
+                        type = colander.SchemaNode(colander.String())
+                        target_id = colander.SchemaNode(colander.Int())
+
+class IdentifierResolveRequestSchema(colander.MappingSchema):
+    @colander.instantiate(validator=colander.Length(1, 10000))
+    class identifiers(colander.SequenceSchema):
+        @colander.instantiate()
+        class identifier(colander.MappingSchema):
+            type = colander.SchemaNode(colander.String())
+            value = colander.SchemaNode(colander.String())
+
+class IdentifierResolveResponseSchema(colander.MappingSchema):
+    @colander.instantiate()
+    class body(colander.MappingSchema):
+        status = OKStatus
+
+        @colander.instantiate()
+        class identifiers(colander.SequenceSchema):
+            @colander.instantiate()
+            class identifier(colander.MappingSchema):
+                type = colander.SchemaNode(colander.String())
+                value = colander.SchemaNode(colander.String())
+
+                @colander.instantiate()
+                class work_ids(colander.SequenceSchema):
+                    work_id = colander.SchemaNode(colander.Int())
+
 @resource(name='Work',
           collection_path='/api/v1/work/records',
           path='/api/v1/work/records/{id}',
@@ -346,17 +458,21 @@ class WorkRecordAPI(object):
         '400': ErrorResponseSchema(description='Bad Request'),
         '401': ErrorResponseSchema(description='Unauthorized')})
     def collection_get(self):
+        "List Works, the most recently issued first"
         qs = self.request.validated['querystring']
         offset = qs['offset']
         limit = qs['limit']
-        order_by = [func.lower(Work.during).desc()]
+        # the records are sorted on issued and id with or without a cursor,
+        # so all pages of a listing use the same order. issued is never
+        # null, unlike the lower bound of during which was sorted on before
+        order_by = [Work.issued.desc()]
         format = qs.get('format')
         query = qs.get('query')
         filters = []
         if qs.get('start_date') or qs.get('end_date'):
-            duration = DateInterval([qs.get('start_date'),
-                                     qs.get('end_date')])
-            filters.append(Work.during.op('&&')(duration))
+            filters.append(overlaps(Work.during,
+                                    qs.get('start_date'),
+                                    qs.get('end_date')))
         if query:
             filters.append(Work.search_terms.match(query))
         filter_type = self.request.validated['querystring'].get('filter_type')
@@ -372,7 +488,10 @@ class WorkRecordAPI(object):
             order_by=order_by,
             format=format,
             from_query=from_query,
-            principals=self.request.effective_principals)
+            principals=self.request.effective_principals,
+            cursor=qs.get('cursor'),
+            cursor_key=lambda work: [work.issued],
+            total_mode=self.request.validated['querystring']['total'])
         schema = WorkSchema()
         result = {'total': listing['total'],
                   'records': [schema.to_json(work.to_dict())
@@ -381,6 +500,8 @@ class WorkRecordAPI(object):
                   'limit': limit,
                   'offset': offset,
                   'status': 'ok'}
+        if listing['cursor']:
+            result['cursor'] = listing['cursor']
         return result
 
 work_bulk = Service(name='WorkBulk',
@@ -436,17 +557,21 @@ def work_listing_view(request):
                   start_date = qs.get('start_date'),
                   end_date = qs.get('end_date'),
                   type = qs.get('filter_type'),
+                  cursor = qs.get('cursor'),
+                  total_mode = qs['total'],
                   principals=request.effective_principals)
+    if qs.get('facets'):
+        params['facets'] = qs['facets'].split(',')
+        params['facet_size'] = qs['facet_size']
     if qs.get('contributor_person_id'):
-        params['contributor_person_ids'] = [qs['contributor_person_id']]
+        params['contributor_person_ids'] = qs['contributor_person_id']
     if qs.get('contributor_group_id'):
-        params['contributor_group_ids'] = [qs['contributor_group_id']]
+        params['contributor_group_ids'] = qs['contributor_group_id']
     if qs.get('affiliation_group_id'):
-        params['affiliation_group_ids'] = [qs['affiliation_group_id']]
-        params['affiliation_group_ids'].extend(ResourceFactory(GroupResource)(
-            request, qs['affiliation_group_id']).child_groups())
+        params['affiliation_group_ids'] = qs['affiliation_group_id']
+        params['affiliation_ancestors'] = qs['affiliation_ancestors']
     if qs.get('related_work_id'):
-        params['related_work_ids'] = [qs['related_work_id']]
+        params['related_work_ids'] = qs['related_work_id']
 
     result = request.context.listing(**params)
 
@@ -534,7 +659,10 @@ def work_search_view(request):
     type = request.validated['querystring'].get('type')
     filters = []
     if query:
-        filters.append(Work.search_terms.match(query))
+        ts_query = func.to_tsquery(query)
+        filters.append(Work.search_terms.op('@@')(ts_query))
+        # best matches first, title matches rank above contributors etc.
+        order_by.insert(0, func.ts_rank_cd(Work.search_terms, ts_query).desc())
     if type:
         filters.append(Work.type == type)
     from_query = request.context.session.query(Work)
@@ -549,7 +677,8 @@ def work_search_view(request):
         order_by=order_by,
         format=format,
         from_query=from_query,
-        principals=['group:editor'])
+        principals=['group:editor'],
+        total_mode=request.validated['querystring']['total'])
     snippets = []
     for hit in listing['hits']:
         snippets.append({'id': hit.id,
@@ -561,3 +690,80 @@ def work_search_view(request):
             'offset': offset,
             'status': 'ok'}
 
+
+work_typeahead = Service(name='WorkTypeahead',
+                     path='/api/v1/work/typeahead',
+                     factory=ResourceFactory(WorkResource),
+                     api_security=[{'jwt':[]}],
+                     tags=['work'],
+                     cors_origins=('*', ),
+                     schema=TypeaheadRequestSchema(),
+                     validators=(colander_validator,),
+                     response_schemas={
+    '200': TypeaheadResponseSchema(description='Ok'),
+    '400': ErrorResponseSchema(description='Bad Request'),
+    '401': ErrorResponseSchema(description='Unauthorized')})
+
+@work_typeahead.get(permission='search')
+def work_typeahead_view(request):
+    query = request.validated['querystring']['query']
+    limit = request.validated['querystring']['limit']
+    # like the search listing, typeahead lists with editor principals
+    hits = request.context.typeahead(query, ['group:editor'], limit=limit)
+    return {'snippets': [{'id': id, 'name': name} for id, name in hits],
+            'status': 'ok'}
+
+work_identifier_resolve = Service(
+    name='WorkIdentifierResolve',
+    path='/api/v1/work/identifiers/resolve',
+    factory=ResourceFactory(WorkResource),
+    api_security=[{'jwt':[]}],
+    tags=['work'],
+    cors_origins=('*', ),
+    schema=IdentifierResolveRequestSchema(),
+    validators=(colander_bound_repository_body_validator,),
+    response_schemas={
+    '200': IdentifierResolveResponseSchema(description='Ok'),
+    '400': ErrorResponseSchema(description='Bad Request'),
+    '401': ErrorResponseSchema(description='Unauthorized'),
+    '403': ErrorResponseSchema(description='Forbidden')})
+
+@work_identifier_resolve.post(permission='import')
+def work_identifier_resolve_view(request):
+    "Resolve a batch of identifiers to the ids of the works having them"
+    identifiers = [(i['type'], i['value'])
+                   for i in request.validated['identifiers']]
+    work_ids = request.context.resolve_identifiers(identifiers)
+    return {'identifiers': [
+        {'type': type, 'value': value, 'work_ids': ids}
+        for (type, value), ids in zip(identifiers, work_ids)],
+            'status': 'ok'}
+
+work_graph = Service(name='WorkGraph',
+                     path='/api/v1/work/records/{id}/graph',
+                     factory=ResourceFactory(WorkResource),
+                     api_security=[{'jwt':[]}],
+                     tags=['work'],
+                     cors_origins=('*', ),
+                     schema=WorkGraphRequestSchema(),
+                     validators=(colander_validator,),
+                     response_schemas={
+    '200': WorkGraphResponseSchema(description='Ok'),
+    '400': ErrorResponseSchema(description='Bad Request'),
+    '401': ErrorResponseSchema(description='Unauthorized'),
+    '403': ErrorResponseSchema(description='Forbidden'),
+    '404': ErrorResponseSchema(description='Not Found')})
+
+@work_graph.get(permission='view')
+def work_graph_view(request):
+    "The works related to a work, following relations up to a depth"
+    qs = request.validated['querystring']
+    relation_types = None
+    if qs.get('relation_type'):
+        relation_types = qs['relation_type'].split(',')
+    nodes = request.context.graph(depth=qs['depth'],
+                                  relation_types=relation_types,
+                                  direction=qs['direction'],
+                                  limit=qs['limit'],
+                                  principals=request.effective_principals)
+    return {'nodes': nodes, 'status': 'ok'}
@@ -34,6 +34,9 @@ setup(name='caleido',
       [console_scripts]
       initialize_db = caleido.tools:initialize_db
       drop_db = caleido.tools:drop_db
+      rebuild_search_terms = caleido.tools:rebuild_search_terms
+      rebuild_group_closure = caleido.tools:rebuild_group_closure
+      normalize_identifiers = caleido.tools:normalize_identifiers
       bigquery_schema = caleido.tools:bigquery_schema
       """,
       paster_plugins=['pyramid'])
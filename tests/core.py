@@ -31,8 +31,11 @@ class BaseTest(unittest.TestCase):
         if 'unittest' in storage.repository_info(self.session):
             storage.drop_repository(self.session, 'unittest')
             transaction.commit()
-        storage.create_repository(self.session, 'unittest', 'unittest.localhost')
-        storage.initialize_repository(self.session, 'unittest', 'admin', 'admin')
+        storage.provision_repository(self.session,
+                                     'unittest',
+                                     'unittest.localhost',
+                                     'admin',
+                                     'admin')
         transaction.commit()
 
     def admin_token(self):
@@ -50,7 +53,8 @@ class BaseTest(unittest.TestCase):
                  'password': user_group_password}
                 ,status=[200, 401])
         if response.status_code == 401:
-            context = UserResource(self.storage.registry, self.session)
+            context = UserResource(self.storage.registry,
+                                   self.storage.make_session('unittest'))
             context.put(
                 User(userid=user_group_password,
                      credentials=user_group_password,
@@ -1,7 +1,11 @@
 import transaction
+from zope.sqlalchemy import mark_changed
 
 from core import BaseTest
-from caleido.models import User
+from caleido.models import User, GroupClosure
+from caleido.closure import rebuild_group_closure
+from caleido.resources import GroupResource, PersonResource
+from caleido.security import BasicAuthenticator
 
 class GroupWebTest(BaseTest):
 
@@ -290,6 +294,56 @@ class GroupRetrievalWebTest(GroupWebTest):
             '/api/v1/group/records?query=Department',
             headers=headers, status=200)
         assert out.json['total'] == 1
+        out = self.api.get(
+            '/api/v1/group/records?query=partment',
+            headers=headers, status=200)
+        assert out.json['total'] == 1
+        # like wildcards are matched literally
+        out = self.api.get(
+            '/api/v1/group/records?query=%25',
+            headers=headers, status=200)
+        assert out.json['total'] == 0
+        out = self.api.get(
+            '/api/v1/group/search?query=Dep_rtment',
+            headers=headers, status=200)
+        assert out.json['total'] == 0
+
+    def test_typeahead(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.get('/api/v1/group/typeahead?query=dep',
+                           headers=headers, status=200)
+        assert out.json['snippets'] == [
+            {'id': self.dept_id, 'name': 'Department A'}]
+        out = self.api.get('/api/v1/group/typeahead?query=CORP',
+                           headers=headers, status=200)
+        assert [s['id'] for s in out.json['snippets']] == [self.corp_id]
+        # only prefixes match
+        out = self.api.get('/api/v1/group/typeahead?query=partment',
+                           headers=headers, status=200)
+        assert out.json['snippets'] == []
+        out = self.api.get('/api/v1/group/typeahead?query=%25',
+                           headers=headers, status=200)
+        assert out.json['snippets'] == []
+        out = self.api.get('/api/v1/person/typeahead?query=doe&limit=1',
+                           headers=headers, status=200)
+        assert [s['id'] for s in out.json['snippets']] == [self.john_id]
+        self.api.get('/api/v1/group/typeahead', headers=headers, status=400)
+
+    def test_typeahead_applies_acl_filters(self):
+        session = self.storage.make_session('unittest')
+        groups = GroupResource(self.app.registry, session)
+        principals = ['owner:group:%s' % self.dept_id]
+        assert groups.typeahead('', principals) == [
+            (self.dept_id, 'Department A')]
+        assert groups.typeahead('', []) == []
+        assert [h[0] for h in groups.typeahead('', ['group:editor'])] == [
+            self.corp_id, self.dept_id]
+        # persons are visible to the owners of their groups
+        persons = PersonResource(self.app.registry, session)
+        assert persons.typeahead('doe', principals) == [
+            (self.john_id, 'Doe (John)')]
+        principals = ['owner:group:%s' % self.corp_id]
+        assert persons.typeahead('doe', principals) == []
 
     def test_group_snippet(self):
         headers = dict(Authorization='Bearer %s' % self.admin_token())
@@ -300,6 +354,28 @@ class GroupRetrievalWebTest(GroupWebTest):
         assert len(out.json.get('snippets', [])) == 1
         assert out.json['snippets'][0]['members'] == 1
 
+    def test_group_cursor_pagination(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        for format in ('record', 'snippet'):
+            out = self.api.get(
+                '/api/v1/group/records?limit=1&format=%s' % format,
+                headers=headers, status=200)
+            assert out.json['total'] == 2
+            key = '%ss' % format
+            assert out.json[key][0]['id'] == self.corp_id
+            out = self.api.get(
+                '/api/v1/group/records?limit=1&format=%s&cursor=%s' % (
+                    format, out.json['cursor']),
+                headers=headers, status=200)
+            assert out.json['total'] == 2
+            assert out.json[key][0]['id'] == self.dept_id
+            out = self.api.get(
+                '/api/v1/group/records?limit=1&format=%s&cursor=%s' % (
+                    format, out.json['cursor']),
+                headers=headers, status=200)
+            assert out.json[key] == []
+            assert 'cursor' not in out.json
+
     def test_owner_group_search(self):
         headers = dict(Authorization='Bearer %s' % self.generate_test_token('owner'))
         # all users have search permission on all groups
@@ -333,3 +409,117 @@ class GroupRetrievalWebTest(GroupWebTest):
 
 
 
+
+    def test_owners_of_reparented_groups_own_subgroups(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        group_ids = {}
+        for name, parent in [('Corp.', None),
+                             ('Other', None),
+                             ('Dept.', 'Corp.'),
+                             ('Sub.', 'Dept.')]:
+            group = {'international_name': name, 'type': 'organisation'}
+            if parent:
+                group['parent_id'] = group_ids[parent]
+            out = self.api.post_json('/api/v1/group/records',
+                                     group,
+                                     headers=headers,
+                                     status=201)
+            group_ids[name] = out.json['id']
+        # move the department with its subgroup to the other group
+        self.api.put_json('/api/v1/group/records/%s' % group_ids['Dept.'],
+                          {'id': group_ids['Dept.'],
+                           'international_name': 'Dept.',
+                           'parent_id': group_ids['Other'],
+                           'type': 'organisation'},
+                          headers=headers,
+                          status=200)
+        # a group can not become a subgroup of its own subgroup
+        out = self.api.put_json(
+            '/api/v1/group/records/%s' % group_ids['Other'],
+            {'id': group_ids['Other'],
+             'international_name': 'Other',
+             'parent_id': group_ids['Sub.'],
+             'type': 'organisation'},
+            headers=headers,
+            status=400)
+        assert out.json['errors'][0]['name'] == 'parent_id'
+        owner_headers = dict(Authorization='Bearer %s' % (
+            self.generate_test_token(
+                'owner', owners=[{'group_id': group_ids['Other']}])))
+        self.api.get('/api/v1/group/records/%s' % group_ids['Sub.'],
+                     headers=owner_headers,
+                     status=200)
+        self.api.get('/api/v1/group/records/%s' % group_ids['Corp.'],
+                     headers=owner_headers,
+                     status=403)
+        self.api.delete('/api/v1/group/records/%s' % group_ids['Sub.'],
+                        headers=headers)
+        self.api.get('/api/v1/group/records/%s' % group_ids['Dept.'],
+                     headers=owner_headers,
+                     status=200)
+
+    def test_rebuilding_the_group_closure(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.post_json('/api/v1/group/records',
+                                 {'international_name': 'Corp.',
+                                  'type': 'organisation'},
+                                 headers=headers,
+                                 status=201)
+        corp_id = out.json['id']
+        out = self.api.post_json('/api/v1/group/records',
+                                 {'international_name': 'Dept.',
+                                  'parent_id': corp_id,
+                                  'type': 'organisation'},
+                                 headers=headers,
+                                 status=201)
+        dept_id = out.json['id']
+        # a repository created before the closure table was maintained
+        session = self.storage.make_session('unittest')
+        session.execute(GroupClosure.__table__.delete())
+        mark_changed(session)
+        transaction.commit()
+        self.generate_test_token('owner', owners=[{'group_id': corp_id}])
+        session = self.storage.make_session('unittest')
+        principals = BasicAuthenticator(
+            self.app.registry, session).principals('owner')
+        # owners always own their own groups
+        assert 'owner:group:%s' % corp_id in principals
+        assert 'owner:group:%s' % dept_id not in principals
+        rebuild_group_closure(session)
+        mark_changed(session)
+        transaction.commit()
+        session = self.storage.make_session('unittest')
+        rows = session.query(GroupClosure.ancestor_id,
+                             GroupClosure.descendant_id,
+                             GroupClosure.depth).filter(
+                                 GroupClosure.descendant_id.in_(
+                                     [corp_id, dept_id])).all()
+        assert set(rows) == {(corp_id, corp_id, 0),
+                             (dept_id, dept_id, 0),
+                             (corp_id, dept_id, 1)}
+        principals = BasicAuthenticator(
+            self.app.registry, session).principals('owner')
+        assert 'owner:group:%s' % dept_id in principals
+
+    def test_filter_listing_on_subtree_and_ancestors(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        group_ids = {}
+        for name, parent in [('Corp.', None),
+                             ('Dept.', 'Corp.'),
+                             ('Sub.', 'Dept.'),
+                             ('Other', 'Corp.')]:
+            group = {'international_name': name, 'type': 'organisation'}
+            if parent:
+                group['parent_id'] = group_ids[parent]
+            out = self.api.post_json('/api/v1/group/records',
+                                     group,
+                                     headers=headers,
+                                     status=201)
+            group_ids[name] = out.json['id']
+        out = self.api.get('/api/v1/group/records?filter_subtree=%s' % (
+            group_ids['Dept.']), headers=headers)
+        assert [r['name'] for r in out.json['records']] == ['Dept.', 'Sub.']
+        out = self.api.get('/api/v1/group/records?filter_ancestors=%s' % (
+            group_ids['Sub.']), headers=headers)
+        assert [r['name'] for r in out.json['records']] == [
+            'Corp.', 'Dept.', 'Sub.']
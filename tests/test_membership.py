@@ -369,3 +369,14 @@ class MembershipRetrievalWebTest(MembershipWebTest):
             '/api/v1/membership/records?group_id=%s&transitive=true' % self.corp_id ,
             headers=headers, status=200)
         assert self.bob_id in [r['person_id'] for r in out.json['records']]
+        # the groups above a group with the ancestors flag
+        out = self.api.get(
+            '/api/v1/membership/records?group_id=%s' % self.deptx_id,
+            headers=headers, status=200)
+        assert self.john_id not in [
+            r['person_id'] for r in out.json['records']]
+        out = self.api.get(
+            '/api/v1/membership/records?group_id=%s&ancestors=true' % (
+                self.deptx_id),
+            headers=headers, status=200)
+        assert self.john_id in [r['person_id'] for r in out.json['records']]
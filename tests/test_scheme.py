@@ -1,4 +1,7 @@
+import unittest
+
 from core import BaseTest
+from caleido.storage import SchemeCache
 
 class SchemeTypeTest(BaseTest):
     def test_retrieving_and_updating_group_types(self):
@@ -43,3 +46,62 @@ class SchemeTypeTest(BaseTest):
         assert settings['title'] == 'Unittest Repository'
         assert settings['foo'] == 'bar'
 
+
+    def test_repository_info_is_cached_and_invalidated(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        cache = self.app.registry['repository_cache']
+        self.api.get('/api/v1/schemes/settings', headers=headers)
+        info = cache.get('unittest.localhost')
+        assert info['namespace'] == 'unittest'
+        settings = dict(info['settings'])
+        settings['title'] = 'Cached Repository'
+        self.api.put_json('/api/v1/schemes/settings',
+                          settings,
+                          headers=headers)
+        assert cache.get('unittest.localhost') is None
+        out = self.api.get('/api/v1/schemes/settings', headers=headers)
+        assert out.json['title'] == 'Cached Repository'
+        assert cache.get(
+            'unittest.localhost')['settings']['title'] == 'Cached Repository'
+
+
+    def test_scheme_values_are_cached_and_invalidated(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        cache = self.app.registry['scheme_cache']
+        self.api.post_json('/api/v1/group/records',
+                           {'international_name': 'Corp.',
+                            'type': 'organisation'},
+                           headers=headers,
+                           status=201)
+        revision = self.storage.repository_info(
+            self.session)['unittest']['config_revision']
+        schemes = cache.get('unittest', revision)
+        assert 'organisation' in [
+            v['key'] for v in schemes['group_type']]
+        types = self.api.get('/api/v1/schemes/types/group',
+                             headers=headers).json
+        types['values'].append(dict(key='publisher', label='Publisher'))
+        self.api.put_json('/api/v1/schemes/types/group',
+                          types,
+                          headers=headers)
+        assert cache.get('unittest', revision) is None
+        # the validator sees the new type
+        self.api.post_json('/api/v1/group/records',
+                           {'international_name': 'Publ.',
+                            'type': 'publisher'},
+                           headers=headers,
+                           status=201)
+
+
+class SchemeCacheTest(unittest.TestCase):
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = SchemeCache(max_entries=2)
+        cache.set('a', 1, {'work_type': []})
+        cache.set('b', 1, {'work_type': []})
+        assert cache.get('a', 1) is not None
+        cache.set('c', 1, {'work_type': []})
+        assert cache.get('b', 1) is None
+        assert cache.get('a', 1) is not None
+        assert cache.get('c', 1) is not None
+        cache.invalidate('a')
+        assert cache.get('a', 1) is None
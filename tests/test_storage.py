@@ -0,0 +1,554 @@
+import datetime
+from unittest import mock
+
+import sqlalchemy as sql
+import transaction
+from sqlalchemy.pool import NullPool
+from webtest import TestApp as WebTestApp
+
+from core import BaseTest
+from caleido.models import Group, Repository, Work, Membership
+from caleido.exceptions import StatementTimeout
+from caleido.monitor import QueryBudget, pool_has_capacity
+from caleido.resources import overlaps
+from caleido.storage import DEFAULTS, Explain, RepositoryConfig
+
+class ReplicaRoutingTest(BaseTest):
+    def app_settings(self):
+        settings = super(ReplicaRoutingTest, self).app_settings()
+        # use the primary database as replica, so the routing can be tested
+        settings['sqlalchemy.replica.url'] = settings['sqlalchemy.url']
+        return settings
+
+    def test_replica_schemes_are_not_cached(self):
+        cache = self.app.registry['scheme_cache']
+        session = self.storage.make_session('unittest', readonly=True)
+        config = RepositoryConfig(self.app.registry, session, 'unittest',
+                                  'http://unittest.localhost/api/v1',
+                                  config_revision=99)
+        assert config.schemes['identifier_type']
+        assert cache.get('unittest', 99) is None
+        session = self.storage.make_session('unittest')
+        config = RepositoryConfig(self.app.registry, session, 'unittest',
+                                  'http://unittest.localhost/api/v1',
+                                  config_revision=99)
+        assert config.schemes['identifier_type']
+        assert cache.get('unittest', 99) is not None
+
+    def test_replica_totals_are_not_cached(self):
+        cache = self.app.registry['count_cache']
+        session = self.storage.make_session('unittest', readonly=True)
+        total = self.storage.count(session, session.query(Group),
+                                   mapper=Group)
+        assert total() == 0
+        assert len(cache._entries) == 0
+        session = self.storage.make_session('unittest')
+        total = self.storage.count(session, session.query(Group),
+                                   mapper=Group)
+        assert total() == 0
+        assert len(cache._entries) == 1
+
+    def test_readonly_sessions_are_bound_to_replica(self):
+        registry = self.app.registry
+        assert registry['replica_engine'] is not registry['engine']
+        session = self.storage.make_session('unittest', readonly=True)
+        assert session.get_bind().url == registry['replica_engine'].url
+        assert session.get_bind().pool is registry['replica_engine'].pool
+        session = self.storage.make_session('unittest')
+        assert session.get_bind().pool is registry['engine'].pool
+
+    def test_reads_and_writes_with_replica(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.post_json('/api/v1/group/records',
+                                 {'international_name': 'Corp.',
+                                  'type': 'organisation'},
+                                 headers=headers,
+                                 status=201)
+        out = self.api.get('/api/v1/group/records/%s' % out.json['id'],
+                           headers=headers)
+        assert out.json['name'] == 'Corp.'
+
+
+class PoolStatusTest(BaseTest):
+    def test_pool_status_as_admin(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.api.get('/api/v1/group/records', headers=headers)
+        out = self.api.get('/api/v1/client/pool', headers=headers)
+        primary = out.json['pools']['primary']
+        assert primary['checkouts'] > 0
+        assert sum(b['count'] for b in primary['checkout_ms']['histogram']
+                   ) == primary['checkouts']
+        assert primary['namespaces']['unittest']['checkouts'] > 0
+        assert 'overflow' in primary
+
+    def test_pool_status_is_limited_to_the_namespace(self):
+        monitor = self.app.registry['pool_monitors']['primary']
+        monitor.tenant_checkout('othertenant', {})
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.api.get('/api/v1/group/records', headers=headers)
+        out = self.api.get('/api/v1/client/pool', headers=headers)
+        namespaces = out.json['pools']['primary']['namespaces']
+        assert list(namespaces.keys()) == ['unittest']
+
+    def test_pool_status_is_admin_only(self):
+        headers = dict(Authorization='Bearer %s' % self.generate_test_token(
+            'editor'))
+        self.api.get('/api/v1/client/pool', headers=headers, status=403)
+        self.api.get('/api/v1/client/pool', status=401)
+
+
+class ConfiguredPoolClassTest(BaseTest):
+    def app_settings(self):
+        settings = super(ConfiguredPoolClassTest, self).app_settings()
+        settings['sqlalchemy.poolclass'] = NullPool
+        return settings
+
+    def test_configured_poolclass_is_used(self):
+        assert isinstance(self.app.registry['engine'].pool, NullPool)
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.get('/api/v1/client/pool', headers=headers)
+        assert 'overflow' not in out.json['pools']['primary']
+
+
+class PlacementTest(BaseTest):
+    def app_settings(self):
+        settings = super(PlacementTest, self).app_settings()
+        # use the main database as shard, so the placement can be tested
+        settings['sqlalchemy.shard.local.url'] = settings['sqlalchemy.url']
+        return settings
+
+    def setUp(self):
+        super(PlacementTest, self).setUp()
+        if 'unittest_shard' in self.storage.repository_info(self.session):
+            self.storage.drop_repository(self.session, 'unittest_shard')
+            transaction.commit()
+        self.storage.create_repository(self.session,
+                                       'unittest_shard',
+                                       'shard.localhost',
+                                       placement='local')
+        self.storage.initialize_repository(self.session,
+                                           'unittest_shard',
+                                           'admin',
+                                           'admin')
+        transaction.commit()
+        self.shard_api = WebTestApp(
+            self.app, extra_environ={'HTTP_HOST': 'shard.localhost'})
+
+    def test_sessions_are_bound_to_placement(self):
+        registry = self.app.registry
+        info = self.storage.repository_info(self.session)
+        assert info['unittest_shard']['placement'] == 'local'
+        session = self.storage.make_session('unittest_shard',
+                                            placement='local')
+        shard_engine = registry['shard_engines']['local']
+        assert session.get_bind(mapper=Group).pool is shard_engine.pool
+        assert session.get_bind(
+            mapper=Repository).pool is registry['engine'].pool
+
+    def test_crud_on_placed_repository(self):
+        token = self.shard_api.post_json(
+            '/api/v1/auth/login',
+            {'user': 'admin', 'password': 'admin'}).json['token']
+        headers = dict(Authorization='Bearer %s' % token)
+        out = self.shard_api.post_json('/api/v1/group/records',
+                                       {'international_name': 'Corp.',
+                                        'type': 'organisation'},
+                                       headers=headers,
+                                       status=201)
+        out = self.shard_api.get(
+            '/api/v1/group/records/%s' % out.json['id'], headers=headers)
+        assert out.json['name'] == 'Corp.'
+        out = self.api.get('/api/v1/group/records',
+                           headers=dict(
+                               Authorization='Bearer %s' % self.admin_token()))
+        assert out.json['total'] == 0
+
+
+class TenantSelectionRoundTrip(object):
+    """
+    Create, list and search works with one of the tenant selection modes,
+    including the group closure, snippets and search vectors that are
+    written with core statements.
+    """
+    tenant_selection = None
+
+    def app_settings(self):
+        settings = super(TenantSelectionRoundTrip, self).app_settings()
+        settings['caleido.tenant_selection'] = self.tenant_selection
+        return settings
+
+    def test_create_list_search_round_trip(self):
+        assert self.storage.tenant_selection == self.tenant_selection
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.post_json('/api/v1/person/records',
+                                 {'family_name': 'Doe', 'given_name': 'John'},
+                                 headers=headers,
+                                 status=201)
+        person_id = out.json['id']
+        out = self.api.post_json('/api/v1/group/records',
+                                 {'international_name': 'Corp.',
+                                  'type': 'organisation'},
+                                 headers=headers,
+                                 status=201)
+        corp_id = out.json['id']
+        out = self.api.post_json('/api/v1/group/records',
+                                 {'international_name': 'Dept.',
+                                  'parent_id': corp_id,
+                                  'type': 'organisation'},
+                                 headers=headers,
+                                 status=201)
+        dept_id = out.json['id']
+        out = self.api.post_json('/api/v1/work/records',
+                                 {'title': 'Test Publication',
+                                  'type': 'article',
+                                  'issued': '2018-02-27'},
+                                 headers=headers,
+                                 status=201)
+        work_id = out.json['id']
+        work = out.json
+        work['contributors'] = [{'person_id': person_id,
+                                 'role': 'author',
+                                 'position': 0,
+                                 'affiliations': [{'group_id': dept_id,
+                                                   'position': 0}]}]
+        self.api.put_json('/api/v1/work/records/%s' % work_id,
+                          work,
+                          headers=headers)
+        out = self.api.get('/api/v1/work/records', headers=headers)
+        assert [r['id'] for r in out.json['records']] == [work_id]
+        # works affiliated with subgroups are found through the closure
+        out = self.api.get(
+            '/api/v1/work/listing?affiliation_group_id=%s' % corp_id,
+            headers=headers)
+        assert out.json['total'] == 1
+        snippet = out.json['snippets'][0]
+        assert snippet['contributors'][0]['name'] == 'Doe (John)'
+        out = self.api.get('/api/v1/work/search?query=doe', headers=headers)
+        assert out.json['total'] == 1
+        # the rows are stored in the schema of the repository
+        engine = self.app.registry['engine']
+        assert engine.execute(
+            'SELECT count(*) FROM unittest.works').scalar() == 1
+        assert engine.execute(
+            'SELECT count(*) FROM unittest.group_closure '
+            'WHERE ancestor_id = %s AND descendant_id = %s',
+            (corp_id, dept_id)).scalar() == 1
+
+
+class SearchPathRoundTripTest(TenantSelectionRoundTrip, BaseTest):
+    tenant_selection = 'search_path'
+
+
+class TransactionRoundTripTest(TenantSelectionRoundTrip, BaseTest):
+    tenant_selection = 'transaction'
+
+
+class SchemaTranslateRoundTripTest(TenantSelectionRoundTrip, BaseTest):
+    tenant_selection = 'schema_translate'
+
+
+class ProvisioningTest(BaseTest):
+    def test_provisioned_repository_has_tables_and_defaults(self):
+        engine = self.app.registry['engine']
+        inspector = sql.inspect(engine)
+        tables = set(inspector.get_table_names(schema='unittest'))
+        assert tables == set(
+            table.name for table in self.storage.tenant_tables())
+        indexes = [index['name'] for index in inspector.get_indexes(
+            'works', schema='unittest')]
+        assert 'ix_works_search_terms' in indexes
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.get('/api/v1/schemes/types/identifier',
+                           headers=headers)
+        assert set(v['key'] for v in out.json['values']) == set(
+            DEFAULTS['identifier_types'])
+
+    def test_extension_indexes_depend_on_installed_extensions(self):
+        dialect = self.app.registry['engine'].dialect
+        statements = self.storage.tenant_ddl('unittest', dialect)
+        assert not [s for s in statements if 'gin_trgm_ops' in s]
+        statements = self.storage.tenant_ddl('unittest', dialect,
+                                             extensions={'pg_trgm'})
+        assert [s for s in statements if 'ix_groups_name_trgm' in s]
+        installed = self.storage.installed_extensions(self.session.connection())
+        indexes = [index['name'] for index in sql.inspect(
+            self.app.registry['engine']).get_indexes(
+                'groups', schema='unittest')]
+        assert ('ix_groups_name_trgm' in indexes) == ('pg_trgm' in installed)
+
+    def test_extensions_the_role_may_not_create_are_skipped(self):
+        connection = self.session.connection()
+        connection.execute('SET LOCAL ROLE pg_monitor')
+        with mock.patch('caleido.storage.EXTENSIONS', ('vector',)):
+            installed = self.storage.ensure_extensions(connection)
+        assert 'vector' not in installed
+        # the transaction is still usable
+        connection.execute('RESET ROLE')
+        assert 'vector' not in self.storage.installed_extensions(connection)
+
+    def test_date_filters_use_range_indexes(self):
+        session = self.storage.make_session('unittest')
+        # the tables are nearly empty, make sure an index is chosen if the
+        # filter can use one. This shows the filters can use a range index,
+        # not which plan is the cheapest on populated tables
+        session.execute('SET LOCAL enable_seqscan = off')
+        start = datetime.date(2018, 1, 1)
+        queries = [
+            ('works',
+             sql.select([Work.id]).where(overlaps(Work.during, start))),
+            ('memberships',
+             sql.select([Membership.id]).where(
+                 overlaps(Membership.during, None, start))),
+            ('memberships',
+             sql.select([Membership.id]).where(sql.and_(
+                 Membership.group_id == 1,
+                 overlaps(Membership.during, start, start))))]
+        for table, query in queries:
+            plan = session.execute(Explain(query)).scalar()
+            assert ('gist', table) in self.scanned_indexes(session, plan)
+        session.close()
+
+    def scanned_indexes(self, session, plan):
+        "Return the access methods and tables of the indexes in `plan`"
+        names = set()
+        nodes = list(plan)
+        while nodes:
+            node = nodes.pop()
+            node = node.get('Plan', node)
+            if 'Index Name' in node:
+                names.add(node['Index Name'])
+            nodes.extend(node.get('Plans', []))
+        if not names:
+            return set()
+        return set(tuple(row) for row in session.execute(sql.text(
+            'SELECT am.amname, tables.relname FROM pg_index i '
+            'JOIN pg_class indexes ON indexes.oid = i.indexrelid '
+            'JOIN pg_class tables ON tables.oid = i.indrelid '
+            'JOIN pg_am am ON am.oid = indexes.relam '
+            'WHERE indexes.relname IN :names'), {'names': tuple(names)}))
+
+    def test_single_column_range_indexes_are_kept(self):
+        # a multicolumn gist index on a column with few distinct values,
+        # like the type of works, serves date only filters poorly
+        dialect = self.app.registry['engine'].dialect
+        statements = self.storage.tenant_ddl('unittest', dialect)
+        assert [s for s in statements if 'ix_works_during ' in s]
+        assert not [s for s in statements if 'ix_works_type_during' in s]
+        statements = self.storage.tenant_ddl('unittest', dialect,
+                                             extensions={'btree_gist'})
+        assert [s for s in statements if 'ix_works_during ' in s]
+        assert [s for s in statements if 'ix_works_type_during' in s]
+
+    def test_provisioned_repository_sequences_are_local(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.post_json('/api/v1/group/records',
+                                 {'international_name': 'Corp.',
+                                  'type': 'organisation'},
+                                 headers=headers,
+                                 status=201)
+        assert out.json['id'] == 1
+
+
+class DatabaseFreeRequestTest(BaseTest):
+    def test_swagger_ui_is_served_without_transaction(self):
+        monitor = self.app.registry['pool_monitors']['primary']
+        checkouts = monitor.checkouts
+        out = self.api.get('/api/swagger.html')
+        assert 'tm.active' not in out.request.environ
+        out = self.api.get('/api/index.html')
+        assert 'tm.active' not in out.request.environ
+        assert monitor.checkouts == checkouts
+
+    def test_client_config_is_served_from_cache(self):
+        monitor = self.app.registry['pool_monitors']['primary']
+        out = self.api.get('/api/v1/client')
+        assert 'organisation' in [
+            t['id'] for t in out.json['settings']['group']['type']]
+        checkouts = monitor.checkouts
+        out = self.api.get('/api/v1/client')
+        assert 'organisation' in [
+            t['id'] for t in out.json['settings']['group']['type']]
+        assert monitor.checkouts == checkouts
+
+
+class ConcurrentCountTest(BaseTest):
+    def app_settings(self):
+        settings = super(ConcurrentCountTest, self).app_settings()
+        settings['caleido.concurrent_count'] = 'true'
+        return settings
+
+    def test_listing_totals_with_concurrent_count(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        for index in range(3):
+            self.api.post_json('/api/v1/work/records',
+                               {'title': 'Publication %s' % index,
+                                'type': 'article',
+                                'issued': '2018-02-27'},
+                               headers=headers,
+                               status=201)
+        out = self.api.get('/api/v1/work/records?limit=2',
+                           headers=headers)
+        assert out.json['total'] == 3
+        assert len(out.json['records']) == 2
+        out = self.api.get('/api/v1/work/listing?limit=2',
+                           headers=headers)
+        assert out.json['total'] == 3
+        assert len(out.json['snippets']) == 2
+
+    def test_count_sees_snapshot_of_session(self):
+        session = self.storage.make_session('unittest', readonly=True)
+        query = session.query(Group)
+        total = self.storage.count(session, query, mapper=Group)
+        assert total() == 0
+        session = self.storage.make_session('unittest')
+        # sessions that may write count on their own connection
+        session.add(Group(name='Corp.', type='organisation'))
+        session.flush()
+        total = self.storage.count(session, session.query(Group), mapper=Group)
+        assert total() == 1
+
+    def test_readonly_sessions_use_repeatable_read(self):
+        session = self.storage.make_session('unittest', readonly=True)
+        assert session.execute(
+            'SHOW transaction_isolation').scalar() == 'repeatable read'
+        session = self.storage.make_session('unittest')
+        assert session.execute(
+            'SHOW transaction_isolation').scalar() == 'read committed'
+
+    def test_count_without_spare_connection_runs_inline(self):
+        session = self.storage.make_session('unittest', readonly=True)
+        session.add(Group(name='Corp.', type='organisation'))
+        session.flush()
+        executor = mock.Mock()
+        self.app.registry['query_executor'], previous = (
+            executor, self.app.registry['query_executor'])
+        try:
+            with mock.patch('caleido.storage.pool_has_capacity',
+                            return_value=False):
+                total = self.storage.count(
+                    session, session.query(Group), mapper=Group)
+                assert total() == 1
+        finally:
+            self.app.registry['query_executor'] = previous
+        assert not executor.submit.called
+
+    def test_pool_capacity(self):
+        pool = sql.pool.QueuePool(
+            lambda: mock.Mock(), pool_size=1, max_overflow=0)
+        assert pool_has_capacity(pool)
+        connection = pool.connect()
+        assert not pool_has_capacity(pool)
+        connection.close()
+        assert pool_has_capacity(pool)
+        assert pool_has_capacity(sql.pool.NullPool(lambda: mock.Mock()))
+
+
+class QueryLimitTest(BaseTest):
+    def app_settings(self):
+        settings = super(QueryLimitTest, self).app_settings()
+        settings['caleido.statement_timeout'] = '30000'
+        settings['caleido.statement_timeout.WorkListing'] = '50'
+        return settings
+
+    def test_statement_timeouts_per_service(self):
+        assert self.storage.statement_timeout('WorkListing') == 50
+        assert self.storage.statement_timeout('collection_Work') == 30000
+        assert self.storage.query_budget() is None
+
+    def test_statement_timeout_cancels_query(self):
+        session = self.storage.make_session('unittest', statement_timeout=50)
+        with self.assertRaises(StatementTimeout):
+            session.execute(sql.select([sql.func.pg_sleep(1)]))
+
+    def test_statement_timeout_is_remaining_budget(self):
+        budget = QueryBudget(max_time=1000)
+        session = self.storage.make_session(
+            'unittest', statement_timeout=1000, budget=budget)
+        # the timeout in milliseconds
+        query = sql.text("SELECT setting::integer FROM pg_settings "
+                         "WHERE name = 'statement_timeout'")
+        assert session.execute(query).scalar() == 1000
+        # the timeout is kept while more than half of it is left
+        budget.record(0.3)
+        assert session.execute(query).scalar() == 1000
+        budget.record(0.6)
+        assert session.execute(query).scalar() <= 100
+        with self.assertRaises(StatementTimeout):
+            session.execute(sql.select([sql.func.pg_sleep(1)]))
+
+    def test_query_budget_exceeded(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.storage.max_queries = 2
+        out = self.api.get('/api/v1/work/records',
+                           headers=headers,
+                           status=503)
+        assert out.json['status'] == 'error'
+        assert out.json['errors'][0]['name'] == 'query_budget'
+        self.storage.max_queries = 0
+        self.api.get('/api/v1/work/records', headers=headers, status=200)
+
+
+class CountCacheTest(BaseTest):
+    def test_totals_are_cached_until_tables_are_written(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        cache = self.app.registry['count_cache']
+        self.api.post_json('/api/v1/group/records',
+                           {'international_name': 'Corp.',
+                            'type': 'organisation'},
+                           headers=headers,
+                           status=201)
+        out = self.api.get('/api/v1/group/records?limit=1', headers=headers)
+        assert out.json['total'] == 1
+        assert len(cache._entries) == 1
+        # writes to other tables keep the total
+        self.api.post_json('/api/v1/work/records',
+                           {'title': 'Publication',
+                            'type': 'article',
+                            'issued': '2018-02-27'},
+                           headers=headers,
+                           status=201)
+        assert len(cache._entries) == 1
+        out = self.api.get('/api/v1/group/records?limit=1&offset=1',
+                           headers=headers)
+        assert out.json['total'] == 1
+        assert len(cache._entries) == 1
+        # adding a group invalidates the total
+        self.api.post_json('/api/v1/group/records',
+                           {'international_name': 'Dept.',
+                            'type': 'organisation'},
+                           headers=headers,
+                           status=201)
+        assert len(cache._entries) == 0
+        out = self.api.get('/api/v1/group/records', headers=headers)
+        assert out.json['total'] == 2
+
+    def test_totals_counted_before_an_invalidation_are_not_cached(self):
+        cache = self.app.registry['count_cache']
+        session = self.storage.make_session('unittest', readonly=True)
+        session.execute('SELECT 1')
+        # a write committed after the transaction started
+        cache.invalidate('unittest', {'groups'})
+        total = self.storage.count(session, session.query(Group),
+                                   mapper=Group)
+        assert total() == 0
+        assert len(cache._entries) == 0
+        session = self.storage.make_session('unittest', readonly=True)
+        total = self.storage.count(session, session.query(Group),
+                                   mapper=Group)
+        assert total() == 0
+        assert len(cache._entries) == 1
+
+    def test_totals_are_cached_per_principal_filters(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.api.post_json('/api/v1/work/records',
+                           {'title': 'Publication',
+                            'type': 'article',
+                            'issued': '2018-02-27'},
+                           headers=headers,
+                           status=201)
+        out = self.api.get('/api/v1/work/records', headers=headers)
+        assert out.json['total'] == 1
+        owner_headers = dict(Authorization='Bearer %s' % (
+            self.generate_test_token('owner')))
+        out = self.api.get('/api/v1/work/records', headers=owner_headers)
+        assert out.json['total'] == 0
@@ -1,4 +1,15 @@
+import colander
+import transaction
+from sqlalchemy import event
+from zope.sqlalchemy import mark_changed
+from pyramid.httpexceptions import HTTPBadRequest
+
 from core import BaseTest
+from caleido.models import Work, WorkSnippet, Identifier
+from caleido.resources import WorkResource
+from caleido.search import update_work_search_terms
+from caleido.views.work import WorkListingResponseSchema
+from caleido.utils import encode_cursor
 
 class WorkWebTest(BaseTest):
 
@@ -226,6 +237,48 @@ class WorkPermissionWebTest(BaseTest):
         assert len(pub['identifiers']) == 1
         assert pub['identifiers'][0]['value'] == 'changed'
 
+    def test_resolve_identifiers(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        pub = self.api.get('/api/v1/work/records/%s' % self.pub_id,
+                           headers=headers).json
+        pub['identifiers'] = [{'type': 'doi', 'value': '10.12345/ABC'},
+                              {'type': 'isbn', 'value': '978-3-16-148410-0'}]
+        self.api.put_json('/api/v1/work/records/%s' % self.pub_id,
+                          pub,
+                          headers=headers)
+        out = self.api.post_json(
+            '/api/v1/work/identifiers/resolve',
+            {'identifiers': [
+                {'type': 'doi', 'value': 'https://doi.org/10.12345/abc'},
+                {'type': 'isbn', 'value': '9783161484100'},
+                {'type': 'doi', 'value': '10.12345/other'},
+                {'type': 'isbn', 'value': '10.12345/abc'}]},
+            headers=headers)
+        assert [i['work_ids'] for i in out.json['identifiers']] == [
+            [self.pub_id], [self.pub_id], [], []]
+        assert out.json['identifiers'][0]['value'] == (
+            'https://doi.org/10.12345/abc')
+        # identifiers stored before the normalized values were maintained
+        session = self.storage.make_session('unittest')
+        session.execute(Identifier.__table__.update().values(
+            normalized_value=None))
+        assert WorkResource(self.app.registry,
+                            session).normalize_identifiers() == 2
+        mark_changed(session)
+        transaction.commit()
+        out = self.api.post_json(
+            '/api/v1/work/identifiers/resolve',
+            {'identifiers': [{'type': 'doi', 'value': 'doi:10.12345/abc'}]},
+            headers=headers)
+        assert out.json['identifiers'][0]['work_ids'] == [self.pub_id]
+        # importing requires the import permission
+        self.api.post_json(
+            '/api/v1/work/identifiers/resolve',
+            {'identifiers': [{'type': 'doi', 'value': '10.12345/abc'}]},
+            headers=dict(Authorization='Bearer %s' % (
+                self.generate_test_token('viewer'))),
+            status=403)
+
     def test_work_with_measures_inline(self):
         headers = dict(Authorization='Bearer %s' % self.admin_token())
         out = self.api.get('/api/v1/work/records/%s' % self.pub_id,
@@ -286,6 +339,163 @@ class WorkPermissionWebTest(BaseTest):
         assert len(pub['descriptions']) == 1
         assert pub['descriptions'][0]['value'] == 'An abstract'
 
+    def test_search_on_weighted_search_terms(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        # contributor names are searchable
+        out = self.api.get('/api/v1/work/search?query=doe', headers=headers)
+        assert out.json['total'] == 2
+        pub = self.api.get('/api/v1/work/records/%s' % self.pub_id,
+                           headers=headers).json
+        pub['descriptions'].append({'type': 'keywords',
+                                    'format': 'text',
+                                    'value': 'entanglement'})
+        pub['identifiers'].append({'type': 'doi', 'value': '10.12345/54321'})
+        self.api.put_json('/api/v1/work/records/%s' % self.pub_id,
+                          pub,
+                          headers=headers)
+        out = self.api.get('/api/v1/work/search?query=entanglement',
+                           headers=headers)
+        assert [s['id'] for s in out.json['snippets']] == [self.pub_id]
+        out = self.api.get('/api/v1/work/search?query=10.12345/54321',
+                           headers=headers)
+        assert [s['id'] for s in out.json['snippets']] == [self.pub_id]
+        # title matches rank above contributor matches
+        out = self.api.post_json('/api/v1/work/records',
+                                 {'title': 'On Doe',
+                                  'type': 'article',
+                                  'issued': '2018-02-27'},
+                                 headers=headers,
+                                 status=201)
+        out = self.api.get('/api/v1/work/search?query=doe', headers=headers)
+        assert out.json['total'] == 3
+        assert out.json['snippets'][0]['name'] == 'On Doe'
+        # removing a contributor updates the search terms
+        self.api.delete('/api/v1/contributor/records/%s' % self.contributor_id,
+                        headers=headers)
+        out = self.api.get('/api/v1/work/search?query=doe', headers=headers)
+        assert out.json['total'] == 2
+        # renaming a person updates the search terms of their works
+        jane = self.api.get('/api/v1/person/records/%s' % self.jane_id,
+                            headers=headers).json
+        jane['family_name'] = 'Roe'
+        self.api.put_json('/api/v1/person/records/%s' % self.jane_id,
+                          jane,
+                          headers=headers)
+        out = self.api.get('/api/v1/work/search?query=roe', headers=headers)
+        assert [s['id'] for s in out.json['snippets']] == [
+            self.another_pub_id]
+
+    def test_rebuilding_search_terms_of_existing_works(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        session = self.storage.make_session('unittest')
+        session.execute(Work.__table__.update().values(search_terms=None))
+        mark_changed(session)
+        transaction.commit()
+        # the vectors are filled in a transaction of its own, like the
+        # rebuild_search_terms script does
+        session = self.storage.make_session('unittest')
+        update_work_search_terms(session)
+        mark_changed(session)
+        transaction.commit()
+        out = self.api.get('/api/v1/work/search?query=doe', headers=headers)
+        assert out.json['total'] == 2
+
+    def test_listing_facets(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        pub = self.api.get('/api/v1/work/records/%s' % self.pub_id,
+                           headers=headers).json
+        pub['contributors'][0]['affiliations'] = [{'group_id': self.corp_id,
+                                                   'position': 0}]
+        self.api.put_json('/api/v1/work/records/%s' % self.pub_id,
+                          pub,
+                          headers=headers)
+        self.api.post_json('/api/v1/work/records',
+                           {'title': 'An Older Publication',
+                            'type': 'article',
+                            'issued': '2016-05-01'},
+                           headers=headers,
+                           status=201)
+        statements = []
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+        engine = self.app.registry['engine']
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            out = self.api.get(
+                '/api/v1/work/listing?limit=1&facets=type,year,affiliation',
+                headers=headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        # the page and the facets are selected in a single statement
+        assert len([statement for statement in statements
+                    if 'matched_works' in statement]) == 1
+        assert out.json['total'] == 3
+        assert len(out.json['snippets']) == 1
+        facets = out.json['facets']
+        assert facets['type'] == [{'value': 'article', 'count': 3}]
+        assert facets['year'] == [{'value': 2018, 'count': 2},
+                                  {'value': 2016, 'count': 1}]
+        assert facets['affiliation'] == [
+            {'value': self.corp_id, 'name': 'Corp.', 'count': 1}]
+        # facets are computed for the filtered works
+        out = self.api.get(
+            '/api/v1/work/listing?facets=year&facet_size=1'
+            '&start_date=2018-01-01',
+            headers=headers)
+        assert out.json['facets'] == {'year': [{'value': 2018, 'count': 2}]}
+        out = self.api.get('/api/v1/work/listing', headers=headers)
+        assert 'facets' not in out.json
+        self.api.get('/api/v1/work/listing?facets=foo',
+                     headers=headers,
+                     status=400)
+
+    def test_listing_snippets_are_maintained_on_write(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+
+        def stored_snippet(work_id):
+            session = self.storage.make_session('unittest')
+            snippet = session.query(WorkSnippet).get(work_id)
+            return snippet.snippet if snippet else None
+
+        snippet = stored_snippet(self.pub_id)
+        assert snippet['title'] == 'Test Publication'
+        assert [c['person_id'] for c in snippet['contributors']] == [
+            self.john_id]
+        # renaming a contributor updates the snippets of the works
+        self.api.put_json('/api/v1/person/records/%s' % self.john_id,
+                          {'id': self.john_id,
+                           'family_name': 'Doe',
+                           'given_name': 'Johnny'},
+                          headers=headers)
+        snippet = stored_snippet(self.pub_id)
+        assert snippet['contributors'][0]['given_name'] == 'Johnny'
+        # as does a new affiliation
+        self.api.post_json('/api/v1/affiliation/records',
+                           {'work_id': self.pub_id,
+                            'contributor_id': self.contributor_id,
+                            'group_id': self.corp_id,
+                            'position': 0},
+                           headers=headers,
+                           status=201)
+        snippet = stored_snippet(self.pub_id)
+        assert snippet['affiliations'] == [{'id': str(self.corp_id),
+                                            'name': 'Corp.'}]
+        out = self.api.get('/api/v1/work/listing', headers=headers)
+        hit = [h for h in out.json['snippets'] if h['id'] == self.pub_id][0]
+        assert hit['affiliations'] == snippet['affiliations']
+        assert hit['contributors'][0]['given_name'] == 'Johnny'
+        assert stored_snippet(self.another_pub_id) is not None
+        self.api.delete('/api/v1/work/records/%s' % self.another_pub_id,
+                        headers=headers)
+        assert stored_snippet(self.another_pub_id) is None
+        # a missing snippet is built when listing
+        session = self.storage.make_session('unittest')
+        session.query(WorkSnippet).delete()
+        transaction.commit()
+        out = self.api.get('/api/v1/work/listing', headers=headers)
+        hit = [h for h in out.json['snippets'] if h['id'] == self.pub_id][0]
+        assert hit['contributors'][0]['given_name'] == 'Johnny'
+
     def test_add_relations_inline(self):
         headers = dict(Authorization='Bearer %s' % self.admin_token())
         out = self.api.get('/api/v1/work/records/%s' % self.pub_id,
@@ -307,4 +517,223 @@ class WorkPermissionWebTest(BaseTest):
         assert len(pub['relations']) == 1
         assert pub['relations'][0]['_target_name'] == 'Another Test Publication'
 
+    def test_relation_graph(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.post_json('/api/v1/work/records',
+                                 {'title': 'Citing Publication',
+                                  'type': 'article',
+                                  'issued': '2018-03-01',
+                                  'relations': [
+                                      {'type': 'references',
+                                       'target_id': self.another_pub_id}]},
+                                 headers=headers,
+                                 status=201)
+        citing_id = out.json['id']
+        for work_id, relation_type, target_id in [
+            (self.pub_id, 'isPartOf', self.another_pub_id),
+            (self.another_pub_id, 'references', self.pub_id)]:
+            work = self.api.get('/api/v1/work/records/%s' % work_id,
+                                headers=headers).json
+            work['relations'].append({'type': relation_type,
+                                      'target_id': target_id})
+            self.api.put_json('/api/v1/work/records/%s' % work_id,
+                              work,
+                              headers=headers)
+        url = '/api/v1/work/records/%s/graph' % self.pub_id
+        out = self.api.get(url, headers=headers)
+        nodes = out.json['nodes']
+        assert [(n['id'], n['depth']) for n in nodes] == [
+            (self.pub_id, 0), (self.another_pub_id, 1)]
+        assert nodes[0]['relations'] == [{'type': 'isPartOf',
+                                          'target_id': self.another_pub_id}]
+        assert nodes[1]['title'] == 'Another Test Publication'
+        # the work itself is not repeated when the graph is cyclic
+        out = self.api.get(url + '?depth=2', headers=headers)
+        assert [(n['id'], n['depth']) for n in out.json['nodes']] == [
+            (self.pub_id, 0), (self.another_pub_id, 1), (citing_id, 2)]
+        out = self.api.get(url + '?depth=2&direction=outgoing',
+                           headers=headers)
+        assert [n['id'] for n in out.json['nodes']] == [
+            self.pub_id, self.another_pub_id]
+        out = self.api.get(url + '?depth=3&relation_type=isPartOf',
+                           headers=headers)
+        assert [n['id'] for n in out.json['nodes']] == [
+            self.pub_id, self.another_pub_id]
+        out = self.api.get(url + '?depth=2&limit=2', headers=headers)
+        assert len(out.json['nodes']) == 2
+        self.api.get(url + '?depth=4', headers=headers, status=400)
+        # owners only see the works they may view
+        owner_headers = dict(Authorization='Bearer %s' % (
+            self.generate_test_token(
+                'owner', owners=[{'person_id': self.john_id}])))
+        out = self.api.get(url + '?depth=3', headers=owner_headers)
+        assert [(n['id'], n['relations']) for n in out.json['nodes']] == [
+            (self.pub_id, [])]
+        self.api.get('/api/v1/work/records/%s/graph' % self.another_pub_id,
+                     headers=owner_headers,
+                     status=403)
+
+    def test_listing_with_multiple_ids(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.get(
+            '/api/v1/work/listing?contributor_person_id=%s,%s' % (
+                self.john_id, self.jane_id),
+            headers=headers)
+        assert out.json['total'] == 2
+        out = self.api.get(
+            '/api/v1/work/listing?contributor_person_id=%s'
+            '&contributor_person_id=%s' % (self.john_id, self.jane_id),
+            headers=headers)
+        assert out.json['total'] == 2
+        # different selectors are combined
+        pub = self.api.get('/api/v1/work/records/%s' % self.pub_id,
+                           headers=headers).json
+        pub['contributors'][0]['affiliations'] = [{'group_id': self.corp_id,
+                                                   'position': 0}]
+        self.api.put_json('/api/v1/work/records/%s' % self.pub_id,
+                          pub,
+                          headers=headers)
+        out = self.api.get(
+            '/api/v1/work/listing?contributor_person_id=%s,%s'
+            '&affiliation_group_id=%s' % (
+                self.john_id, self.jane_id, self.corp_id),
+            headers=headers)
+        assert [s['id'] for s in out.json['snippets']] == [self.pub_id]
+        out = self.api.get(
+            '/api/v1/membership/listing?person_id=%s,%s' % (
+                self.john_id, self.jane_id),
+            headers=headers)
+        assert out.json['total'] == 2
+        self.api.get('/api/v1/work/listing?contributor_person_id=1,x',
+                     headers=headers,
+                     status=400)
+
+    def test_listing_children_are_not_duplicated(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        pub = self.api.get('/api/v1/work/records/%s' % self.pub_id,
+                           headers=headers).json
+        pub['contributors'].append({'position': 1,
+                                    'role': 'author',
+                                    'person_id': self.jane_id})
+        pub['contributors'][0]['affiliations'] = [{'group_id': self.corp_id,
+                                                   'position': 0}]
+        for volume in ('1', '2'):
+            pub['relations'].append({'type': 'isPartOf',
+                                     'target_id': self.another_pub_id,
+                                     'volume': volume})
+        self.api.put_json('/api/v1/work/records/%s' % self.pub_id,
+                          pub,
+                          headers=headers)
+        out = self.api.get('/api/v1/work/listing', headers=headers)
+        hits = dict((hit['id'], hit) for hit in out.json['snippets'])
+        hit = hits[self.pub_id]
+        assert [c['person_id'] for c in hit['contributors']] == [
+            self.john_id, self.jane_id]
+        assert [r['volume'] for r in hit['relations']] == ['1', '2']
+        assert hit['affiliations'] == [{'id': str(self.corp_id),
+                                        'name': 'Corp.'}]
+        assert hits[self.another_pub_id]['relations'] == []
+
+
+
+
+class WorkPaginationWebTest(BaseTest):
+    def setUp(self):
+        super(WorkPaginationWebTest, self).setUp()
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        for index, issued in enumerate(['2018-01-01',
+                                        '2017-01-01',
+                                        '2018-01-01',
+                                        '2016-01-01',
+                                        '2018-01-01']):
+            self.api.post_json('/api/v1/work/records',
+                               {'title': 'Publication %s' % index,
+                                'type': 'article',
+                                'issued': issued},
+                               headers=headers,
+                               status=201)
+
+    def walk(self, url, key, total=5):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        ids = []
+        out = self.api.get(url, headers=headers)
+        while True:
+            assert out.json['total'] == total
+            ids.extend([hit['id'] for hit in out.json[key]])
+            if not out.json.get('cursor'):
+                break
+            out = self.api.get('%s&cursor=%s' % (url, out.json['cursor']),
+                               headers=headers)
+        return ids
+
+    def test_cursor_pagination_of_records(self):
+        ids = self.walk('/api/v1/work/records?limit=2', 'records')
+        assert ids == [5, 3, 1, 2, 4]
+
+    def test_default_order_of_records(self):
+        # the records are sorted on issued, newest first, and then on id,
+        # with or without a cursor
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.get('/api/v1/work/records', headers=headers)
+        assert [hit['id'] for hit in out.json['records']] == [5, 3, 1, 2, 4]
+
+    def test_cursor_pagination_of_records_with_open_start(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.post_json('/api/v1/work/records',
+                                 {'title': 'Open Start Publication',
+                                  'type': 'article',
+                                  'issued': '2017-06-01',
+                                  'end_date': '2017-06-01'},
+                                 headers=headers,
+                                 status=201)
+        ids = self.walk('/api/v1/work/records?limit=2', 'records', total=6)
+        assert ids == [5, 3, 1, out.json['id'], 2, 4]
+
+    def test_cursor_pagination_of_listing(self):
+        ids = self.walk('/api/v1/work/listing?limit=2', 'snippets')
+        assert ids == [5, 3, 1, 2, 4]
+
+    def test_total_modes(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        for url in ('/api/v1/work/records', '/api/v1/work/listing'):
+            out = self.api.get('%s?total=exact' % url, headers=headers)
+            assert out.json['total'] == 5
+            out = self.api.get('%s?total=none' % url, headers=headers)
+            assert out.json['total'] is None
+            assert len(out.json['records' if 'records' in url
+                                else 'snippets']) == 5
+            out = self.api.get('%s?total=estimated' % url, headers=headers)
+            assert isinstance(out.json['total'], int)
+            self.api.get('%s?total=foo' % url, headers=headers, status=400)
+        # the listing response schema allows a null total
+        total = WorkListingResponseSchema().get('body').get('total')
+        assert total.deserialize(colander.null) is None
+
+    def test_invalid_cursor(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.api.get('/api/v1/work/records?cursor=foo',
+                     headers=headers,
+                     status=400)
+        # cursors with values that do not match the sort order
+        for values in (['foo', 1], ['2018-01-01', 'x'], [1, 2],
+                       ['2018-01-01', True]):
+            for url in ('/api/v1/work/records', '/api/v1/work/listing'):
+                out = self.api.get('%s?cursor=%s' % (url,
+                                                     encode_cursor(values)),
+                                   headers=headers,
+                                   status=400)
+                assert out.json['errors'][0]['name'] == 'cursor'
+        out = self.api.get('/api/v1/group/records?cursor=%s' % (
+            encode_cursor([1, 1])), headers=headers, status=400)
+        assert out.json['errors'][0]['name'] == 'cursor'
 
+    def test_cursor_requires_default_sort_order(self):
+        cursor = self.api.get(
+            '/api/v1/work/listing?limit=2',
+            headers=dict(Authorization='Bearer %s' % self.admin_token())
+            ).json['cursor']
+        session = self.storage.make_session('unittest')
+        context = WorkResource(self.storage.registry, session)
+        with self.assertRaises(HTTPBadRequest):
+            context.listing(order_by=Work.title.asc(), cursor=cursor)
+        session.close()